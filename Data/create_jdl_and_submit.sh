@@ -13,6 +13,27 @@ MCSERIAL=50002  # MCSerialNumber a number in preprodcdb
 
 sqlitedb="../../MICEprodDB/MICEprodDB_dirac_sqlite.db"  # path to local DB
 
+MAUS_VERSION="MAUS-v3.1.2"  # processing the runs are submitted for
+BATCH_ITERATION=2
+
+completion_db="../../MICEprodDB/completion_catalogue.db"  # outputs already done
+SUBMIT_EXE="../production/submit_jobs.py"
+
+BULK_SIZE=100  # jobs per dirac-wms-job-submit call
+SUBMIT_RATE=0.5  # dirac-wms-job-submit calls per second
+
+# BannedSites from the site statistics of jobs followed by job_poller.py;
+# remove to use the hand-made list in testMICE
+SITE_OPTIONS="--site-stats"
+
+RUNINFO="../runinfo/runinfo.sqlite"  # triggers and settings of each run
+
+GROUP_SIZE=5  # runs with the same geometry submitted in one job; 1 for none
+
+# runs without beamline entry, geometry or SciFi calibration are not submitted;
+# the index is also added to the input sandbox of the jobs (metadata_index.sqlite)
+METADATA_INDEX="../../MICEprodDB/metadata_index.sqlite"
+
 # =======================
 
 prodID=${MCSERIAL}  # local DB entry for new production (for each MCSerialNumber)
@@ -25,44 +46,12 @@ if [ $# -eq 0 ];
     exit
 fi
 
-touch ../submitting
-
-chunks=$@
-
-date=`date +"%Y-%m-%d"`
-time=`date +"%H:%M:%S"`
-
-
-for i in $chunks
-
-do
-
-    filenum=`printf "%05d" $i`
-    LFC_NAME=${LFC_PREFIX}"/"${PROD_DIR}"/"${filenum}"_mc.tar"
-
-    mkdir job_$filenum
-    cd job_$filenum
-    cat ../testMICE | sed s/"AAA"/$i/g  > testMICE_$filenum.jdl
-    cp ../execute_data-v2.sh . 
-
-    echo submiting testMICE_$filenum.jdl
-
-    dirac-wms-job-submit testMICE_$filenum.jdl | awk '{print $0,"testMICE_'$filenum'.jdl job_'$filenum' "}' > submition_log.txt
-
-
-    jobid=`cat submition_log.txt | awk '{print $3}'`
-    jdlname=`cat submition_log.txt | awk '{print $4}'`
-    jobdir=`cat submition_log.txt | awk '{print $5}'`
-
-    sqlite3 ${sqlitedb} "insert into job_info2 (datetime, prodID, dir_name, jdl_name, ID, lfc_name, retry_count, status) values ('"$date" "$time"','"${prodID}"','"${jobdir}"', '"${jdlname}"', '"${jobid}"', '"${LFC_NAME}"','1', 'Submitted') "
-
-    cat submition_log.txt >> ../submition_logs.txt
-    cd ..
-
-echo sleeping...
-    sleep 2s
-echo end sleeping
-
-done
-
-rm -f ../submitting
+# submit_jobs.py makes the JDLs from testMICE in memory, submits them in bulk
+# (dirac backend) and writes the job_info2 rows in one transaction per bulk
+python ${SUBMIT_EXE} --prod-id ${prodID} --db ${sqlitedb} \
+    --lfc-name ${LFC_PREFIX}"/"${PROD_DIR}"/%05d_mc.tar" \
+    --bulk-size ${BULK_SIZE} --rate ${SUBMIT_RATE} ${SITE_OPTIONS} \
+    --runinfo ${RUNINFO} --group-size ${GROUP_SIZE} \
+    --metadata-index ${METADATA_INDEX} \
+    --completion-catalogue ${completion_db} -b ${BATCH_ITERATION} \
+    -m ${MAUS_VERSION} $@
@@ -41,6 +41,11 @@ echo ${MAUS_ROOT_DIR}
 
 OFFLINE_EXE="${MAUS_ROOT_DIR}/bin/utilities/$EXE"
 
+# prefer the executable shipped in the input sandbox
+if [ -f $PWD/$EXE ]; then
+    OFFLINE_EXE="$PWD/$EXE"
+fi
+
 # base url for raw input
 # we take the input from RAL PPD dcache
 DATA_URL="root://dcap.pp.rl.ac.uk:///pnfs/pp.rl.ac.uk/data/mice/MICE/Step4/"
@@ -54,6 +59,13 @@ DAQ_DIR="./raw"
 
 PARENT_DIR=$PWD
 
+# stages of a run done by an earlier attempt in this working directory are
+# listed in <run>_offline.stages (see execute_data_recon.py); call in the run
+# directory
+stage_done() {
+    grep -q "^$1 " ${runStr}_offline.stages 2>/dev/null
+}
+
 if [ -z $MAUS_ROOT_DIR ]; then
     echo "MAUS_ROOT_DIR is not set"
     echo "Please source env.sh from your install to set the MAUS environment"
@@ -65,8 +77,9 @@ fi
 while getopts ":r:b:c:f:h:" opt; do
   case $opt in
     r)
-      runs=${OPTARG}
-      echo $runs
+      # one run, or a comma separated group of runs sharing their geometry
+      runs=( ${OPTARG//,/ } )
+      echo ${runs[@]}
       ;;
     f)
       run_list=${OPTARG}
@@ -81,7 +94,7 @@ while getopts ":r:b:c:f:h:" opt; do
       #echo $config_file
       ;;
     h)
-      echo "Usage: $0 -r <run-number> -b batch-iteration-number -c configuration-file -f runlist-file"
+      echo "Usage: $0 -r <run-number[,run-number...]> -b batch-iteration-number -c configuration-file -f runlist-file"
       echo "       At least one of -r or -f is necessary"
       echo "       If not specified, the default configuration file is config.py"
       echo "       If not specified, the default batch-iteration-number is 2"
@@ -127,6 +140,66 @@ fi
 n_runs=${#runs[@]}
 echo "Will process $n_runs runs"
 
+# runs of one job share their geometry download (production/affinity.py
+# groups runs by geometry and settings)
+CACHE_OPTION=""
+if [ $n_runs -gt 1 ] && [ "$run_list" == "" ]; then
+    CACHE_OPTION="--download-cache $PARENT_DIR/geometry_cache"
+fi
+
+# runs are checked against the run metadata index shipped in the input sandbox
+# (production/metadata_index.py) before anything is downloaded
+INDEX_OPTION=""
+if [ -f $PARENT_DIR/metadata_index.sqlite ]; then
+    INDEX_OPTION="--metadata-index $PARENT_DIR/metadata_index.sqlite"
+fi
+
+# runs missing their beamline entry, geometry or calibration fail with 4; all
+# runs of the job are checked by one call before the loop
+INVALID_RUNS=""
+if [ -n "$INDEX_OPTION" ]; then
+    check_runs=""
+    for run in ${runs[@]}; do
+        check_runs="$check_runs,$((10#$run))"
+    done
+    INVALID_RUNS=`python $OFFLINE_EXE --run-number ${check_runs#,} --check-only $INDEX_OPTION`
+    check_status=$?
+    echo "$INVALID_RUNS"
+    if [ $check_status != 0 ] && [ $check_status != 4 ]; then
+        echo "!!! ERROR: Checking the runs failed with status = $check_status"
+        exit $check_status
+    fi
+fi
+
+# e.g. "--segment-files 5" reconstructs long runs 5 DAQ files at a time, so a
+# rerun of a preempted job continues after the last finished segment
+SEGMENT_OPTION=""
+
+# the runs of a run list are reconstructed back to back by one warm
+# execute_data_recon.py worker (--queue) instead of a new process per run;
+# both pipes are opened read-write so opening them never waits for the worker
+WORKER_PID=""
+if [ "$run_list" != "" ]; then
+    rm -f reco_queue reco_replies
+    mkfifo reco_queue reco_replies
+    \time -v python $OFFLINE_EXE --queue $PARENT_DIR/reco_queue --replies $PARENT_DIR/reco_replies --batch-iteration ${batch_iteration} $CACHE_OPTION $INDEX_OPTION $SEGMENT_OPTION > reco_worker.log 2>&1 &
+    WORKER_PID=$!
+    exec 4<>reco_replies
+    exec 3<>reco_queue
+fi
+
+# read the worker's "<run> <status>" reply to reply_run and reply_status,
+# giving up if the worker is gone
+worker_reply() {
+    while kill -0 $WORKER_PID 2>/dev/null; do
+        if read -t 10 reply_run reply_status <&4; then
+            return 0
+        fi
+    done
+    # it may have replied just before exiting
+    read -t 1 reply_run reply_status <&4
+}
+
 # loop over the list of runs
 n=0
 while [ $n -lt $n_runs ]; do
@@ -135,7 +208,9 @@ while [ $n -lt $n_runs ]; do
 
     # create run directory
     echo "Setting up $runStr ..."
-    if [ -d $runStr ]; then
+    if [ -f $runStr/${runStr}_offline.stages ]; then
+        echo "Resuming $runStr after stages:" `cut -d' ' -f1 $runStr/${runStr}_offline.stages`
+    elif [ -d $runStr ]; then
         echo "Hmm...there is a directory named $runStr. Will not overwrrite. Exiting"
         exit 1
     else
@@ -153,6 +228,13 @@ while [ $n -lt $n_runs ]; do
     cd $runStr
     curDir=$PWD
 
+    if echo "$INVALID_RUNS" | grep -q "^Run $cur_run is not valid"; then
+        echo "!!! ERROR: Reconstruction failed with status = 4"
+        cd $PARENT_DIR
+        let n=n+1
+        continue
+    fi
+
     # setup variables for input and output 
     infile="${runStr}.tar"
     tarFile="${runStr}_offline.tar"
@@ -167,24 +249,31 @@ while [ $n -lt $n_runs ]; do
     raw_tar="${runStr}.tar"
 
 
-echo lcg-ls srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.tar
+# the .processed semaphore is only written once the tar was copied with a
+# good checksum; a tar without it is from an attempt that died during the
+# upload, so the run is resumed and the upload done again
+echo lcg-ls srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.processed
 
-lcg-ls srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.tar > file_exists.txt
+lcg-ls srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.processed > processed_exists.txt
 
 ls
 
-fiex=`cat file_exists.txt | wc -l`
+fiex=`cat processed_exists.txt | wc -l`
 
 echo $fiex
 
 if [ $fiex == 0 ]; then
-        echo "No output file on dcache."
+        echo "No processed output on dcache."
 
+    if stage_done reconstruction; then
+        echo "Reconstructed by an earlier attempt, not getting raw input"
+    else
     # download raw data tarball
     echo "Getting $raw_tar from ${DATA_URL}/${subdir}"
 
     # create a raw directory --inside the run directory--
-    mkdir raw
+    stage_start=`date +%s`
+    mkdir -p raw
     xrdcp-old ${DATA_URL}/${subdir}/${raw_tar} - | tar -x -C raw >& /dev/null
     #xrdcp-old ${DATA_URL}/${subdir}/${raw_tar} . >& /dev/null
 
@@ -193,9 +282,13 @@ if [ $fiex == 0 ]; then
         exit 1
     fi
 
+    # read by site_stats.py
+    echo "Stage-in bytes = `du -sb raw | awk '{print $1}'` seconds = $((`date +%s`-stage_start))"
+
    ls -al
 
    ls -al raw
+    fi
 
     # now execute the reco
     echo "Processing ....."
@@ -205,12 +298,23 @@ if [ $fiex == 0 ]; then
     ####python ./$EXE --run-number $cur_run --batch-iteration 1 --no-globals
     ########################
 
-    \time -v python $OFFLINE_EXE --run-number $cur_run --batch-iteration ${batch_iteration}
-    status=$?
+    # a dead worker leaves the remaining runs to a process each
+    if [ -n "$WORKER_PID" ] && kill -0 $WORKER_PID 2>/dev/null; then
+        reply_run=""
+        reply_status=""
+        echo "$cur_run $PWD" >&3 && worker_reply
+        status=3
+        if [ "$reply_run" == "$cur_run" ] && [ -n "$reply_status" ]; then
+            status=$reply_status
+        fi
+    else
+        \time -v python $OFFLINE_EXE --run-number $cur_run --batch-iteration ${batch_iteration} $CACHE_OPTION $INDEX_OPTION $SEGMENT_OPTION
+        status=$?
+    fi
 
-    echo $status > reco.status
+    echo "$status" > reco.status
 
-    if [ $status != 0 ]; then
+    if [ "$status" != 0 ]; then
         echo "!!! ERROR: Reconstruction failed with status = $status"
     fi
 
@@ -259,11 +363,31 @@ if [ $fiex == 0 ]; then
 ###echo "copy to" ${CLOSE_SE}/Simulation/MCproduction/$PADDED_10k/$century/${PADDED_mcserial}/${PADDED_filenum}_mc.tar
 ##echo "copy to" ${USE_THIS_SE}/Simulation/MCproduction/$PADDED_10k/$century/${PADDED_mcserial}/${PADDED_filenum}_mc.tar 
 
-lcg-ls srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.tar
+# a speculative copy of this job (job_poller.py --speculate) may have
+# finished first: its .processed semaphore is only written once its tar was
+# copied with a good checksum, so keep that output and do not upload ours
+lcg-ls srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.processed > processed_exists.txt
 
-lcg-cp --checksum ${runStr}_offline.tar srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.tar
-
-lcg-cp ${runStr}_offline.processed srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.processed
+if [ `cat processed_exists.txt | wc -l` != 0 ]; then
+    echo "Error: Already existing output file on dcache!"
+    echo "Not uploaded, local md5: " `cat ${mdFile}`
+else
+    # remove a partial tar left by an attempt that died during the upload
+    lcg-ls srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.tar > file_exists.txt
+    if [ `cat file_exists.txt | wc -l` != 0 ]; then
+        echo "Removing unprocessed output on dcache"
+        lcg-del --nolfc srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.tar
+    fi
+    stage_start=`date +%s`
+    lcg-cp --checksum ${runStr}_offline.tar srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.tar
+    copy_status=$?
+    echo "Stage-out bytes = `stat -c %s ${runStr}_offline.tar` seconds = $((`date +%s`-stage_start))"
+
+    if [ $copy_status == 0 ]; then
+        lcg-cp ${runStr}_offline.processed srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}/${runStr}_offline.processed && \
+            echo "upload `date +%s`" >> ${runStr}_offline.stages
+    fi
+fi
 
 ##lcg-cr --checksum -l /grid/mice/Simulation/MCproduction/$PADDED_10k/$century/${PADDED_mcserial}/${PADDED_filenum}_mc.tar -d ${USE_THIS_SE}/Simulation/MCproduction/$PADDED_10k/$century/${PADDED_mcserial}/${PADDED_filenum}_mc.tar ${PADDED_filenum}_mc.tar
 
@@ -274,10 +398,18 @@ lcg-cp ${runStr}_offline.processed srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/
     ls -al
 
 else
-    echo "Error: Already existing output file on dcache!"
+    echo "Error: Already processed output file on dcache!"
 fi
 
     cd $PARENT_DIR
 	ls -al
     let n=n+1
 done
+
+if [ -n "$WORKER_PID" ]; then
+    exec 3>&-
+    wait $WORKER_PID
+    exec 4<&-
+    rm -f reco_queue reco_replies
+    cat reco_worker.log
+fi
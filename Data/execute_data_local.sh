@@ -0,0 +1,197 @@
+#!/bin/bash
+
+#=================================
+# Reconstruction job run by production/local_executor.py on a local machine
+# or batch cluster, with the same arguments as execute_data-v3.sh:
+#     execute_data_local.sh -r <run-number[,run-number...]> [-b batch-iteration]
+# The MAUS environment is taken from the shell running the executor (source
+# env.sh of a MAUS install first), or set up from cvmfs if it is not there.
+# Outputs go to the local storage element $LOCAL_SE (set by the executor) in
+# the layout used on dcache:
+#     $LOCAL_SE/RECO/<MAUS version>/<batch iteration>/Step4/<century>/
+# Raw data are read from $RAW_DATA_DIR/<century>/<run>.tar if it is set, else
+# from dcache with xrdcp.
+#=================================
+
+MAUS_VERSION="MAUS-v3.1.2"
+
+VO_MICE_SW_DIR=/cvmfs/mice.egi.eu
+MAUS_DIR=$VO_MICE_SW_DIR/sl6/$MAUS_VERSION
+
+if [ -z $MAUS_ROOT_DIR ] && [ -d $MAUS_DIR ]; then
+    cp $MAUS_DIR/configure .
+    ./configure -r $MAUS_DIR
+    source ./env.sh
+    export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:$MAUS_DIR/external
+fi
+
+if [ -z $MAUS_ROOT_DIR ]; then
+    echo "MAUS_ROOT_DIR is not set"
+    echo "Please source env.sh from your install to set the MAUS environment"
+    exit 3
+fi
+
+if [ -z $LOCAL_SE ]; then
+    echo "LOCAL_SE is not set"
+    exit 3
+fi
+
+runs=""
+batch_iteration=2
+
+EXE="execute_data_recon.py"
+OFFLINE_EXE="${MAUS_ROOT_DIR}/bin/utilities/$EXE"
+if [ -f $PWD/$EXE ]; then
+    OFFLINE_EXE="$PWD/$EXE"
+fi
+
+DATA_URL="root://dcap.pp.rl.ac.uk:///pnfs/pp.rl.ac.uk/data/mice/MICE/Step4/"
+
+PARENT_DIR=$PWD
+
+# stages of a run done by an earlier attempt in this working directory are
+# listed in <run>_offline.stages (see execute_data_recon.py); call in the run
+# directory
+stage_done() {
+    grep -q "^$1 " ${runStr}_offline.stages 2>/dev/null
+}
+
+while getopts ":r:b:" opt; do
+  case $opt in
+    r)
+      runs=( ${OPTARG//,/ } )
+      ;;
+    b)
+      batch_iteration=${OPTARG}
+      ;;
+    \?)
+      echo "FATAL: Invalid option: -$OPTARG" >&2
+      exit 3
+      ;;
+  esac
+done
+
+if [ -z $runs ]; then
+    echo "A run number must be specified with -r"
+    exit 3
+fi
+
+n_runs=${#runs[@]}
+echo "Will process $n_runs runs"
+
+CACHE_OPTION=""
+if [ $n_runs -gt 1 ]; then
+    CACHE_OPTION="--download-cache $PARENT_DIR/geometry_cache"
+fi
+
+# runs are checked against the run metadata index shipped in the input sandbox
+# (production/metadata_index.py) before anything is downloaded
+INDEX_OPTION=""
+if [ -f $PARENT_DIR/metadata_index.sqlite ]; then
+    INDEX_OPTION="--metadata-index $PARENT_DIR/metadata_index.sqlite"
+fi
+
+# runs missing their beamline entry, geometry or calibration fail with 4; all
+# runs of the job are checked by one call before the loop
+INVALID_RUNS=""
+if [ -n "$INDEX_OPTION" ]; then
+    check_runs=""
+    for run in ${runs[@]}; do
+        check_runs="$check_runs,$((10#$run))"
+    done
+    INVALID_RUNS=`python $OFFLINE_EXE --run-number ${check_runs#,} --check-only $INDEX_OPTION`
+    check_status=$?
+    echo "$INVALID_RUNS"
+    if [ $check_status != 0 ] && [ $check_status != 4 ]; then
+        echo "!!! ERROR: Checking the runs failed with status = $check_status"
+        exit $check_status
+    fi
+fi
+
+# long runs are reconstructed SEGMENT_FILES DAQ files at a time; finished
+# segments are published next to the outputs so a rerun picks them up
+SEGMENT_FILES=${SEGMENT_FILES:-5}
+
+job_status=0
+n=0
+while [ $n -lt $n_runs ]; do
+    cur_run=$((10#${runs[$n]}))
+    printf -v runStr "%05d" $cur_run
+    let sd=$cur_run/100*100
+    printf -v subdir "%05d" $sd
+    OUT_DIR=$LOCAL_SE/RECO/${MAUS_VERSION}/${batch_iteration}/Step4/${subdir}
+    SEGMENT_OPTION="--segment-files $SEGMENT_FILES --segment-publish $OUT_DIR/segments"
+
+    # a directory with a stage file is resumed (see execute_data_recon.py)
+    mkdir -p $runStr
+    cd $runStr
+
+    if echo "$INVALID_RUNS" | grep -q "^Run $cur_run is not valid"; then
+        echo "!!! ERROR: Reconstruction failed with status = 4"
+        job_status=4
+        cd $PARENT_DIR
+        let n=n+1
+        continue
+    fi
+
+    if [ -e $OUT_DIR/${runStr}_offline.processed ]; then
+        echo "Error: Already existing output file on dcache!"
+        cd $PARENT_DIR
+        let n=n+1
+        continue
+    fi
+
+    if stage_done reconstruction; then
+        echo "Reconstructed by an earlier attempt, not getting raw input"
+    else
+        stage_start=`date +%s`
+        mkdir -p raw
+        if [ "$RAW_DATA_DIR" != "" ]; then
+            tar -x -C raw -f $RAW_DATA_DIR/${subdir}/${runStr}.tar >& /dev/null
+        else
+            xrdcp-old ${DATA_URL}/${subdir}/${runStr}.tar - | tar -x -C raw >& /dev/null
+        fi
+        if [ $? -ne 0 ]; then
+            echo "Error getting raw input for ${runStr}.tar"
+            exit 1
+        fi
+        # read by site_stats.py
+        echo "Stage-in bytes = `du -sb raw | awk '{print $1}'` seconds = $((`date +%s`-stage_start))"
+    fi
+
+    echo "Processing ....."
+    \time -v python $OFFLINE_EXE --run-number $cur_run --batch-iteration ${batch_iteration} $CACHE_OPTION $INDEX_OPTION $SEGMENT_OPTION
+    status=$?
+    echo $status > reco.status
+
+    if [ $status != 0 ]; then
+        echo "!!! ERROR: Reconstruction failed with status = $status"
+        job_status=$status
+    else
+        stage_start=`date +%s`
+        mkdir -p $OUT_DIR
+        # copy under a temporary name so the output appears complete or not
+        # at all; the .processed semaphore is written last
+        cp ${runStr}_offline.tar $OUT_DIR/.${runStr}_offline.tar.tmp && \
+            mv $OUT_DIR/.${runStr}_offline.tar.tmp $OUT_DIR/${runStr}_offline.tar
+        copy_status=$?
+        echo "Stage-out bytes = `stat -c %s ${runStr}_offline.tar` seconds = $((`date +%s`-stage_start))"
+        if [ $copy_status == 0 ]; then
+            if [ -e ${runStr}_offline.tar.md5 ]; then
+                cp ${runStr}_offline.tar.md5 $OUT_DIR
+            fi
+            cp ${runStr}_offline.processed $OUT_DIR
+            echo "upload `date +%s`" >> ${runStr}_offline.stages
+            # the run is stored whole now, its published segments are not needed
+            rm -f $OUT_DIR/segments/${runStr}_segment-*
+        else
+            echo "Error copying ${runStr}_offline.tar to $OUT_DIR"
+            job_status=1
+        fi
+    fi
+
+    cd $PARENT_DIR
+    let n=n+1
+done
+
+exit $job_status
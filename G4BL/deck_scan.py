@@ -0,0 +1,180 @@
+#!/bin/env python
+
+"""
+Expand a magnet parameter scan into G4BL decks, skipping known settings
+"""
+
+DESCRIPTION = """
+Expand a parameter grid into <deck>.json files for simulate_mice_G4BL_v2.py
+and run_g4bl_pool.py, scheduling only settings that have not been produced.
+
+The scan file is JSON:
+    {
+        "base": {"Q1":1.018, "Q2":-1.271, "Q3":0.884, "D1":-1.242,
+                 "D2":-0.8, "DS":3.666, "proton_absorber":29},
+        "scan": {"D2":[-0.8, -0.9, -1.0], "proton_absorber":[0, 29, 83]}
+    }
+Every combination of the "scan" values is applied on top of "base". Each
+point is resolved into its g4bl configuration with get_setup_dict and hashed
+without the seed, run number and MAUS install path, so settings that resolve
+to the same configuration (within the grid or against earlier scans) are
+simulated only once. The deck of a point is named <prefix>_<hash>.
+
+Known configurations are kept in a local manifest (JSON) as
+    {<hash>: {"deck":..., "fields":..., "status":"scheduled"|"produced"}}
+"expand" writes the decks and a deck list of the new points; run_g4bl_pool.py
+--manifest marks a deck as produced when all its chunks succeeded. Scheduled
+points that never got produced are scheduled again by the next expand.
+
+Usage:
+    deck_scan.py expand <scan.json> [--manifest m] [--deck-list f] [--prefix p]
+    deck_scan.py status [--manifest m]
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+
+from simulate_mice_G4BL_v2 import get_setup_dict
+
+DEFAULT_MANIFEST = 'g4bl_manifest.json'
+
+# g4bl keys that do not change the beam that is generated
+UNHASHED_KEYS = ['random_seed', 'run_number', 'file_path']
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['expand', 'status'])
+    parser.add_argument('scan_file', nargs='?', default=None)
+    parser.add_argument('--manifest', dest='manifest', \
+                        default=DEFAULT_MANIFEST, help='Manifest file')
+    parser.add_argument('--deck-list', dest='deck_list', \
+                        default='new_decks.txt', \
+                        help='Output list of decks still to be produced')
+    parser.add_argument('--prefix', dest='prefix', default='scan', \
+                        help='Deck name prefix')
+    return parser
+
+def load_manifest(manifest):
+    """
+    @returns the manifest dictionary; empty if the file does not exist
+    """
+    if not os.path.exists(manifest):
+        return {}
+    with open(manifest) as manifest_file:
+        return json.load(manifest_file)
+
+def save_manifest(manifest, entries):
+    """
+    Write the manifest atomically, so an interrupted write cannot lose it
+    """
+    with open(manifest+'.tmp', 'w') as manifest_file:
+        json.dump(entries, manifest_file, indent=1, sort_keys=True)
+    os.rename(manifest+'.tmp', manifest)
+
+def expand_grid(scan):
+    """
+    @returns list of deck field dictionaries, one per grid point
+    """
+    names = sorted(scan.get('scan', {}).keys())
+    values = [scan['scan'][name] for name in names]
+    points = []
+    for combination in itertools.product(*values):
+        fields = dict(scan.get('base', {}))
+        fields.update(dict(zip(names, combination)))
+        points.append(fields)
+    return points
+
+def write_deck(deck_name, fields):
+    """
+    Write <deck_name>.json as read by get_setup_dict
+    """
+    with open(deck_name+'.json', 'w') as deck_file:
+        json.dump(fields, deck_file, indent=1, sort_keys=True)
+
+def config_hash(deck_name):
+    """
+    Hash the resolved g4bl configuration of a deck, excluding the seed
+
+    @returns hex digest identifying the configuration
+    """
+    g4bl = get_setup_dict(deck_name, '0', 0, 0, 0)['g4bl']
+    for key in UNHASHED_KEYS:
+        g4bl.pop(key, None)
+    return hashlib.sha1(json.dumps(g4bl, sort_keys=True)).hexdigest()
+
+def expand(scan_file, manifest, deck_list, prefix):
+    """
+    Write decks for the new points of a scan and record them as scheduled
+
+    @returns list of deck names to produce
+    """
+    with open(scan_file) as scan_in:
+        scan = json.load(scan_in)
+    entries = load_manifest(manifest)
+    new_decks = []
+    n_known = 0
+    tmp_deck = prefix+'_tmp'
+    for fields in expand_grid(scan):
+        write_deck(tmp_deck, fields)
+        digest = config_hash(tmp_deck)
+        if digest in entries and (entries[digest]['status'] == 'produced' or \
+                                  entries[digest]['deck'] in new_decks):
+            n_known += 1
+            continue
+        deck_name = prefix+'_'+digest[:12]
+        os.rename(tmp_deck+'.json', deck_name+'.json')
+        entries[digest] = {'deck':deck_name, 'fields':fields, \
+                           'status':'scheduled'}
+        new_decks.append(deck_name)
+    if os.path.exists(tmp_deck+'.json'):
+        os.remove(tmp_deck+'.json')
+    save_manifest(manifest, entries)
+    with open(deck_list, 'w') as list_out:
+        for deck_name in new_decks:
+            list_out.write(deck_name+'\n')
+    print 'Scheduled', len(new_decks), 'new decks;', n_known, \
+          'points already produced or duplicated'
+    return new_decks
+
+def mark_produced(manifest, deck_names):
+    """
+    Mark decks as produced in the manifest
+
+    Called by run_g4bl_pool.py once all chunks of a deck succeeded. Decks that
+    are not in the manifest are added, so hand-made decks are deduplicated too.
+    """
+    entries = load_manifest(manifest)
+    for deck_name in deck_names:
+        digest = config_hash(deck_name)
+        entry = entries.get(digest, {'deck':deck_name, 'fields':None})
+        entry['status'] = 'produced'
+        entries[digest] = entry
+    save_manifest(manifest, entries)
+
+def main(argv):
+    """
+    Command line interface - see DESCRIPTION
+    """
+    args = arg_parser().parse_args(argv)
+    if args.command == 'expand':
+        if args.scan_file is None:
+            print 'expand needs a scan file'
+            return 1
+        expand(args.scan_file, args.manifest, args.deck_list, args.prefix)
+    else:
+        for digest, entry in sorted(load_manifest(args.manifest).items()):
+            print digest[:12], entry['deck'], entry['status']
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,5 +1,9 @@
 import MAUS
 import io
+import sys
+import json
+import maus_cpp.globals
+from Configuration import Configuration
 
 def main():
     """ Run the macro
@@ -24,6 +28,68 @@ def main():
     # The Go() drives all the components you pass in, then check the file
     # (default simulation.out) for output
     MAUS.Go(my_input, my_map, MAUS.ReducePyDoNothing(), my_output, datacards)
+
+def pop_batch_file(argv):
+    """
+    Remove --batch_file <file> from the command line arguments
+
+    @returns the batch file name, or None if the option was not given
+    """
+    if '--batch_file' in argv:
+        i = argv.index('--batch_file')
+        batch_file = argv[i+1]
+        del argv[i:i+2]
+        return batch_file
+    return None
+
+def run_batch(batch_file):
+    """
+    Generate several chunks in one process
+
+    The batch file is a JSON list with one entry per chunk, each holding the
+    chunk "random_seed", "run_number" and "output_root_file_name". MAUS and
+    the geometry are set up once; the beamline mapper, spill generator and
+    output are birthed again for each chunk with the chunk datacards, as the
+    mapper takes its seed and run number at birth, so every chunk is
+    reproducible on its own and goes to its own output file.
+    """
+    with open(batch_file) as batch_in:
+        batch = json.load(batch_in)
+    datacards = io.StringIO(u"")
+    config = json.loads(Configuration().getConfigJSON(datacards, True))
+    if not maus_cpp.globals.has_instance():
+        maus_cpp.globals.birth(json.dumps(config))
+    try:
+        for chunk in batch:
+            chunk_config = dict(config)
+            chunk_config["g4bl"] = dict(config["g4bl"])
+            chunk_config["g4bl"]["random_seed"] = chunk["random_seed"]
+            chunk_config["g4bl"]["run_number"] = chunk["run_number"]
+            chunk_config["output_root_file_name"] = \
+                                                chunk["output_root_file_name"]
+            chunk_config_doc = json.dumps(chunk_config)
+            print "Generating", chunk["output_root_file_name"], \
+                  "with seed", chunk["random_seed"]
+
+            my_map = MAUS.MapPyBeamlineSimulation()
+            my_input = MAUS.InputPySpillGenerator()
+            my_output = MAUS.OutputCppRoot()
+            my_map.birth(chunk_config_doc)
+            my_input.birth(chunk_config_doc)
+            my_output.birth(chunk_config_doc)
+            try:
+                for spill in my_input.emitter():
+                    my_output.save(my_map.process(spill))
+            finally:
+                my_map.death()
+                my_input.death()
+                my_output.death()
+    finally:
+        maus_cpp.globals.death()
     
 if __name__ == "__main__":
-    main()
+    BATCH_FILE = pop_batch_file(sys.argv)
+    if BATCH_FILE is None:
+        main()
+    else:
+        run_batch(BATCH_FILE)
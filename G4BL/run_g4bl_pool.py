@@ -0,0 +1,184 @@
+#!/bin/env python
+
+"""
+Run G4BL chunk production for a deck scan across the cores of one node
+"""
+
+DESCRIPTION = """
+Generate G4BL chunks for a list of decks and a range of chunk numbers on one
+node.
+
+All datacard.json files are written up front, one working directory per
+(deck, chunk), with seeds from simulate_mice_G4BL_v2.chunk_seed so no two
+chunks share a seed, however many are started at once. run_g4bl.py is then run
+in each directory through a process pool (by default one process per core).
+The wall time and return code of every chunk are printed and written to the
+timing file as "<deck> <chunk> <seconds> <return code>" lines.
+
+The decks (<deck>.json) and the geometry (geo-<sim_run>/) are read from the
+current directory, as for simulate_mice_G4BL_v2.py. With --manifest, decks
+whose chunks all succeeded are marked as produced in the deck_scan.py
+manifest.
+"""
+
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+from simulate_mice_G4BL_v2 import get_setup_dict, setup_from_dict, chunk_seed
+
+G4BL_EXE = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+                        'run_g4bl.py')
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--decks', dest='decks', required=True, \
+                        help='Comma separated deck names, or a file with '+\
+                             'one deck name per line')
+    parser.add_argument('--first-chunk', dest='first_chunk', type=int, \
+                        default=0, help='First chunk number')
+    parser.add_argument('--last-chunk', dest='last_chunk', type=int, \
+                        required=True, help='Last chunk number (inclusive)')
+    parser.add_argument('--sim-run', dest='sim_run', required=True, \
+                        help='Geometry run number (geometry in geo-<sim_run>)')
+    parser.add_argument('--seed', dest='base_seed', type=int, default=0, \
+                        help='Base seed the per-chunk seeds are derived from')
+    parser.add_argument('--spills-per-chunk', dest='spills_per_chunk', \
+                        type=int, default=1, help='Spills per chunk')
+    parser.add_argument('--processes', dest='processes', type=int, \
+                        default=multiprocessing.cpu_count(), \
+                        help='Number of chunks run at once')
+    parser.add_argument('--work-dir', dest='work_dir', default='g4bl_chunks', \
+                        help='Parent directory of the per-chunk directories')
+    parser.add_argument('--timing-file', dest='timing_file', \
+                        default='g4bl_timing.txt', \
+                        help='Per-chunk timing output')
+    parser.add_argument('--manifest', dest='manifest', default=None, \
+                        help='deck_scan.py manifest to mark produced decks in')
+    return parser
+
+def get_decks(decks):
+    """
+    @returns list of deck names from a comma separated list or a file
+    """
+    if os.path.isfile(decks):
+        with open(decks) as deck_file:
+            return [line.strip() for line in deck_file if line.strip()]
+    return [deck for deck in decks.split(',') if deck]
+
+def get_seeds(decks, chunks, sim_run, base_seed):
+    """
+    Seeds for all chunks of the scan, guaranteed distinct
+
+    A hash collision between two chunks is resolved by rehashing the later
+    chunk with a bumped base seed, so the result is still reproducible.
+
+    @returns dict of (deck, chunk) -> seed
+    """
+    seeds = {}
+    used = set()
+    for deck in decks:
+        for chunk in chunks:
+            salt = base_seed
+            seed = chunk_seed(deck, chunk, sim_run, salt)
+            while seed in used:
+                salt += 1
+                seed = chunk_seed(deck, chunk, sim_run, salt)
+            used.add(seed)
+            seeds[(deck, chunk)] = seed
+    return seeds
+
+def write_datacards(deck, chunk, sim_run, seed, spills_per_chunk, work_dir):
+    """
+    Write datacard.json for one chunk into its own working directory
+
+    @returns the chunk working directory
+    """
+    chunk_dir = os.path.join(work_dir, deck+"_"+str(chunk))
+    if not os.path.isdir(chunk_dir):
+        os.makedirs(chunk_dir)
+    setup_dict = get_setup_dict(deck, str(chunk), sim_run, seed, seed, \
+                                spills_per_chunk)
+    # the chunk runs in its own directory, so point at the shared geometry
+    setup_dict["simulation_geometry_filename"] = \
+                      os.path.abspath(setup_dict["simulation_geometry_filename"])
+    datacards = setup_from_dict(setup_dict)
+    with open(os.path.join(chunk_dir, 'datacard.json'), 'w') as fd:
+        fd.write(datacards.getvalue())
+    return chunk_dir
+
+def run_chunk(task):
+    """
+    Run run_g4bl.py for one chunk; executed in a pool worker
+
+    @param task tuple of (deck, chunk, chunk_dir)
+
+    @returns tuple of (deck, chunk, wall seconds, return code)
+    """
+    deck, chunk, chunk_dir = task
+    start = time.time()
+    with open(os.path.join(chunk_dir, 'g4bl.log'), 'w') as log:
+        proc = subprocess.Popen(["python", G4BL_EXE, "--configuration_file", \
+                                 "datacard.json"], cwd=chunk_dir, \
+                                stdout=log, stderr=subprocess.STDOUT)
+        proc.wait()
+    return (deck, chunk, time.time()-start, proc.returncode)
+
+def main(argv):
+    """
+    Write the datacards, run the pool and report the timing
+
+    @returns 0 if all chunks succeeded, else 1
+    """
+    args = arg_parser().parse_args(argv)
+    decks = get_decks(args.decks)
+    chunks = range(args.first_chunk, args.last_chunk+1)
+    seeds = get_seeds(decks, chunks, args.sim_run, args.base_seed)
+
+    tasks = []
+    for deck in decks:
+        for chunk in chunks:
+            chunk_dir = write_datacards(deck, chunk, args.sim_run, \
+                                        seeds[(deck, chunk)], \
+                                        args.spills_per_chunk, args.work_dir)
+            tasks.append((deck, chunk, chunk_dir))
+    print 'Running', len(tasks), 'chunks on', args.processes, 'processes'
+
+    failed_decks = set()
+    n_failed = 0
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes)
+    with open(args.timing_file, 'w') as timing:
+        for deck, chunk, seconds, returncode in \
+                                         pool.imap_unordered(run_chunk, tasks):
+            print '   ', deck, chunk, 'took', round(seconds, 1), \
+                  's and returned', returncode
+            timing.write(deck+' '+str(chunk)+' '+str(round(seconds, 1))+' '+\
+                         str(returncode)+'\n')
+            timing.flush()
+            if returncode != 0:
+                n_failed += 1
+                failed_decks.add(deck)
+    pool.close()
+    pool.join()
+    if args.manifest is not None:
+        import deck_scan
+        deck_scan.mark_produced(args.manifest, \
+                           [deck for deck in decks if deck not in failed_decks])
+    print 'Done', len(tasks), 'chunks in', round(time.time()-start, 1), \
+          's;', n_failed, 'failed'
+    if n_failed > 0:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
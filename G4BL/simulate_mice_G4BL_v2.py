@@ -18,6 +18,7 @@ import subprocess
 import shutil
 import fileinput
 import json
+import zlib
 
 def download_geometry(self):
     """
@@ -48,7 +49,8 @@ def download_geometry(self):
     if proc.returncode != 0:
         raise DownloadError("Failed to download geometry successfully")
 
-def get_setup_dict(deck_name, chunk_number, sim_run, seed, run_number):
+def get_setup_dict(deck_name, chunk_number, sim_run, seed, run_number, \
+                   spills_per_chunk=1):
 
     """
     # Settings for a classic 3mm-200MeV/c muon beam
@@ -81,22 +83,52 @@ def get_setup_dict(deck_name, chunk_number, sim_run, seed, run_number):
     my_dict = {
         "simulation_geometry_filename":GEO_FILE,
         "output_root_file_name":deck_name+"_"+chunk_number+".root",
-	"spill_generator_number_of_spills":1,
+	"spill_generator_number_of_spills":spills_per_chunk,
 	"g4bl":g4bl
     }
     return my_dict
 
+def chunk_seed(deck_name, chunk_number, sim_run, base_seed):
+    """
+    Deterministic random seed for one chunk
+
+    The seed is a hash of the base seed, deck, geometry run and chunk number,
+    so a chunk can be regenerated exactly and different chunks, decks or
+    base seeds get different seeds whenever and wherever they are run.
+
+    @returns seed as an int in [1, 2^31-1)
+    """
+    key = "%s:%s:%s:%s" % (base_seed, deck_name, sim_run, chunk_number)
+    return (zlib.crc32(key) & 0x7fffffff) % 2147483646 + 1
+
+def get_batch(deck_name, first_chunk, n_chunks, sim_run, base_seed):
+    """
+    Per-chunk settings for a batched invocation
+
+    @returns list of dicts with chunk_number, random_seed, run_number and
+             output_root_file_name, as read by run_g4bl.py --batch_file
+    """
+    batch = []
+    for chunk_number in range(int(first_chunk), int(first_chunk)+n_chunks):
+        seed = chunk_seed(deck_name, chunk_number, sim_run, base_seed)
+        batch.append({"chunk_number":chunk_number, "random_seed":seed, \
+                      "run_number":seed, "output_root_file_name":\
+                      deck_name+"_"+str(chunk_number)+".root"})
+    return batch
+
 def setup_from_dict(key_dict):
     my_keys = ""
     for key, value in key_dict.iteritems():
         my_keys += str(key)+" = "+json.dumps(value)+"\n"
     return io.StringIO(unicode(my_keys))
 
-def run():
+def run(batch_file=None):
     """ Run the macro
     """
     G4BL_EXE='run_g4bl.py'
     run_args = ["python", G4BL_EXE, "--configuration_file", "datacard.json"]
+    if batch_file is not None:
+        run_args += ["--batch_file", batch_file]
     proc = subprocess.Popen(run_args)
     proc.wait()
 
@@ -106,8 +138,12 @@ if __name__ == '__main__':
     deck_name = ""
     chunk_number = -1 
     sim_run = -1 
+    n_chunks = 1
+    spills_per_chunk = 1
+    base_seed = None
 
-    (opts, args) = getopt.getopt(sys.argv[1:], "", ["deck_name=", "chunk_number=", "sim_run="])
+    (opts, args) = getopt.getopt(sys.argv[1:], "", ["deck_name=", "chunk_number=", "sim_run=", \
+                                 "n_chunks=", "spills_per_chunk=", "seed="])
     for o, a in opts:
 	    if o == "--deck_name":
 	        if a:
@@ -118,23 +154,41 @@ if __name__ == '__main__':
 	    if o == "--sim_run":
 	        if a:
 		    sim_run = a
+            if o == "--n_chunks":
+                n_chunks = int(a)
+            if o == "--spills_per_chunk":
+                spills_per_chunk = int(a)
+            if o == "--seed":
+                base_seed = int(a)
 
 
     if not deck_name or chunk_number < 0 or sim_run < 0:
         print "Some of the parameter(s) is/are missing"
         sys.exit(1)
         
-    # Get the simulation seed and run_numbeer from the current time
+    # Get the simulation seed and run_numbeer from the current time, unless a
+    # base seed is given or several chunks are generated; per-chunk seeds are
+    # then derived deterministically from the base seed
     seed = int(time.time())
+    batch_file = None
+    if n_chunks > 1 or base_seed is not None:
+        if base_seed is None:
+            base_seed = 0
+        batch = get_batch(deck_name, chunk_number, n_chunks, sim_run, base_seed)
+        seed = batch[0]["random_seed"]
+        batch_file = 'batch.json'
+        with open(batch_file, 'w') as fd:
+            json.dump(batch, fd, indent=1)
     run_number = seed
     
     # Fetch the data cards and load them
-    setup_dict = get_setup_dict(deck_name, chunk_number, sim_run, seed, run_number)
+    setup_dict = get_setup_dict(deck_name, chunk_number, sim_run, seed, run_number, \
+                                spills_per_chunk)
     datacards = setup_from_dict(setup_dict)
     with open('datacard.json', 'w') as fd:
         datacards.seek (0)
         shutil.copyfileobj (datacards, fd)
         
     # Run the simulation (e12 protons on target)
-    run()
+    run(batch_file)
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Read and write G4BL JSON chunks, optionally compressed
+
+A chunk is a line-delimited JSON file with one spill per line. Chunks named
+*.gz are gzip compressed and chunks named *.zst are zstd compressed; both are
+decompressed on the fly while the spills are streamed, so the uncompressed
+chunk never touches the disk. gzip uses the python gzip module; zstd goes
+through the zstd command line tool, as the python bindings are not available
+on the grid.
+"""
+
+import gzip
+import subprocess
+
+COMPRESSION_SUFFIXES = {'gzip':'.gz', 'zstd':'.zst', 'none':''}
+
+def compression_suffix(file_name):
+    """
+    @returns the compression suffix of file_name ('.gz', '.zst') or ''
+    """
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if suffix != '' and file_name.endswith(suffix):
+            return suffix
+    return ''
+
+def is_compressed(file_name):
+    """
+    @returns True if file_name is a compressed chunk
+    """
+    return compression_suffix(file_name) != ''
+
+class PipeFile: # pylint: disable = R0903
+    """
+    File-like wrapper around the stdin or stdout of a (de)compressor process
+
+    close() waits for the process and raises IOError if it failed, so a
+    truncated or corrupt chunk is not silently accepted.
+    """
+    def __init__(self, args, mode):
+        """
+        Start the process
+
+        @param args command line of the process
+        @param mode 'r' to read its stdout, 'w' to write its stdin
+        """
+        if mode == 'r':
+            self._proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+            self._file = self._proc.stdout
+        else:
+            self._proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+            self._file = self._proc.stdin
+        self._args = args
+
+    def __iter__(self):
+        """Iterate over lines"""
+        return iter(self._file.readline, '')
+
+    def __enter__(self):
+        """Context manager support"""
+        return self
+
+    def __exit__(self, *args):
+        """Context manager support"""
+        self.close()
+
+    def __getattr__(self, name):
+        """Delegate read, readline, write etc to the pipe"""
+        return getattr(self._file, name)
+
+    def close(self):
+        """
+        Close the pipe and wait for the process
+
+        @raises IOError if the process returned non-zero
+        """
+        if self._proc is None:
+            return
+        self._file.close()
+        self._proc.wait()
+        returncode = self._proc.returncode
+        self._proc = None
+        if returncode != 0:
+            raise IOError(' '.join(self._args)+" returned "+str(returncode))
+
+def open_chunk(file_name, mode='r'):
+    """
+    Open a chunk, compressing or decompressing on the fly
+
+    @param file_name chunk file name; the suffix selects the compression
+    @param mode 'r' or 'w'
+
+    @returns file-like object iterating over (or accepting) lines of JSON
+    """
+    suffix = compression_suffix(file_name)
+    if suffix == '.gz':
+        return gzip.open(file_name, mode+'b')
+    if suffix == '.zst':
+        if mode == 'r':
+            return PipeFile(['zstd', '-q', '-d', '-c', file_name], 'r')
+        return PipeFile(['zstd', '-q', '-f', '-o', file_name], 'w')
+    return open(file_name, mode)
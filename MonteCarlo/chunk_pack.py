@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""
+Packed container of G4BL JSON chunks
+"""
+
+DESCRIPTION = """
+Pack the chunks of a G4BL chunk list into one container file and read single
+chunks back out of it, either from a local (mirror) copy or over HTTP with a
+byte-range request, so an MC job only transfers its own chunk.
+
+Container layout:
+    <chunk 0 bytes><chunk 1 bytes>...<index JSON><trailer>
+
+The trailer is the 8 character magic MICEPACK followed by the length of the
+index JSON as a 16 digit zero padded decimal. The index is
+    {"version":1, "chunks":[{"name", "offset", "length", "md5"}, ...]}
+Chunks are stored byte for byte, so gzip/zstd compressed chunks stay
+compressed and are decompressed on the fly by simulate_beam.py.
+
+Usage:
+    chunk_pack.py pack <chunk list> <output.pack>
+    chunk_pack.py list <pack file or URL>
+    chunk_pack.py extract <pack file or URL> <chunk index> [<output dir>]
+
+A pack published on a web server can be passed to execute_MC.py with
+--input-file in place of a chunk list; --run-number is then the chunk index.
+"""
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from time import sleep
+
+import chunk_io
+
+PACK_MAGIC = 'MICEPACK'
+TRAILER_LENGTH = len(PACK_MAGIC)+16
+PACK_SUFFIX = '.pack'
+
+def is_pack(file_name):
+    """
+    @returns True if file_name names a chunk pack
+    """
+    return file_name.endswith(PACK_SUFFIX)
+
+def _is_http(source):
+    """
+    @returns True if source is an http(s) URL
+    """
+    return source.startswith('http://') or source.startswith('https://')
+
+def read_range(source, offset, length):
+    """
+    Read a byte range of a pack
+
+    @param source local path, file: URL or http(s) URL of the pack
+    @param offset first byte to read; negative counts from the end of the file
+    @param length number of bytes to read
+
+    @returns the bytes as a string
+    @raises IOError if the range could not be read in full, straight away
+            without retrying if the server ignores the byte range
+    """
+    if source.startswith('file:'):
+        source = source[len('file:'):]
+    if not _is_http(source):
+        with open(source, 'rb') as pack:
+            if offset < 0:
+                pack.seek(offset, os.SEEK_END)
+            else:
+                pack.seek(offset)
+            data = pack.read(length)
+    else:
+        if offset < 0:
+            byte_range = 'bytes='+str(offset)
+        else:
+            byte_range = 'bytes='+str(offset)+'-'+str(offset+length-1)
+        args = ['wget', '-nv', '-S', '-O', '-', \
+                '--header', 'Range: '+byte_range, source]
+        data = ''
+        for i in range(5):
+            with tempfile.TemporaryFile() as log:
+                proc = subprocess.Popen(args, stdout=subprocess.PIPE, \
+                                        stderr=log)
+                # stop as soon as there is more than the range, rather than
+                # downloading the whole pack
+                data = proc.stdout.read(length+1)
+                if len(data) > length:
+                    proc.kill()
+                proc.communicate()
+                log.seek(0)
+                stderr = log.read()
+            status = re.findall(r'HTTP/\S+ (\d+)', stderr)
+            if len(data) > length or (status and status[-1] == '200'):
+                raise IOError("Server sent the whole of "+source+\
+                              " instead of "+byte_range+\
+                              " - it does not support byte ranges")
+            if proc.returncode == 0 and len(data) == length:
+                break
+            print 'Range request', byte_range, 'failed on attempt', i+1, \
+                  stderr
+            sleep(0.5)
+    if len(data) != length:
+        raise IOError("Read "+str(len(data))+" bytes instead of "+\
+                      str(length)+" from "+source+\
+                      " - does the server support byte ranges?")
+    return data
+
+def read_index(source):
+    """
+    Read the index of a pack
+
+    @returns list of chunk dictionaries with name, offset, length and md5
+    """
+    trailer = read_range(source, -TRAILER_LENGTH, TRAILER_LENGTH)
+    if not trailer.startswith(PACK_MAGIC):
+        raise IOError(source+" is not a chunk pack")
+    index_length = int(trailer[len(PACK_MAGIC):])
+    index = read_range(source, -TRAILER_LENGTH-index_length, index_length)
+    return json.loads(index)['chunks']
+
+def extract_chunk(source, chunk_number, output_dir, mirror=None):
+    """
+    Extract one chunk of a pack to a local file
+
+    @param source local path or http(s) URL of the pack
+    @param chunk_number index of the chunk in the pack
+    @param output_dir directory to write the chunk to
+    @param mirror optional local directory holding a copy of the pack; used in
+           preference to source if the pack is found there
+
+    @returns the local file name of the chunk
+    @raises IOError if the chunk does not exist or fails its checksum
+    """
+    if mirror is not None:
+        mirrored = os.path.join(mirror, os.path.basename(source))
+        if os.path.exists(mirrored):
+            source = mirrored
+    chunks = read_index(source)
+    chunk_number = int(chunk_number)
+    if chunk_number < 0 or chunk_number >= len(chunks):
+        raise IOError("No chunk "+str(chunk_number)+" in "+source)
+    entry = chunks[chunk_number]
+    data = read_range(source, entry['offset'], entry['length'])
+    if hashlib.md5(data).hexdigest() != entry['md5']:
+        raise IOError("Checksum mismatch for chunk "+str(chunk_number)+\
+                      " of "+source)
+    file_name = os.path.join(output_dir, entry['name'])
+    with open(file_name, 'wb') as out:
+        out.write(data)
+    return file_name
+
+def pack(entries, pack_name, work_dir):
+    """
+    Write the chunks of a chunk list into a pack
+
+    @param entries chunk list entries (URLs, grid LFNs or local paths)
+    @param pack_name output pack file name
+    @param work_dir scratch directory for downloads
+
+    @returns list of chunk dictionaries written to the index
+    """
+    from rechunk_g4bl import fetch
+    chunks = []
+    offset = 0
+    with open(pack_name, 'wb') as out:
+        for i, entry in enumerate(entries):
+            name = 'jsondoc_'+str(i)+'.txt'+chunk_io.compression_suffix(entry)
+            local_name = os.path.join(work_dir, name)
+            file_name = fetch(entry, local_name)
+            md5hash = hashlib.md5()
+            length = 0
+            with open(file_name, 'rb') as fin:
+                for block in iter(lambda: fin.read(1024*1024), b""):
+                    md5hash.update(block)
+                    out.write(block)
+                    length += len(block)
+            if file_name == local_name:
+                os.remove(local_name)
+            chunks.append({'name':name, 'offset':offset, 'length':length, \
+                           'md5':md5hash.hexdigest()})
+            offset += length
+        index = json.dumps({'version':1, 'chunks':chunks})
+        out.write(index)
+        out.write(PACK_MAGIC+str(len(index)).rjust(16, '0'))
+    return chunks
+
+def main(argv):
+    """
+    Command line interface - see DESCRIPTION
+    """
+    if len(argv) == 3 and argv[0] == 'pack':
+        with open(argv[1]) as list_file:
+            entries = [line.strip() for line in list_file if line.strip()]
+        chunks = pack(entries, argv[2], os.path.dirname(argv[2]) or '.')
+        print 'Packed', len(chunks), 'chunks into', argv[2]
+    elif len(argv) == 2 and argv[0] == 'list':
+        for i, entry in enumerate(read_index(argv[1])):
+            print i, entry['name'], entry['offset'], entry['length'], \
+                  entry['md5']
+    elif len(argv) in [3, 4] and argv[0] == 'extract':
+        output_dir = '.'
+        if len(argv) == 4:
+            output_dir = argv[3]
+        print extract_chunk(argv[1], argv[2], output_dir)
+    else:
+        print DESCRIPTION
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -43,6 +43,20 @@ LFC_PREFIX="/grid/mice/users/dmaletic"  # LFC prefix
 
 sqlitedb="../../MICEprodDB/MICEprodDB_dirac_sqlite.db"  # path to local DB
 
+SUBMIT_EXE="../production/submit_jobs.py"
+
+BULK_SIZE=100  # jobs per dirac-wms-job-submit call
+SUBMIT_RATE=0.5  # dirac-wms-job-submit calls per second
+
+# BannedSites from the site statistics of jobs followed by job_poller.py;
+# remove to use the hand-made list in testMICE
+SITE_OPTIONS="--site-stats"
+
+# the geometry of the MCSERIAL cards is checked in this metadata index (see
+# production/metadata_index.py) before submitting, and the index is added to
+# the input sandbox of the jobs (metadata_index.sqlite) to check it again
+METADATA_INDEX="../../MICEprodDB/metadata_index.sqlite"
+
 # =======================
 
 prodID=${MCSERIAL}  # local DB entry for new production (for each MCSerialNumber)
@@ -57,67 +71,16 @@ if [ $# -eq 0 ];
     exit
 fi
 
-touch ../submitting
-
+# submit_jobs.py makes the JDLs from testMICE in memory, submits them in bulk
+# (dirac backend) and writes the job_info2 rows in one transaction per bulk
 if [ $1 == "file" ];
    then
-     g4bllist=$2
-
-     wget $g4bllist
-
-     infile=`echo  $g4bllist | sed s/"\/"/"\n"/g | tail -1`
-
-     if [ -f $infile ];
-       then
-         echo "File $infile exists."
-       else
-         echo "File $infile does not exist."
-         exit
-     fi
-
-    number=`cat $infile | wc -l | awk '{print $1-1}'`
-     echo file: $infile number of chunks: $(($number+1))
-     chunks=$(eval echo "{11..$number}")
-#      chunks=$(eval echo "{11..250}")
-#     chunks=$(eval echo "{0..10}")
+     chunks="--chunk-list $2 --first-chunk 11"
    else
- chunks=$@
+     chunks=$@
 fi
 
-date=`date +"%Y-%m-%d"`
-time=`date +"%H:%M:%S"`
-
-
-for i in $chunks
-
-do
-
-    filenum=`printf "%05d" $i`
-    LFC_NAME=${LFC_PREFIX}"/"${PROD_DIR}"/"${filenum}"_mc.tar"
-
-    mkdir job_$filenum
-    cd job_$filenum
-    cat ../testMICE | sed s/"AAA"/$i/g  > testMICE_$filenum.jdl
-    cp ../execute_against_MC.sh ../execute_MC.py  .
-    echo submiting testMICE_$filenum.jdl
-#    glite-wms-job-submit -d ${delegatename} --endpoint ${WMS_ENDPOINT} -r ${CE_USED} testMICE_$filenum.jdl | awk '{print $0,"testMICE_'$filenum'.jdl job_'$filenum' "}' > submition_log.txt
-    dirac-wms-job-submit testMICE_$filenum.jdl | awk '{print $0,"testMICE_'$filenum'.jdl job_'$filenum' "}' > submition_log.txt
-
-# JobID = 4511856 testMICE_00000.jdl job_00000 
-
-    jobid=`cat submition_log.txt | awk '{print $3}'`
-    jdlname=`cat submition_log.txt | awk '{print $4}'`
-    jobdir=`cat submition_log.txt | awk '{print $5}'`
-
-    sqlite3 ${sqlitedb} "insert into job_info2 (datetime, prodID, dir_name, jdl_name, ID, lfc_name, retry_count, status) values ('"$date" "$time"','"${prodID}"','"${jobdir}"', '"${jdlname}"', '"${jobid}"', '"${LFC_NAME}"','1', 'Submitted') "
-
-    cat submition_log.txt >> ../submition_logs.txt
-    cd ..
-
-echo sleeping...
-    sleep 1s
-echo end sleeping
-
-done
-
-rm -f ../submitting
+python ${SUBMIT_EXE} --prod-id ${prodID} --db ${sqlitedb} \
+    --lfc-name ${LFC_PREFIX}"/"${PROD_DIR}"/%05d_mc.tar" \
+    --bulk-size ${BULK_SIZE} --rate ${SUBMIT_RATE} ${SITE_OPTIONS} \
+    --metadata-index ${METADATA_INDEX} --mc-serial ${MCSERIAL} $chunks
@@ -96,6 +96,10 @@ def arg_parser():
     parser.add_argument('--geometry-id', dest='geoid', \
                         help='The simulation geometry ID number') # ,\
                         # required=True)
+    parser.add_argument('--pack-mirror', dest='pack_mirror', \
+                        help='Local directory holding copies of chunk packs; '+\
+                             'used instead of downloading if the pack is there',
+                        default=None)
     return parser
 
 class DownloadError(Exception):
@@ -326,9 +330,15 @@ class RunManager:
         Executes the simulation; puts the output file into the tar queue
         """
         print 'Running simulation'
-        simulation = [os.path.join(self.run_setup.maus_root_dir, 'bin', 
+        # prefer a simulate_beam.py shipped in the input sandbox, which
+        # understands compressed chunks and chunk lists
+        simulation = [os.path.join(os.getcwd(), 'simulate_beam.py')]
+        if not os.path.exists(simulation[0]):
+            simulation = [os.path.join(self.run_setup.maus_root_dir, 'bin', 
                                                             'simulate_beam.py')]
-        simulation += self.run_setup.get_simulation_parameters()
+        # run with this interpreter, as sandbox files lose their exec bit
+        simulation = [sys.executable] + simulation + \
+                     self.run_setup.get_simulation_parameters()
         print simulation
         print self.logs.tar_queue
         proc = subprocess.Popen(simulation, stdout=self.logs.sim_log, \
@@ -378,6 +388,7 @@ class RunSettings: #pylint: disable = R0902
         self.run_number = args_in.run_number
         self.run_number_as_string = str(self.run_number).rjust(5, '0')
         self.tar_file_name = self.run_number_as_string+"_mc.tar"
+        self.pack_mirror = args_in.pack_mirror
         self.g4bl_interface = \
                    self.get_file_name_from_run_number(self.input_file_name,\
                                                       self.run_number)
@@ -404,9 +415,19 @@ class RunSettings: #pylint: disable = R0902
         Assumes that the file index contains a list of file names and
         that the run_number corresponds to a line number in the file.
 
+        If the file index is a chunk pack (see chunk_pack.py) the run_number
+        is the chunk index in the pack; only that chunk's byte range is read,
+        from the local pack mirror if there is one or else over HTTP.
+
         @returns a file name as a string
         """
         
+        if file_index.endswith('.pack'):
+            # only needed for packs, so only required in the sandbox then
+            import chunk_pack
+            return chunk_pack.extract_chunk(file_index, run_number, \
+                                            os.getcwd(), self.pack_mirror)
+
         index = os.path.basename(file_index)
         index = os.path.join(os.getcwd(), index)
         if os.path.exists(index):
@@ -444,6 +465,11 @@ class RunSettings: #pylint: disable = R0902
         # file names on the grid are arbitrary so make
         # it something logical for the local copy
         file_name = "jsondoc_"+str(run_number)+".txt"
+        # keep the compression suffix of gzip/zstd chunks; they are
+        # decompressed on the fly by simulate_beam.py
+        for suffix in ['.gz', '.zst']:
+            if target_entry.endswith(suffix):
+                file_name += suffix
         if target_entry.find("http") >= 0:
             # use a wget algorithm instead
             args = ['wget']
@@ -34,6 +34,30 @@ The user needs to source env.sh in the usual way before running.
 Creates a tarball called ######_offline.tar where ##### is the run number right
 aligned and padded by 0s.
 
+If --result-catalogue is given, a fingerprint of all inputs (final sim.cards,
+geometry, G4BL input chunk and MAUS version) is looked up in that local
+catalogue before simulating. On a hit the stored output tarball is reused; on
+success a new output is added to the catalogue.
+
+With --g4bl-datacards (the datacards G4BL/simulate_mice_G4BL_v2.py writes)
+there is no --input-file: the beamline is simulated in the job by
+simulate_fused.py, which hands the G4BL spills straight to the MAUS
+simulation. The G4BL seed is derived from the datacards seed and the run
+number, so each job simulates its own beam and a rerun the same one. The job
+scripts use this mode when g4bl_datacards.json is in the input sandbox.
+
+If --metadata-index is given, the geometry is looked up in that local index
+(made by production/metadata_index.py, shipped in the input sandbox by
+submit_jobs.py): the --geometry-id before anything is downloaded, and the
+geometry_download_id of the MC cards once they are downloaded. A geometry the
+index records as not downloadable is rejected with return code 4.
+
+The MAUS geometry download utility is run through its Python code in a fork
+of this process, with its output and any traceback collected into the
+download log; the MAUS modules it uses (maus_cpp, Configuration, the geometry
+package) are imported before the fork. If the fork fails, or with
+--subprocess-utilities, it is run by a new interpreter as before.
+
 Return codes are:
     0 - Everything ran okay.
     1 - There was a transient error. Try again later. Transient errors are
@@ -43,16 +67,20 @@ Return codes are:
         checked by the software expert.
     3 - there was some problem with this script. It needs to be checked by the
         software expert.
+    4 - the job failed pre-flight validation. It will fail again until its
+        metadata is uploaded to the configuration database.
 """
 
 # dynamically set __doc__ string so I can access it for argparse
 #pylint: disable = W0622, C0301
 __doc__ = DESCRIPTION+"""
 
-Three classes are defined
+Five classes are defined
   - RunManager: handles overall run execution;
   - FileManager: handles logging and output tarball;
   - RunSettings: handles run setup #pylint: disable = W0622
+  - ResultCatalogue: handles reuse of outputs with identical inputs
+  - UtilityRun: handles runs of the MAUS download utilities
 """
 
 # TODO (rogers): pylint: disable = W0511
@@ -60,12 +88,20 @@ Three classes are defined
 # - docstrings + pylint
 
 import argparse
+import re
 import tarfile
 import sys
 import os
 import subprocess
 import shutil
 import time
+import hashlib
+import json
+import zlib
+import sqlite3
+import runpy
+import tempfile
+import traceback
 from time import sleep
 import cdb
 
@@ -79,7 +115,11 @@ def arg_parser():
                            formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('--input-file', dest='input_file', \
                         help='Read interface file with this name', \
-                        required=True)
+                        default=None)
+    parser.add_argument('--g4bl-datacards', dest='g4bl_datacards', \
+                        help='Simulate the beamline in the job from these '+\
+                             'G4BL datacards instead of reading --input-file', \
+                        default=None)
     parser.add_argument('--run-number', dest='run_number', \
                         help='Output index number', \
                         required=True)
@@ -95,8 +135,103 @@ def arg_parser():
     parser.add_argument('--geometry-id', dest='geoid', \
                         help='The simulation geometry ID number') # ,\
                         # required=True)
+    parser.add_argument('--pack-mirror', dest='pack_mirror', \
+                        help='Local directory holding copies of chunk packs; '+\
+                             'used instead of downloading if the pack is there',
+                        default=None)
+    parser.add_argument('--result-catalogue', dest='result_catalogue', \
+                        default=None, \
+                        help='Local sqlite catalogue of outputs keyed by '+\
+                             'input fingerprint; reused when inputs match')
+    parser.add_argument('--metadata-index', dest='metadata_index', \
+                        default=None, \
+                        help='Local metadata index checked before any '+\
+                             'download')
+    parser.add_argument('--subprocess-utilities', \
+                        dest='in_process_utilities', action='store_false', \
+                        default=True, \
+                        help='Run the download utilities in new '+\
+                             'interpreters instead of forks of this one')
     return parser
 
+def file_md5(file_name):
+    """
+    @returns the md5 hex digest of a file
+    """
+    md5hash = hashlib.md5()
+    with open(file_name, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(4096), b""):
+            md5hash.update(chunk)
+    return md5hash.hexdigest()
+
+def hash_paths(md5hash, paths):
+    """
+    Add the names and contents of files and directory trees to a hash
+
+    Directories are walked in sorted order so the hash does not depend on the
+    file system listing order. Missing paths are hashed by name only.
+    """
+    for path in paths:
+        md5hash.update(os.path.basename(path))
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_name = os.path.join(root, name)
+                    md5hash.update(os.path.relpath(file_name, path))
+                    md5hash.update(file_md5(file_name))
+        elif os.path.isfile(path):
+            md5hash.update(file_md5(path))
+
+def check_geometry_metadata(index_file, geometry_id):
+    """
+    Look up a geometry ID in the metadata index made by
+    production/metadata_index.py
+
+    @returns list of reasons the job cannot run; empty if the geometry is fine
+             or is not in the index
+    """
+    if index_file is None or geometry_id is None or \
+       not os.path.isfile(index_file):
+        return []
+    conn = sqlite3.connect(index_file)
+    try:
+        row = conn.execute("SELECT available FROM geometries WHERE \
+                            geometry_id = ?", (str(geometry_id),)).fetchone()
+    except sqlite3.Error:
+        row = None
+    conn.close()
+    if row is None or row[0] != 0:
+        return []
+    return ['geometry '+str(geometry_id)+' cannot be downloaded']
+
+def cards_geometry_id(cards_file):
+    """
+    @returns the geometry_download_id set in a datacards file, or None
+    """
+    if not os.path.isfile(cards_file):
+        return None
+    match = re.search(r'^\s*geometry_download_id\s*=\s*[\'"]?(\w+)', \
+                      open(cards_file).read(), re.MULTILINE)
+    if match is None:
+        return None
+    return match.group(1)
+
+class ValidationError(Exception):
+    """
+    ValidationError indicates the job cannot run because metadata it needs is
+    missing from the configuration database - resubmitting will not help until
+    the metadata is uploaded.
+    """
+    def __init__(self, error_message):
+        """Initialise the exception with some error message"""
+        super(ValidationError, self).__init__(error_message)
+        self.error_message = error_message
+
+    def __str__(self):
+        """Return a string containing the the error message"""
+        return repr(self.error_message)
+
 class DownloadError(Exception):
     """
     DownloadError indicates a failure to download some necessary data for the
@@ -143,6 +278,11 @@ class RunManager:
         self.logs.open_log('download.log', 'sim.log', 'batch.log')
         self.run_setup = RunSettings(args_in_)
         self.logs.tar_file_name = self.run_setup.tar_file_name
+        self.sim_status = -1
+        self.fingerprint = None
+        self.catalogue = None
+        if self.run_setup.result_catalogue is not None:
+            self.catalogue = ResultCatalogue(self.run_setup.result_catalogue)
 
     def run(self):
         """
@@ -158,26 +298,50 @@ class RunManager:
             return 1
         self.setup()
         self.download_cards()
+        self.check_cards_geometry()
         self.download_geometry()
+        if self.reuse_result():
+            return 0
         self.execute_simulation()
 
 
-    def check_valid(self): # pylint: disable = R0201
+    def check_valid(self):
         """
         Checks that the run number can be executed
 
-        Not implemented yet, but some day would like to check that the run has
-        valid calibrations, cabling and geometry
+        Looks the geometry up in the metadata index, if there is one, and
+        checks that the G4BL interface file was downloaded
 
         @returns True if run is valid
+        @raises ValidationError if the geometry cannot be downloaded
         """
         print 'Checking run validity'
-        
+        problems = check_geometry_metadata(self.run_setup.metadata_index, \
+                                           self.run_setup.geometry_id)
+        if len(problems) > 0:
+            raise ValidationError('; '.join(problems))
+        if self.run_setup.g4bl_datacards is not None:
+            return os.path.exists(self.run_setup.g4bl_datacards)
         if os.path.exists(self.run_setup.g4bl_interface):
             return True
         else:
             return False
 
+    def check_cards_geometry(self):
+        """
+        Looks the geometry the MC cards ask for up in the metadata index, if
+        there is one
+
+        @raises ValidationError if the geometry cannot be downloaded
+        """
+        geometry_id = cards_geometry_id(self.run_setup.sim_cards)
+        if geometry_id is None:
+            return
+        problems = check_geometry_metadata(self.run_setup.metadata_index, \
+                                           geometry_id)
+        if len(problems) > 0:
+            raise ValidationError('; '.join(problems))
+
     def setup(self):
         """
         Set up the current working directory
@@ -204,7 +368,8 @@ class RunManager:
         download_dir = self.run_setup.download_target
         if os.path.isdir(download_dir):
             shutil.rmtree(download_dir)
-        if os.path.exists(self.run_setup.input_file_name):
+        if self.run_setup.input_file_name is not None and \
+           os.path.exists(self.run_setup.input_file_name):
             os.remove(self.run_setup.input_file_name)
 
     
@@ -263,22 +428,63 @@ class RunManager:
         @raises DownloadError on failure
         """
         print 'Getting geometry'
-        download = [os.path.join(self.run_setup.maus_root_dir, 'bin', \
-                                 'utilities', 'download_geometry.py')]
+        download = os.path.join(self.run_setup.maus_root_dir, 'bin', \
+                                'utilities', 'download_geometry.py')
         # check that there is a selection for the geometry in the datacards
-        download += self.run_setup.get_download_parameters()
-        proc = subprocess.Popen(download, stdout=self.logs.download_log, \
-                                                       stderr=subprocess.STDOUT)
-        proc.wait()
+        geometry = UtilityRun(download, \
+                              self.run_setup.get_download_parameters(), \
+                              self.run_setup.in_process_utilities)
+        geometry.wait(self.logs.download_log)
         if self.run_setup.test_mode:
             test_path_in = os.path.join(self.run_setup.maus_root_dir, 'src',
                     'legacy', 'FILES', 'Models', 'Configurations', 'Test.dat')
             test_path_out = os.path.join(self.run_setup.download_target, \
                                                        'ParentGeometryFile.dat')
             # shutil.copy(test_path_in, test_path_out)
-        if proc.returncode != 0:
-            raise DownloadError("Failed to download geometry successfully")
+        if geometry.returncode != 0:
+            raise DownloadError("Failed to download geometry successfully"+\
+                                geometry.error())
+
+
+    def get_fingerprint(self):
+        """
+        Fingerprint of everything that determines the simulation output
+
+        Covers the final sim cards, the geometry download, the G4BL input
+        chunk and the MAUS version.
+
+        @returns hex digest as a string
+        """
+        md5hash = hashlib.md5()
+        md5hash.update(self.run_setup.maus_version)
+        beam = self.run_setup.g4bl_interface
+        if self.run_setup.g4bl_datacards is not None:
+            beam = self.run_setup.job_g4bl_datacards
+            self.run_setup.write_g4bl_datacards()
+        hash_paths(md5hash, [self.run_setup.sim_cards,
+                             self.run_setup.download_target,
+                             beam])
+        return md5hash.hexdigest()
+
+    def reuse_result(self):
+        """
+        Look the input fingerprint up in the result catalogue
 
+        On a hit the catalogued tarball is copied to the output tarball name,
+        and is then left alone when the logs are closed.
+
+        @returns True if an earlier output was reused
+        """
+        if self.catalogue is None:
+            return False
+        self.fingerprint = self.get_fingerprint()
+        print 'Input fingerprint', self.fingerprint
+        if not self.catalogue.fetch(self.fingerprint, \
+                                    self.run_setup.tar_file_name):
+            return False
+        print 'Reusing catalogued output for identical inputs'
+        self.logs.tar_file_name = None
+        return True
 
     def execute_simulation(self):
         """
@@ -287,9 +493,22 @@ class RunManager:
         Executes the simulation; puts the output file into the tar queue
         """
         print 'Running simulation'
-        simulation = [os.path.join(self.run_setup.maus_root_dir, 'bin', 
-                                                            'simulate_beam.py')]
-        simulation += self.run_setup.get_simulation_parameters()
+        if self.run_setup.g4bl_datacards is not None:
+            # the fused beamline and MAUS simulation is only in the sandbox
+            self.run_setup.write_g4bl_datacards()
+            simulation = [os.path.join(os.getcwd(), 'simulate_fused.py'), \
+                          '--g4bl_datacards', \
+                          self.run_setup.job_g4bl_datacards]
+        else:
+            # prefer a simulate_beam.py shipped in the input sandbox, which
+            # understands compressed chunks and chunk lists
+            simulation = [os.path.join(os.getcwd(), 'simulate_beam.py')]
+            if not os.path.exists(simulation[0]):
+                simulation = [os.path.join(self.run_setup.maus_root_dir, 'bin',
+                                                           'simulate_beam.py')]
+        # run with this interpreter, as sandbox files lose their exec bit
+        simulation = [sys.executable] + simulation + \
+                     self.run_setup.get_simulation_parameters()
         print simulation
         proc = subprocess.Popen(simulation, stdout=self.logs.sim_log, \
                                                        stderr=self.logs.sim_log)
@@ -297,6 +516,7 @@ class RunManager:
         proc.wait()
         if proc.returncode != 0:
             raise MausError("MAUS simulation returned "+str(proc.returncode))
+        self.sim_status = proc.returncode
         self.logs.tar_queue.append(self.run_setup.mc_file_name)
         print self.logs.tar_queue
         # print self.logs.tar_queue
@@ -312,6 +532,11 @@ class RunManager:
         if not self.run_setup == None:
             self.cleanup()
             self.logs.close_log()
+            if self.sim_status == 0 and self.catalogue is not None and \
+               self.fingerprint is not None:
+                self.catalogue.record(self.fingerprint, \
+                                      self.run_setup.run_number, \
+                                      self.run_setup.tar_file_name)
             # if not self.run_setup.test_mode:
 
 
@@ -335,10 +560,16 @@ class RunSettings: #pylint: disable = R0902
         self.input_file_name = args_in.input_file
         self.test_mode = args_in.test_mode    
         self.mc_iteration = args_in.mc_iteration
+        self.result_catalogue = args_in.result_catalogue
         self.run_number = args_in.run_number
         self.run_number_as_string = str(self.run_number).rjust(5, '0')
         self.tar_file_name = self.run_number_as_string+"_mc.tar"
-        self.g4bl_interface = \
+        self.pack_mirror = args_in.pack_mirror
+        self.g4bl_datacards = args_in.g4bl_datacards
+        self.job_g4bl_datacards = 'g4bl.cards'
+        self.g4bl_interface = None
+        if self.g4bl_datacards is None:
+            self.g4bl_interface = \
                    self.get_file_name_from_run_number(self.input_file_name,\
                                                       self.run_number)
 
@@ -347,13 +578,18 @@ class RunSettings: #pylint: disable = R0902
         
         print self.g4bl_interface
         
-        if os.path.exists(self.g4bl_interface):
+        if self.g4bl_interface is not None and \
+           os.path.exists(self.g4bl_interface):
             print "Download of interface file successful"
             
         self.maus_root_dir = os.environ["MAUS_ROOT_DIR"]
+        self.maus_version = os.environ.get("MAUS_VERSION", \
+                             os.path.basename(self.maus_root_dir.rstrip('/')))
         self.download_target = '%s/downloads' % os.getcwd()
         self.sim_cards = 'sim.cards'
         self.geometry_id = args_in.geoid
+        self.metadata_index = args_in.metadata_index
+        self.in_process_utilities = args_in.in_process_utilities
 
     def get_file_name_from_run_number(self, file_index, run_number):
         # pylint: disable = R0201
@@ -365,9 +601,19 @@ class RunSettings: #pylint: disable = R0902
         Assumes that the file index contains a list of file names and
         that the run_number corresponds to a line number in the file.
 
+        If the file index is a chunk pack (see chunk_pack.py) the run_number
+        is the chunk index in the pack; only that chunk's byte range is read,
+        from the local pack mirror if there is one or else over HTTP.
+
         @returns a file name as a string
         """
         
+        if file_index.endswith('.pack'):
+            # only needed for packs, so only required in the sandbox then
+            import chunk_pack
+            return chunk_pack.extract_chunk(file_index, run_number, \
+                                            os.getcwd(), self.pack_mirror)
+
         index = os.path.basename(file_index)
         index = os.path.join(os.getcwd(), index)
         if os.path.exists(index):
@@ -405,6 +651,11 @@ class RunSettings: #pylint: disable = R0902
         # file names on the grid are arbitrary so make
         # it something logical for the local copy
         file_name = "jsondoc_"+str(run_number)+".txt"
+        # keep the compression suffix of gzip/zstd chunks; they are
+        # decompressed on the fly by simulate_beam.py
+        for suffix in ['.gz', '.zst']:
+            if target_entry.endswith(suffix):
+                file_name += suffix
         if target_entry.find("http") >= 0:
             # use a wget algorithm instead
             args = ['wget']
@@ -440,6 +691,36 @@ class RunSettings: #pylint: disable = R0902
         # os.remove(index)
         return file_name
             
+    def write_g4bl_datacards(self):
+        """
+        Write the G4BL datacards of this job for simulate_fused.py
+
+        The datacards are "key = JSON value" lines. The g4bl seed (and the run
+        number the beamline simulation gives its spills, which
+        simulate_mice_G4BL_v2.py sets to the seed) is replaced by a hash of
+        the datacards seed and the run number, and the geometry is the one
+        downloaded for the job.
+        """
+        cards = []
+        with open(self.g4bl_datacards) as datacards:
+            for line in datacards:
+                if '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                cards.append([key.strip(), json.loads(value)])
+        for card in cards:
+            if card[0] == 'g4bl':
+                key = str(card[1].get('random_seed'))+':'+str(self.run_number)
+                seed = (zlib.crc32(key) & 0x7fffffff) % 2147483646 + 1
+                card[1]['random_seed'] = seed
+                card[1]['run_number'] = seed
+            if card[0] == 'simulation_geometry_filename':
+                card[1] = os.path.join(self.download_target, \
+                                       'ParentGeometryFile.dat')
+        with open(self.job_g4bl_datacards, 'w') as datacards:
+            for key, value in cards:
+                datacards.write(key+' = '+json.dumps(value)+'\n')
+
     def get_simulation_parameters(self):
         """
         Get the parameters for the simulation executable
@@ -448,15 +729,17 @@ class RunSettings: #pylint: disable = R0902
 
         @return list of command line arguments for simulation
         """
-        return [
+        parameters = [
             '-simulation_geometry_filename', \
                    os.path.join(self.download_target, 'ParentGeometryFile.dat'),
-            '-input_json_file_name', self.g4bl_interface,
             '-output_root_file_name', self.mc_file_name,
             '-verbose_level', '0',
             '-will_do_stack_trace', 'False',
             '-configuration_file', 'sim.cards',
         ]
+        if self.g4bl_interface is not None:
+            parameters += ['-input_json_file_name', self.g4bl_interface]
+        return parameters
 
     ## This will need to be updated to reflect the source of the MC
     ## data cards.
@@ -565,6 +848,196 @@ class FileManager: # pylint: disable = R0902
         """
         self.close_log()
 
+class ResultCatalogue:
+    """
+    Result catalogue holds finished output tarballs keyed by input fingerprint
+
+    The catalogue is a sqlite file; the tarballs are kept in a results/
+    directory next to it. A catalogued tarball is only handed out again if it
+    still matches the md5 recorded with it.
+    """
+
+    def __init__(self, db_name):
+        """
+        Open the catalogue, creating it if needed
+
+        @param db_name sqlite file name of the catalogue
+        """
+        self.db_name = db_name
+        self.store_dir = os.path.join(os.path.dirname( \
+                                       os.path.abspath(db_name)), 'results')
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("CREATE TABLE IF NOT EXISTS results(\
+                fingerprint STRING PRIMARY KEY,\
+                run STRING,\
+                tar_name STRING,\
+                md5 STRING,\
+                created DATE)\
+                ")
+        conn.commit()
+        conn.close()
+
+    def fetch(self, fingerprint, target):
+        """
+        Copy the output catalogued for fingerprint to target
+
+        @returns True on a hit; False if there is no valid catalogued output
+        """
+        conn = sqlite3.connect(self.db_name)
+        row = conn.execute("SELECT md5 FROM results WHERE fingerprint = ?", \
+                           (fingerprint,)).fetchone()
+        conn.close()
+        stored = os.path.join(self.store_dir, fingerprint+'.tar')
+        if row is None or not os.path.isfile(stored):
+            return False
+        if file_md5(stored) != row[0]:
+            print 'Catalogued output', stored, 'is corrupt - ignoring it'
+            return False
+        shutil.copy(stored, target)
+        return True
+
+    def record(self, fingerprint, run, tar_name):
+        """
+        Add an output tarball to the catalogue
+        """
+        if not os.path.isfile(tar_name):
+            return
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        stored = os.path.join(self.store_dir, fingerprint+'.tar')
+        shutil.copy(tar_name, stored)
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("INSERT OR REPLACE INTO results(fingerprint, run, \
+                     tar_name, md5, created) VALUES (?,?,?,?,datetime('now'))", \
+                     (fingerprint, str(run), tar_name, file_md5(stored)))
+        conn.commit()
+        conn.close()
+
+class UtilityRun:
+    """
+    UtilityRun runs a MAUS python utility script as its command line would,
+    in a fork of this process or, as fallback, in a new interpreter. The
+    output is collected until the run is waited for. Before the first fork the
+    modules the utilities import are imported here, so every fork starts with
+    them loaded.
+
+    A copy of this class is in execute_data_recon.py: the drivers run as single
+    scripts (execute_data_recon.py also from the MAUS installation) with no
+    module of their own to share it through, so the copies are kept identical.
+    """
+    # imported before the first fork; missing ones are left to the utility
+    utility_modules = ['maus_cpp.globals', 'Configuration', \
+                       'geometry.ConfigReader', 'geometry.GDMLtoCDB', \
+                       'geometry.GDMLPacker', 'geometry.GDMLFormatter', \
+                       'geometry.GDMLtoMAUSModule']
+    preloaded = False
+
+    def __init__(self, script, arguments, in_process=True):
+        """
+        Start the utility
+
+        @param script path of the utility script
+        @param arguments list of command line arguments
+        @param in_process run the script's code in a fork of this process
+        """
+        self.script = script
+        self.arguments = arguments
+        self.output = tempfile.TemporaryFile()
+        self.returncode = None
+        self.pid = None
+        self.proc = None
+        if in_process:
+            self.preload()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                self.pid = os.fork()
+            except OSError:
+                print 'Could not fork for', script, sys.exc_info()[1]
+                self.pid = None
+            if self.pid == 0:
+                code = 1
+                try:
+                    code = self.run_in_process()
+                finally:
+                    os._exit(code) # pylint: disable = W0212
+        if self.pid is None:
+            self.proc = subprocess.Popen(['python', script]+arguments, \
+                                         stdout=self.output, \
+                                         stderr=subprocess.STDOUT)
+
+    @classmethod
+    def preload(cls):
+        """
+        Import utility_modules, the first time only
+        """
+        if cls.preloaded:
+            return
+        cls.preloaded = True
+        for name in cls.utility_modules:
+            try:
+                __import__(name)
+            except Exception: # pylint: disable = W0703
+                pass
+
+    def run_in_process(self):
+        """
+        Run the script as __main__ in this (forked) process
+
+        @returns exit code of the script
+        """
+        os.dup2(self.output.fileno(), 1)
+        os.dup2(self.output.fileno(), 2)
+        sys.stdout = os.fdopen(1, 'w', 0)
+        sys.stderr = sys.stdout
+        sys.argv = [self.script]+self.arguments
+        sys.path.insert(0, os.path.dirname(os.path.abspath(self.script)))
+        try:
+            runpy.run_path(self.script, run_name='__main__')
+        except SystemExit as exit_:
+            if exit_.code is None:
+                return 0
+            if isinstance(exit_.code, int):
+                return exit_.code
+            print exit_.code
+            return 1
+        except: # pylint: disable = W0702
+            traceback.print_exc()
+            return 1
+        return 0
+
+    def wait(self, log=None):
+        """
+        Wait for the utility to finish; the first call copies its output to log
+
+        @returns exit code
+        """
+        if self.returncode is not None:
+            return self.returncode
+        if self.proc is not None:
+            self.returncode = self.proc.wait()
+        else:
+            status = os.waitpid(self.pid, 0)[1]
+            if os.WIFEXITED(status):
+                self.returncode = os.WEXITSTATUS(status)
+            else:
+                self.returncode = 128+os.WTERMSIG(status)
+        if log is not None:
+            self.output.seek(0)
+            shutil.copyfileobj(self.output, log)
+            log.flush()
+        return self.returncode
+
+    def error(self):
+        """
+        @returns ": " and the last line of output, for error messages, or ""
+        """
+        self.output.seek(0)
+        lines = [line.strip() for line in self.output if line.strip()]
+        if len(lines) == 0:
+            return ""
+        return ": "+lines[-1]
+
 def main(argv):
     """
     Calls run manager to run the execution
@@ -576,12 +1049,17 @@ def main(argv):
             checked by software expert
         3 - there was some problem with this script - needs to be checked by
             checked by software expert
+        4 - pre-flight validation failed - needs its metadata in the
+            configuration database
     """
     my_return_value = 3
     my_run = None
     args = arg_parser()
     args_in_ = args.parse_args(argv) # call the arg_parser before logging
                                      # starts so we get -h output okay
+    if (args_in_.input_file is None) == (args_in_.g4bl_datacards is None):
+        print 'Give one of --input-file and --g4bl-datacards'
+        return 3
     try:
         my_run = RunManager(args_in_)
         my_return_value = my_run.run()
@@ -589,6 +1067,11 @@ def main(argv):
     except DownloadError:
         print "Fail Download"
         my_return_value = 1
+    # metadata missing from the CDB - do not retry until it is there
+    except ValidationError:
+        print "Fail Validation"
+        my_return_value = 4
+        sys.excepthook(*sys.exc_info())
     # some failure in the reconstruction algorithms - needs investigation
     except MausError:
         print "Fail Maus"
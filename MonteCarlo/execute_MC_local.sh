@@ -0,0 +1,88 @@
+#!/bin/bash
+
+#=====================================
+# MC simulation job run by production/local_executor.py on a local machine
+# or batch cluster; the local counterpart of execute_against_MC.sh.
+# The MAUS environment is taken from the shell running the executor (source
+# env.sh of a MAUS install first), or set up from cvmfs if it is not there.
+# The output goes to the local storage element $LOCAL_SE (set by the
+# executor) in the layout used on grid storage:
+#     $LOCAL_SE/Simulation/MCproduction/<10k>/<century>/<MC serial>/
+#=====================================
+
+MCSERIAL=99
+
+G4BLINPUT="https://micewww.pp.rl.ac.uk/attachments/download/8755/3_140_M3v2.txt"
+
+MAUS_VERSION=MAUS-v3.0.1
+
+#=================================
+
+VO_MICE_SW_DIR=/cvmfs/mice.egi.eu
+MAUS_DIR=$VO_MICE_SW_DIR/sl6/$MAUS_VERSION
+
+if [ -z $MAUS_ROOT_DIR ] && [ -d $MAUS_DIR ]; then
+    cp $MAUS_DIR/configure .
+    ./configure -r $MAUS_DIR
+    source ./env.sh
+    export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:$MAUS_DIR/external
+fi
+
+if [ -z $MAUS_ROOT_DIR ] || [ -z $LOCAL_SE ]; then
+    echo "MAUS_ROOT_DIR and LOCAL_SE must be set"
+    exit 3
+fi
+
+chmod a+x execute_MC.py
+
+# metadata_index.sqlite is added to the input sandbox by submit_jobs.py
+# --metadata-index; the cards geometry is then checked before downloading
+INDEX_OPTION=""
+if [ -f metadata_index.sqlite ]; then
+    INDEX_OPTION="--metadata-index metadata_index.sqlite"
+fi
+
+# with G4BL datacards (written by G4BL/simulate_mice_G4BL_v2.py) in the input
+# sandbox the beamline is simulated in the job by simulate_fused.py instead of
+# reading the G4BL interface file
+BEAM_OPTION="--input-file ${G4BLINPUT}"
+if [ -f g4bl_datacards.json ]; then
+    BEAM_OPTION="--g4bl-datacards g4bl_datacards.json"
+fi
+
+\time -v ./execute_MC.py --no-test --mcserialnumber ${MCSERIAL} ${BEAM_OPTION} --run-number $1 ${INDEX_OPTION}
+status=$?
+
+# read by job_poller.py: 1 is transient and resubmitted, 2 and 3 need an expert,
+# 4 means missing metadata
+echo "execute_MC.py exit status = $status"
+
+if [ $status != 0 ]; then
+    exit $status
+fi
+
+PADDED_filenum=`printf "%05d" $1` # file is zero-padded to 5 digits
+PADDED_mcserial=`printf "%06d" $MCSERIAL`
+let "unpadded_century=$MCSERIAL/100*100"
+century=`printf "%06d" $unpadded_century`
+let "unpadded_10k=$unpadded_century/10000*10000"
+PADDED_10k=`printf "%06d" $unpadded_10k`
+
+OUT_DIR=$LOCAL_SE/Simulation/MCproduction/$PADDED_10k/$century/${PADDED_mcserial}
+echo "copy to" $OUT_DIR/${PADDED_filenum}_mc.tar
+
+stage_start=`date +%s`
+mkdir -p $OUT_DIR
+cp ${PADDED_filenum}_mc.tar $OUT_DIR/.${PADDED_filenum}_mc.tar.tmp && \
+    mv $OUT_DIR/.${PADDED_filenum}_mc.tar.tmp $OUT_DIR/${PADDED_filenum}_mc.tar
+copy_status=$?
+
+# read by site_stats.py
+echo "Stage-out bytes = `stat -c %s ${PADDED_filenum}_mc.tar` seconds = $((`date +%s`-stage_start))"
+
+if [ $copy_status != 0 ]; then
+    echo "Error copying ${PADDED_filenum}_mc.tar to $OUT_DIR"
+    exit 1
+fi
+
+echo "execute_MC_local.sh done..."
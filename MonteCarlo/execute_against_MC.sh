@@ -43,9 +43,33 @@ echo $LD_LIBRARY_PATH
 
 chmod a+x execute_MC.py
 
+# metadata_index.sqlite is added to the input sandbox by submit_jobs.py
+# --metadata-index; the cards geometry is then checked before downloading
+INDEX_OPTION=""
+if [ -f metadata_index.sqlite ]; then
+    INDEX_OPTION="--metadata-index metadata_index.sqlite"
+fi
+
+# with G4BL datacards (written by G4BL/simulate_mice_G4BL_v2.py) in the input
+# sandbox the beamline is simulated in the job by simulate_fused.py instead of
+# reading the G4BL interface file
+BEAM_OPTION="--input-file ${G4BLINPUT}"
+if [ -f g4bl_datacards.json ]; then
+    BEAM_OPTION="--g4bl-datacards g4bl_datacards.json"
+fi
+
 #time ./execute_MC.py --test --mcserialnumber ${MCSERIAL} --input-file ${G4BLINPUT} --run-number $1
 
-time ./execute_MC.py --no-test --mcserialnumber ${MCSERIAL} --input-file ${G4BLINPUT} --run-number $1
+\time -v ./execute_MC.py --no-test --mcserialnumber ${MCSERIAL} ${BEAM_OPTION} --run-number $1 ${INDEX_OPTION}
+status=$?
+
+# read by job_poller.py: 1 is transient and resubmitted, 2 and 3 need an expert,
+# 4 means missing metadata
+echo "execute_MC.py exit status = $status"
+
+if [ $status != 0 ]; then
+    exit $status
+fi
 
 echo "Done with simulation"
 
@@ -75,8 +99,12 @@ PADDED_10k=`printf "%06d" $unpadded_10k`  # 10k is zero-padded to 6 digits
 #echo "copy to" ${CLOSE_SE}/Simulation/MCproduction/$PADDED_10k/$century/${PADDED_mcserial}/${PADDED_filenum}_mc.tar
 echo "copy to" ${USE_THIS_SE}/Simulation/MCproduction/$PADDED_10k/$century/${PADDED_mcserial}/${PADDED_filenum}_mc.tar 
 
+stage_start=`date +%s`
 lcg-cr --checksum -l /grid/mice/Simulation/MCproduction/$PADDED_10k/$century/${PADDED_mcserial}/${PADDED_filenum}_mc.tar -d ${USE_THIS_SE}/Simulation/MCproduction/$PADDED_10k/$century/${PADDED_mcserial}/${PADDED_filenum}_mc.tar ${PADDED_filenum}_mc.tar
 
+# read by site_stats.py
+echo "Stage-out bytes = `stat -c %s ${PADDED_filenum}_mc.tar` seconds = $((`date +%s`-stage_start))"
+
 
 #lcg-cr --checksum -l /grid/mice/users/dmaletic/MCproduction/${PROD_DIR}/${PADDED_filenum}_mc.tar -d ${CLOSE_SE}/dmaletic/MCproduction/${PROD_DIR}/${PADDED_filenum}_mc.tar ${PADDED_filenum}_mc.tar
 
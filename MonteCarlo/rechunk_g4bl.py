@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""
+Re-chunk G4BL JSON inputs to a target wall time
+"""
+
+DESCRIPTION = """
+Split or merge the G4BL JSON chunks of a chunk list so that every MC job takes
+roughly the same wall time.
+
+The chunk list is the same file passed to execute_MC.py with --input-file: one
+chunk per line, either an http(s) URL, a grid LFN or a local path. Each chunk
+is a line-delimited JSON file with one spill per line, optionally gzip (.gz) or
+zstd (.zst) compressed.
+
+The time per spill is taken from --seconds-per-spill or measured from
+--timing-file, a file of "<chunk_index> <wall_seconds>" lines harvested from
+earlier MC jobs (e.g. the bash 'time' output in std.out). The spills of the
+input chunks are then streamed, in order, into new chunks holding just enough
+spills to fill the --target-minutes budget. The new chunks are written to
+--output-dir as jsondoc_#####.txt together with a new chunk list, so the list
+can be published and passed to create_jdl_and_submit.sh as before. Use
+--compression to write the new chunks compressed; execute_MC.py and
+simulate_beam.py decompress them on the fly.
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+from time import sleep
+
+import chunk_io
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input-file', dest='input_file', \
+                        help='Chunk list to re-chunk (URL or local file)', \
+                        required=True)
+    parser.add_argument('--output-dir', dest='output_dir', \
+                        help='Directory for the new chunks and chunk list', \
+                        default='rechunked')
+    parser.add_argument('--output-list', dest='output_list', \
+                        help='Name of the new chunk list', \
+                        default='chunk_list.txt')
+    parser.add_argument('--url-prefix', dest='url_prefix', \
+                        help='Prefix written before each chunk name in the '+\
+                             'new chunk list (where the chunks get published)',
+                        default='')
+    parser.add_argument('--target-minutes', dest='target_minutes', \
+                        type=float, default=360., \
+                        help='Wall time budget per MC job in minutes. Keep '+\
+                             'it well below the JDL Requirements limit (479)')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--seconds-per-spill', dest='seconds_per_spill', \
+                        type=float, default=None, \
+                        help='Measured simulation time per spill')
+    group.add_argument('--timing-file', dest='timing_file', default=None, \
+                        help='File of "<chunk_index> <wall_seconds>" lines '+\
+                             'used to measure the time per spill')
+    parser.add_argument('--overhead-seconds', dest='overhead_seconds', \
+                        type=float, default=600., \
+                        help='Fixed per-job cost (setup, downloads, upload)')
+    parser.add_argument('--measure-only', dest='measure_only', \
+                        action='store_true', default=False, \
+                        help='Only print spills per chunk and expected times')
+    parser.add_argument('--compression', dest='compression', \
+                        choices=sorted(chunk_io.COMPRESSION_SUFFIXES.keys()), \
+                        default='none', \
+                        help='Compression of the new chunks')
+    return parser
+
+def fetch(entry, local_name):
+    """
+    Copy a chunk list entry to a local file
+
+    @param entry http(s) URL, grid LFN or local path
+    @param local_name local file name to copy to
+
+    @returns local file name; for a local path, the path itself
+    """
+    if os.path.exists(entry):
+        return entry
+    if entry.find("http") >= 0:
+        args = ['wget', '-q', '-O', local_name, entry]
+    else:
+        args = ['lcg-cp', '--checksum', entry, 'file:'+os.path.abspath(local_name)]
+    for i in range(5):
+        if os.path.exists(local_name):
+            os.remove(local_name)
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, \
+                                stderr=subprocess.PIPE)
+        (stdout, stderr) = proc.communicate()
+        if proc.returncode == 0 and os.path.exists(local_name):
+            return local_name
+        print 'Download of', entry, 'failed on attempt', i+1, stderr
+        sleep(0.5)
+    raise IOError("Failed to download "+entry)
+
+def read_chunk_list(input_file):
+    """
+    Read the chunk list
+
+    @param input_file URL or local file name of the chunk list
+
+    @returns list of chunk entries as strings, in chunk order
+    """
+    index = fetch(input_file, os.path.basename(input_file))
+    with open(index) as list_file:
+        return [line.strip() for line in list_file if line.strip() != '']
+
+def is_spill(line):
+    """
+    @returns True if the JSON document on this line is a spill
+    """
+    try:
+        document = json.loads(line)
+    except ValueError:
+        return False
+    if not isinstance(document, dict):
+        return False
+    return document.get('maus_event_type', 'Spill') == 'Spill'
+
+def iterate_spills(entries, work_dir, keep=False, reuse=False):
+    """
+    Stream the spills of all chunks in chunk order
+
+    Each chunk is downloaded and read before the next one is fetched.
+
+    @param entries chunk list entries
+    @param work_dir scratch directory for downloads
+    @param keep keep the downloads for a later pass; otherwise each download
+           is removed once read, so only one input chunk is on local disk at
+           a time
+    @param reuse read the downloads kept by an earlier pass instead of
+           downloading again
+
+    @returns generator yielding (chunk_index, json_line) for each spill
+    """
+    for i, entry in enumerate(entries):
+        local_name = os.path.join(work_dir, 'input_'+str(i)+'.txt'+\
+                                  chunk_io.compression_suffix(entry))
+        if reuse and os.path.exists(local_name):
+            file_name = local_name
+        else:
+            file_name = fetch(entry, local_name)
+        with chunk_io.open_chunk(file_name) as chunk:
+            for line in chunk:
+                if is_spill(line):
+                    yield i, line
+        if file_name == local_name and not keep:
+            os.remove(local_name)
+
+def count_spills(entries, work_dir):
+    """
+    Count the spills in each chunk
+
+    The downloads are kept for write_chunks.
+
+    @returns list of number of spills, indexed like entries
+    """
+    counts = [0]*len(entries)
+    spills = iterate_spills(entries, work_dir, keep=True)
+    for i, line in spills: # pylint: disable = W0612
+        counts[i] += 1
+    return counts
+
+def measure_seconds_per_spill(timing_file, counts, overhead_seconds):
+    """
+    Measure the simulation time per spill from earlier MC jobs
+
+    @param timing_file file of "<chunk_index> <wall_seconds>" lines
+    @param counts number of spills per chunk
+    @param overhead_seconds fixed per-job cost included in each wall time
+
+    @returns total wall seconds less the per-job overhead divided by total
+             spills of the timed chunks
+    """
+    seconds = 0.
+    spills = 0
+    with open(timing_file) as timing:
+        for line in timing:
+            words = line.split()
+            if len(words) < 2 or words[0].startswith('#'):
+                continue
+            index = int(words[0])
+            if index >= len(counts) or counts[index] == 0:
+                continue
+            seconds += max(0., float(words[1])-overhead_seconds)
+            spills += counts[index]
+    if spills == 0:
+        raise ValueError("No timed chunk with spills in "+timing_file)
+    return seconds/spills
+
+def spills_per_chunk(seconds_per_spill, target_minutes, overhead_seconds):
+    """
+    @returns number of spills that fill the wall time budget (at least 1)
+    """
+    budget = target_minutes*60.-overhead_seconds
+    return max(1, int(budget/seconds_per_spill))
+
+def write_chunks(entries, work_dir, output_dir, n_per_chunk, suffix):
+    """
+    Stream all spills into new chunks of n_per_chunk spills
+
+    @param suffix compression suffix of the new chunks ('', '.gz' or '.zst')
+
+    @returns list of new chunk file names
+    """
+    names = []
+    out = None
+    n_in_chunk = n_per_chunk
+    spills = iterate_spills(entries, work_dir, reuse=True)
+    for i, line in spills: # pylint: disable = W0612
+        if n_in_chunk == n_per_chunk:
+            if out is not None:
+                out.close()
+            names.append('jsondoc_'+str(len(names)).rjust(5, '0')+'.txt'+\
+                         suffix)
+            out = chunk_io.open_chunk(os.path.join(output_dir, names[-1]), 'w')
+            n_in_chunk = 0
+        out.write(line)
+        n_in_chunk += 1
+    if out is not None:
+        out.close()
+    return names
+
+def main(argv):
+    """
+    Measure the input chunks and write the new chunk list
+    """
+    args = arg_parser().parse_args(argv)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    entries = read_chunk_list(args.input_file)
+    counts = count_spills(entries, args.output_dir)
+    print 'Read', len(entries), 'chunks with', sum(counts), 'spills'
+
+    seconds_per_spill = args.seconds_per_spill
+    if seconds_per_spill is None:
+        seconds_per_spill = measure_seconds_per_spill(args.timing_file, \
+                                                      counts, \
+                                                      args.overhead_seconds)
+    print 'Seconds per spill', seconds_per_spill
+    for i, count in enumerate(counts):
+        expected = (count*seconds_per_spill+args.overhead_seconds)/60.
+        print '    chunk', i, 'spills', count, 'expected minutes', \
+              round(expected, 1)
+    if args.measure_only:
+        for i in range(len(entries)):
+            for local_name in glob.glob(os.path.join(args.output_dir, \
+                                                     'input_'+str(i)+'.txt*')):
+                os.remove(local_name)
+        return 0
+
+    n_per_chunk = spills_per_chunk(seconds_per_spill, args.target_minutes, \
+                                   args.overhead_seconds)
+    print 'Writing chunks of', n_per_chunk, 'spills'
+    suffix = chunk_io.COMPRESSION_SUFFIXES[args.compression]
+    names = write_chunks(entries, args.output_dir, args.output_dir, \
+                         n_per_chunk, suffix)
+    with open(os.path.join(args.output_dir, args.output_list), 'w') as out:
+        for name in names:
+            out.write(args.url_prefix+name+'\n')
+    print 'Wrote', len(names), 'chunks and', args.output_list, 'to', \
+          args.output_dir
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -5,19 +5,37 @@ Simulate the MICE experiment
 
 This will simulate MICE spills through the entirety of MICE using Geant4, then
 digitize and reconstruct TOF and tracker hits to space points.
+
+By default a single G4BL JSON chunk is simulated through MAUS.Go. If the
+--chunk_list <file> option is given, the file is read as a list of
+"<input_json_file> <output_root_file>" lines (one chunk per line). The Geant4
+geometry and physics are then initialised once and every chunk is pushed
+through the same mappers, so initialisation is paid once per geometry rather
+than once per chunk. Each chunk's ROOT file gets the job header and footer and
+the run headers and footers (from the run actions) that MAUS.Go writes. All
+other command line arguments are passed to MAUS as usual.
+
+Input chunks named *.gz or *.zst are decompressed on the fly while the spills
+are read (see chunk_io.py).
 """
 
 import io   #  generic python library for I/O
+import sys
+import json
 
 import MAUS # MAUS libraries
+import maus_cpp.globals
+import maus_cpp.run_action_manager
+from Configuration import Configuration
 
-def run():
-    """ Run the macro
-    """
+import chunk_io
 
-    # Use the G4BL JSON chunks as an input to the simulation
-    my_input = MAUS.InputPyJSON()
+def get_mappers():
+    """
+    Build the group of mappers run on each spill
 
+    @returns MAUS.MapPyGroup holding the simulation and reconstruction mappers
+    """
     # Create an empty array of mappers, then populate it
     # with the functionality you want to use.
     my_map = MAUS.MapPyGroup()
@@ -61,6 +79,176 @@ def run():
 
     # Global Digits - post detector digitisation
 
+    return my_map
+
+def pop_chunk_list(argv):
+    """
+    Remove the --chunk_list option from the command line arguments
+
+    MAUS parses the remaining command line itself and does not know about
+    --chunk_list, so it has to be taken out before the configuration is built.
+
+    @param argv list of command line arguments; modified in place
+
+    @returns the chunk list file name, or None if the option was not given
+    """
+    for i, arg in enumerate(argv):
+        if arg == '--chunk_list' and i+1 < len(argv):
+            chunk_list = argv[i+1]
+            del argv[i:i+2]
+            return chunk_list
+        if arg.startswith('--chunk_list='):
+            del argv[i]
+            return arg.split('=', 1)[1]
+    return None
+
+def read_chunk_list(chunk_list):
+    """
+    Read the chunk list file
+
+    @param chunk_list name of a file with one "<input> <output>" pair per line;
+           blank lines and lines starting with # are ignored
+
+    @returns list of (input_json_file_name, output_root_file_name) tuples
+    """
+    chunks = []
+    with open(chunk_list) as list_file:
+        for line in list_file:
+            words = line.split()
+            if len(words) == 0 or words[0].startswith('#'):
+                continue
+            if len(words) != 2:
+                raise ValueError("Malformed chunk list entry: "+line.rstrip())
+            chunks.append((words[0], words[1]))
+    return chunks
+
+def get_argument(argv, key):
+    """
+    @returns the value following key in argv, or None if key is not there
+    """
+    if key in argv and argv.index(key)+1 < len(argv):
+        return argv[argv.index(key)+1]
+    return None
+
+def get_spill_run_number(spill):
+    """
+    @param spill JSON document read from the input
+    @returns run number of a spill, or None for other events
+    """
+    try:
+        event = json.loads(spill)
+    except (TypeError, ValueError):
+        return None
+    if event.get('maus_event_type', 'Spill') != 'Spill':
+        return None
+    return event.get('run_number')
+
+def save_spills(my_map, my_output, config_doc, spills):
+    """
+    Process spills and save them with the headers MAUS.Go writes
+
+    As in MAUS.Go the output starts with a job header and ends with a job
+    footer; the start and end of run actions are called, and their run
+    header and footer saved, whenever the run number of the spills changes.
+
+    @param my_map mappers; birth must already have been called
+    @param my_output output; birth must already have been called
+    @param config_doc configuration the job header is made from
+    @param spills iterable of JSON spill documents
+
+    @returns number of spills processed
+    """
+    n_spills = 0
+    run_number = None
+    my_output.save(json.dumps(MAUS.Go.get_job_header(config_doc)))
+    for spill in spills:
+        spill_run_number = get_spill_run_number(spill)
+        if spill_run_number is not None and spill_run_number != run_number:
+            if run_number is not None:
+                my_output.save(maus_cpp.run_action_manager.end_of_run( \
+                                                               run_number))
+            run_number = spill_run_number
+            my_output.save(maus_cpp.run_action_manager.start_of_run( \
+                                                               run_number))
+        my_output.save(my_map.process(spill))
+        n_spills += 1
+    if run_number is not None:
+        my_output.save(maus_cpp.run_action_manager.end_of_run(run_number))
+    my_output.save(json.dumps(MAUS.Go.get_job_footer()))
+    return n_spills
+
+def simulate_chunk(my_map, config, input_name, output_name):
+    """
+    Push one G4BL JSON chunk through already initialised mappers, saving it
+    with the job and run headers and footers (see save_spills)
+
+    @param my_map mappers; birth must already have been called
+    @param config configuration dictionary shared by all chunks
+    @param input_name name of the G4BL JSON chunk to read
+    @param output_name name of the ROOT file to write
+
+    @returns number of spills processed
+    """
+    chunk_config = dict(config)
+    chunk_config['input_json_file_name'] = input_name
+    chunk_config['output_root_file_name'] = output_name
+    chunk_config_doc = json.dumps(chunk_config)
+
+    chunk_file = chunk_io.open_chunk(input_name)
+    my_input = MAUS.InputPyJSON(chunk_file)
+    my_output = MAUS.OutputCppRoot()
+    my_input.birth(chunk_config_doc)
+    my_output.birth(chunk_config_doc)
+    try:
+        n_spills = save_spills(my_map, my_output, chunk_config_doc, \
+                               my_input.emitter())
+    finally:
+        my_input.death()
+        my_output.death()
+        chunk_file.close()
+    return n_spills
+
+def run_chunks(chunks):
+    """
+    Simulate several G4BL JSON chunks in one process
+
+    Geant4 geometry and physics are built once when the mappers are birthed;
+    the input and output are then swapped for each chunk in turn.
+
+    @param chunks list of (input_json_file_name, output_root_file_name)
+    """
+    # can specify datacards here or by using appropriate command line calls
+    datacards = io.StringIO(u"")
+    config_doc = Configuration().getConfigJSON(datacards, True)
+    config = json.loads(config_doc)
+
+    if not maus_cpp.globals.has_instance():
+        maus_cpp.globals.birth(config_doc)
+    my_map = get_mappers()
+    my_map.birth(config_doc)
+    try:
+        for input_name, output_name in chunks:
+            print 'Simulating', input_name, '->', output_name
+            n_spills = simulate_chunk(my_map, config, input_name, output_name)
+            print '    processed', n_spills, 'spills'
+    finally:
+        my_map.death()
+        maus_cpp.globals.death()
+
+def run():
+    """ Run the macro
+    """
+
+    # Use the G4BL JSON chunks as an input to the simulation; compressed
+    # chunks are handed to the input as an already decompressing file
+    input_name = get_argument(sys.argv, '-input_json_file_name')
+    if input_name is not None and chunk_io.is_compressed(input_name):
+        my_input = MAUS.InputPyJSON(chunk_io.open_chunk(input_name))
+    else:
+        my_input = MAUS.InputPyJSON()
+
+    my_map = get_mappers()
+
     # Then construct a MAUS output component - filename comes from datacards
     my_output = MAUS.OutputCppRoot()
 
@@ -72,4 +260,8 @@ def run():
     MAUS.Go(my_input, my_map, MAUS.ReducePyDoNothing(), my_output, datacards)
 
 if __name__ == '__main__':
-    run()
+    CHUNK_LIST = pop_chunk_list(sys.argv)
+    if CHUNK_LIST is None:
+        run()
+    else:
+        run_chunks(read_chunk_list(CHUNK_LIST))
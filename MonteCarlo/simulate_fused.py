@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Simulate the MICE beamline and experiment in one fused job
+
+The G4BL beamline simulation (as run by G4BL/run_g4bl.py) runs in a producer
+process and hands each spill through a bounded queue to the MAUS simulation
+and reconstruction of simulate_beam.py running in this process. Spills flow
+straight from the beamline into MapCppSimulation: no G4BL JSON chunk is
+written to disk or copied through grid storage. The bounded queue keeps the
+producer at most --queue_size spills ahead of the consumer, so memory use
+stays flat whichever side is slower.
+
+Usage:
+    simulate_fused.py --g4bl_datacards <datacard.json> [--queue_size N] \\
+                      <simulate_beam.py MAUS arguments>
+
+The G4BL datacards are those written by G4BL/simulate_mice_G4BL_v2.py (g4bl
+settings, seed and spill_generator_number_of_spills). All other arguments
+configure the detector simulation exactly as for simulate_beam.py.
+"""
+
+import io
+import sys
+import multiprocessing
+import Queue
+
+import MAUS
+import maus_cpp.globals
+import maus_cpp.converter
+from Configuration import Configuration
+
+from simulate_beam import get_mappers, save_spills
+
+END_OF_SPILLS = 'END_OF_SPILLS'
+PRODUCER_FAILED = 'PRODUCER_FAILED'
+
+# seconds between checks that the producer is still alive
+POLL_SECONDS = 10
+
+def pop_option(argv, name, default=None):
+    """
+    Remove "name value" from the command line arguments
+
+    @param argv list of command line arguments; modified in place
+
+    @returns value, or default if the option was not given
+    """
+    if name in argv and argv.index(name)+1 < len(argv):
+        i = argv.index(name)
+        value = argv[i+1]
+        del argv[i:i+2]
+        return value
+    return default
+
+def produce(g4bl_datacards, spill_queue):
+    """
+    Run the G4BL beamline simulation and put each spill on the queue
+
+    Runs in its own process with its own MAUS configuration. Puts
+    END_OF_SPILLS when done, or PRODUCER_FAILED if anything went wrong so the
+    consumer does not wait forever.
+    """
+    try:
+        with open(g4bl_datacards) as datacards:
+            config_doc = Configuration().getConfigJSON(datacards, False)
+        maus_cpp.globals.birth(config_doc)
+        my_input = MAUS.InputPySpillGenerator()
+        my_map = MAUS.MapPyBeamlineSimulation()
+        my_input.birth(config_doc)
+        my_map.birth(config_doc)
+        for spill in my_input.emitter():
+            spill_queue.put(maus_cpp.converter.string_repr(
+                                                      my_map.process(spill)))
+        my_input.death()
+        my_map.death()
+        maus_cpp.globals.death()
+        spill_queue.put(END_OF_SPILLS)
+    except: # pylint: disable = W0702
+        sys.excepthook(*sys.exc_info())
+        spill_queue.put(PRODUCER_FAILED)
+
+def next_spill(spill_queue, producer):
+    """
+    Wait for the next spill, checking every POLL_SECONDS that the producer is
+    alive
+
+    @returns the spill, END_OF_SPILLS or PRODUCER_FAILED
+    @raises RuntimeError if the producer died (segfault, OOM kill, os._exit)
+            without queueing END_OF_SPILLS or PRODUCER_FAILED
+    """
+    while True:
+        try:
+            return spill_queue.get(True, POLL_SECONDS)
+        except Queue.Empty:
+            if producer is None or producer.is_alive():
+                continue
+        # whatever the producer queued before exiting may still be in transit
+        try:
+            return spill_queue.get(True, 1)
+        except Queue.Empty:
+            raise RuntimeError("G4BL producer died with exit code "+\
+                               str(producer.exitcode)+" before the last spill")
+
+def queued_spills(spill_queue, producer):
+    """
+    Yield the spills taken off the queue until END_OF_SPILLS
+
+    @raises RuntimeError if the producer failed
+    """
+    while True:
+        spill = next_spill(spill_queue, producer)
+        if spill == END_OF_SPILLS:
+            return
+        if spill == PRODUCER_FAILED:
+            raise RuntimeError("G4BL beamline simulation failed")
+        yield spill
+
+def consume(spill_queue, producer=None):
+    """
+    Simulate the detectors for each spill taken off the queue
+
+    The output gets the job and run headers and footers of MAUS.Go, as
+    simulate_beam.py writes them for each chunk.
+
+    @param producer process filling the queue, checked while waiting
+
+    @returns number of spills processed
+    @raises RuntimeError if the producer failed
+    """
+    datacards = io.StringIO(u"")
+    config_doc = Configuration().getConfigJSON(datacards, True)
+    maus_cpp.globals.birth(config_doc)
+    my_map = get_mappers()
+    my_output = MAUS.OutputCppRoot()
+    my_map.birth(config_doc)
+    my_output.birth(config_doc)
+    try:
+        n_spills = save_spills(my_map, my_output, config_doc, \
+                               queued_spills(spill_queue, producer))
+    finally:
+        my_map.death()
+        my_output.death()
+        maus_cpp.globals.death()
+    return n_spills
+
+def run(argv):
+    """
+    Start the producer and run the consumer until the spills run out
+
+    @param argv command line arguments; the fused options are removed and the
+           remainder is left for the MAUS configuration
+    """
+    g4bl_datacards = pop_option(argv, '--g4bl_datacards')
+    queue_size = int(pop_option(argv, '--queue_size', '8'))
+    if g4bl_datacards is None:
+        print __doc__
+        sys.exit(1)
+    spill_queue = multiprocessing.Queue(queue_size)
+    producer = multiprocessing.Process(target=produce, \
+                                       args=(g4bl_datacards, spill_queue))
+    producer.start()
+    try:
+        n_spills = consume(spill_queue, producer)
+    except:
+        # the producer may be blocked on a full queue
+        producer.terminate()
+        raise
+    producer.join()
+    print 'Simulated', n_spills, 'spills'
+    if producer.exitcode != 0:
+        raise RuntimeError("G4BL producer returned "+str(producer.exitcode))
+
+if __name__ == '__main__':
+    run(sys.argv)
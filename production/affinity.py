@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+"""
+Group runs that share geometry and calibration downloads
+"""
+
+DESCRIPTION = """
+Group the runs of a run list so that runs needing the same downloads are
+reconstructed in the same job.
+
+The geometry a run is reconstructed with is downloaded by run number: the
+geometry valid at the start of the run, with the beamline and cooling channel
+settings of the run. Runs share these downloads when they have the same
+    (geometry ID, beamline optics, cooling channel, mode, absorber)
+The settings come from runinfo.sqlite; the geometry ID is looked up in the
+CDB for the start time of the run and cached in --geometry-ids, so each run is
+only looked up once. Runs whose geometry cannot be looked up are not grouped.
+
+Groups hold at most --group-size runs and (if given) --group-triggers
+triggers. Each group is printed as a comma separated list, the form
+execute_data-v2.sh/-v3.sh accept with -r; the job then downloads the geometry
+once and reuses it for the other runs of the group.
+
+Usage:
+    affinity.py [--runinfo runinfo.sqlite] --group-size N <runs or run lists>
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import time
+
+DEFAULT_RUNINFO = "../runinfo/runinfo.sqlite"
+
+DEFAULT_GEOMETRY_IDS = "../../MICEprodDB/geometry_ids.json"
+
+CDBURL = "http://cdb.mice.rl.ac.uk"
+
+# runinfo columns that set the downloaded geometry besides the geometry ID
+SETTING_KEYS = ['optics', 'channel', 'mode', 'absorber']
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('items', nargs='+', help='Runs or run list files')
+    parser.add_argument('--runinfo', dest='runinfo', default=DEFAULT_RUNINFO, \
+                        help='runinfo.sqlite')
+    add_affinity_options(parser)
+    return parser
+
+def add_affinity_options(parser):
+    """
+    Options shared with submit_jobs.py
+    """
+    parser.add_argument('--group-size', dest='group_size', type=int, \
+                        default=1, help='Most runs per job (1: no grouping)')
+    parser.add_argument('--group-triggers', dest='group_triggers', \
+                        type=int, default=None, help='Most triggers per job')
+    parser.add_argument('--geometry-ids', dest='geometry_ids', \
+                        default=DEFAULT_GEOMETRY_IDS, \
+                        help='Cache of geometry IDs looked up per run')
+    parser.add_argument('--cdb', dest='cdb_url', default=CDBURL, \
+                        help='Configuration database URL')
+
+def read_run_info(runinfo_db, runs):
+    """
+    @returns dict of run to dict of runinfo columns
+    """
+    info = {}
+    connection = sqlite3.connect(runinfo_db)
+    columns = ['start', 'triggers']+SETTING_KEYS
+    for start in range(0, len(runs), 500):
+        bulk = [int(run) for run in runs[start:start+500]]
+        query = "SELECT run, "+', '.join(columns)+" FROM runinfo WHERE \
+                 run IN ("+','.join(['?']*len(bulk))+")"
+        for row in connection.execute(query, bulk).fetchall():
+            info[row[0]] = dict(zip(columns, row[1:]))
+    connection.close()
+    return info
+
+def parse_start_time(start_time):
+    """
+    @param start_time run start as "YYYY-MM-DD HH:MM:SS", with or without
+           fractions of a second (runinfo.sqlite mostly has them)
+    @returns the start as a datetime, to the second
+    @raises ValueError if start_time is not in that format
+    """
+    return datetime.datetime(*time.strptime(str(start_time)[:19], \
+                                            "%Y-%m-%d %H:%M:%S")[:6])
+
+def lookup_geometry_id(geometry, start_time):
+    """
+    Ask the CDB for the geometry valid at start_time
+
+    @raises ValueError if start_time cannot be parsed (see parse_start_time)
+    @returns geometry ID, or None if the CDB has none
+    """
+    start = parse_start_time(start_time)
+    ids = geometry.get_ids(start)
+    if len(ids) == 0:
+        return None
+    # the latest valid geometry, and of those the latest uploaded
+    return max(ids.items(), key=lambda item: (str(item[1].get('validFrom')), \
+                                              str(item[1].get('created'))))[0]
+
+def geometry_ids(info, cache_file, cdb_url):
+    """
+    Get the geometry ID of each run, from the cache or the CDB
+
+    Runs that could not be looked up (CDB unreachable, no geometry yet, a
+    start time that cannot be parsed) get None and are not cached, so they are
+    tried again next time. After the first CDB error no more runs are looked
+    up; a bad start time only skips its run.
+
+    @returns dict of run to geometry ID or None
+    """
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as cache_in:
+            cache = json.load(cache_in)
+    ids = {}
+    geometry = None
+    cdb_failed = False
+    for run in sorted(info.keys()):
+        if str(run) in cache:
+            ids[run] = cache[str(run)]
+            continue
+        ids[run] = None
+        if info[run]['start'] is None or cdb_failed:
+            continue
+        try:
+            parse_start_time(info[run]['start'])
+        except ValueError:
+            print 'Cannot parse the start time of run', run, \
+                  info[run]['start']
+            continue
+        try:
+            if geometry is None:
+                import cdb
+                geometry = cdb.Geometry(cdb_url)
+            ids[run] = lookup_geometry_id(geometry, info[run]['start'])
+        except Exception: # pylint: disable = W0703
+            print 'Geometry lookup failed for run', run, sys.exc_info()[1]
+            cdb_failed = True
+            continue
+        if ids[run] is not None:
+            cache[str(run)] = ids[run]
+    try:
+        with open(cache_file+'.tmp', 'w') as cache_out:
+            json.dump(cache, cache_out, indent=1, sort_keys=True)
+        os.rename(cache_file+'.tmp', cache_file)
+    except (IOError, OSError):
+        print 'Could not write geometry ID cache', cache_file
+    return ids
+
+def affinity_key(run_info, geometry_id):
+    """
+    @returns the key of runs sharing downloads, or None if it is not known
+    """
+    if run_info is None or geometry_id is None:
+        return None
+    return tuple([geometry_id]+[run_info[key] for key in SETTING_KEYS])
+
+def group_runs(runs, keys, triggers, group_size, group_triggers=None):
+    """
+    Group runs with the same key
+
+    @param keys dict of run to affinity key (None: run is not grouped)
+    @param triggers dict of run to number of triggers
+
+    @returns list of groups (lists of runs), in order of their first run
+    """
+    by_key = {}
+    groups = []
+    for run in sorted(runs):
+        key = keys.get(run)
+        if key is None or group_size <= 1:
+            groups.append([run])
+            continue
+        group = by_key.get(key)
+        n_triggers = triggers.get(run) or 0
+        if group is None or len(group[0]) >= group_size or \
+           (group_triggers is not None and \
+            group[1]+n_triggers > group_triggers):
+            group = [[], 0]
+            by_key[key] = group
+            groups.append(group[0])
+        group[0].append(run)
+        group[1] += n_triggers
+    return groups
+
+def group_arguments(runs, runinfo_db, args):
+    """
+    Group runs for submission
+
+    @returns list of job arguments; grouped runs are joined by commas
+    """
+    runs = [int(run) for run in runs]
+    if args.group_size <= 1:
+        return [str(run) for run in runs]
+    info = read_run_info(runinfo_db, runs)
+    ids = geometry_ids(info, args.geometry_ids, args.cdb_url)
+    keys = dict([(run, affinity_key(info.get(run), ids.get(run))) \
+                 for run in runs])
+    triggers = dict([(run, info[run]['triggers']) for run in info])
+    groups = group_runs(runs, keys, triggers, args.group_size, \
+                        args.group_triggers)
+    return [','.join([str(run) for run in group]) for group in groups]
+
+def main(argv):
+    """
+    Print the groups of a run list
+    """
+    args = arg_parser().parse_args(argv)
+    runs = []
+    for item in args.items:
+        if os.path.isfile(item):
+            with open(item) as run_list:
+                runs += [int(word) for word in run_list.read().split()]
+        else:
+            runs.append(int(item))
+    for argument in group_arguments(runs, args.runinfo, args):
+        print argument
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
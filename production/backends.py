@@ -0,0 +1,476 @@
+"""
+Job submission backends for the production tools
+
+A backend turns a JDL template and a list of job arguments into submitted jobs
+and returns their IDs, reports the status of jobs in bulk and fetches their
+std.out. The JDL template is the testMICE file used by the shell
+scripts: the string AAA marks where the job argument (chunk or run number)
+goes.
+
+  - DiracBackend submits through the DIRAC command line tools, using DIRAC
+    parametric jobs so one dirac-wms-job-submit call submits many jobs;
+  - LocalBackend is a stand-in that submits nothing, for testing the tools
+    without a grid proxy;
+  - ExecutorBackend queues jobs in a local spool directory, from which
+    local_executor.py runs them on this machine or a local batch system.
+"""
+
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import tempfile
+
+ARGUMENT_MARKER = 'AAA'
+
+class SubmissionError(Exception):
+    """
+    SubmissionError indicates that the backend refused or failed a submission
+    """
+    def __init__(self, error_message):
+        """Initialise the exception with some error message"""
+        super(SubmissionError, self).__init__(error_message)
+        self.error_message = error_message
+
+    def __str__(self):
+        """Return a string containing the the error message"""
+        return repr(self.error_message)
+
+def make_jdl(template, argument):
+    """
+    @returns the JDL of a single job, as create_jdl_and_submit.sh made it
+    """
+    return template.replace(ARGUMENT_MARKER, str(argument))
+
+def get_jdl_value(jdl, key):
+    """
+    Read an attribute of a JDL, ignoring commented lines
+
+    @returns the string value, a list of strings for a {...} list, or None
+    """
+    text = '\n'.join([line for line in jdl.split('\n') \
+                      if not line.strip().startswith('#')])
+    match = re.search(r'\b'+key+r'\s*=\s*("([^"]*)"|\{([^}]*)\})', text)
+    if match is None:
+        return None
+    if match.group(2) is not None:
+        return match.group(2)
+    return re.findall(r'"([^"]*)"', match.group(3))
+
+def make_parametric_jdl(template, arguments):
+    """
+    @returns a DIRAC parametric JDL submitting one job per argument
+    """
+    jdl = template.replace(ARGUMENT_MARKER, '%s')
+    parameters = '    Parameters = {'+\
+                 ','.join(['"'+str(arg)+'"' for arg in arguments])+'};\n'
+    closing = jdl.rindex(']')
+    return jdl[:closing]+parameters+jdl[closing:]
+
+def _jdl_list_re(key):
+    """
+    @returns regex matching an uncommented "key = {...};" JDL line
+    """
+    return re.compile(r'^(\s*)'+key+r'\s*=\s*\{(.*)\}\s*;', re.MULTILINE)
+
+def set_jdl_list(template, key, values):
+    """
+    Set a list attribute (BannedSites, Site, ...) of a JDL template, replacing
+    any value it had
+
+    @returns the new template
+    """
+    line = key+' = {'+','.join(['"'+value+'"' for value in values])+'};'
+    match = _jdl_list_re(key).search(template)
+    if match is not None:
+        return template[:match.start()]+match.group(1)+line+\
+               template[match.end():]
+    closing = template.rindex(']')
+    return template[:closing]+'    '+line+'\n'+template[closing:]
+
+def ban_sites(template, sites):
+    """
+    Add sites to the BannedSites list of a JDL template
+
+    @returns the template with the sites banned
+    """
+    if len(sites) == 0:
+        return template
+    banned = []
+    match = _jdl_list_re('BannedSites').search(template)
+    if match is not None:
+        banned = [site.strip().strip('"') for site in match.group(2).split(',')
+                  if site.strip() != '']
+    return set_jdl_list(template, 'BannedSites', \
+                        banned+[site for site in sites if site not in banned])
+
+class Backend:
+    """
+    Backend base class
+    """
+
+    name = 'base'
+
+    def submit(self, template, arguments):
+        """
+        Submit one job per argument
+
+        @param template JDL template text
+        @param arguments list of job arguments
+
+        @returns list of job IDs (strings), in the order of arguments
+        @raises SubmissionError on failure
+        """
+        raise NotImplementedError()
+
+    def status(self, job_ids):
+        """
+        Get the status of many jobs at once
+
+        @returns dict of job ID to (status, minor status, site); jobs the
+                 backend does not know are left out
+        """
+        raise NotImplementedError()
+
+    def get_output(self, job_ids, out_dir):
+        """
+        Fetch the output sandbox of finished jobs into out_dir/<job ID>/
+
+        @returns dict of job ID to the std.out file name, for jobs whose
+                 std.out was retrieved
+        """
+        raise NotImplementedError()
+
+    def kill(self, job_ids):
+        """
+        Kill jobs; jobs that already finished are ignored
+        """
+        raise NotImplementedError()
+
+class DiracBackend(Backend):
+    """
+    DIRAC backend submits parametric jobs with dirac-wms-job-submit
+    """
+
+    name = 'dirac'
+
+    def __init__(self, work_dir='.'):
+        """
+        @param work_dir directory holding the input sandbox files; the JDL is
+               written there while it is submitted
+        """
+        self.work_dir = work_dir
+
+    def submit(self, template, arguments):
+        """
+        Submit all arguments as one parametric job
+        """
+        if len(arguments) == 1:
+            jdl = make_jdl(template, arguments[0])
+        else:
+            jdl = make_parametric_jdl(template, arguments)
+        (handle, jdl_name) = tempfile.mkstemp(suffix='.jdl', dir=self.work_dir)
+        try:
+            os.write(handle, jdl)
+            os.close(handle)
+            proc = subprocess.Popen(['dirac-wms-job-submit', jdl_name], \
+                                    stdout=subprocess.PIPE, \
+                                    stderr=subprocess.STDOUT)
+            (stdout, stderr) = proc.communicate() # pylint: disable = W0612
+        finally:
+            os.remove(jdl_name)
+        job_ids = parse_job_ids(stdout)
+        if proc.returncode != 0 or len(job_ids) != len(arguments):
+            raise SubmissionError("dirac-wms-job-submit returned "+\
+                                  str(proc.returncode)+": "+stdout)
+        return job_ids
+
+    def status(self, job_ids):
+        """
+        Query dirac-wms-job-status for all jobs in one call
+        """
+        if len(job_ids) == 0:
+            return {}
+        proc = subprocess.Popen(['dirac-wms-job-status']+list(job_ids), \
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        (stdout, stderr) = proc.communicate() # pylint: disable = W0612
+        return parse_job_status(stdout)
+
+    def get_output(self, job_ids, out_dir):
+        """
+        Fetch output sandboxes with one dirac-wms-job-get-output call
+        """
+        if len(job_ids) == 0:
+            return {}
+        proc = subprocess.Popen(['dirac-wms-job-get-output', '-D', out_dir]+\
+                                list(job_ids), stdout=subprocess.PIPE, \
+                                stderr=subprocess.STDOUT)
+        proc.communicate()
+        outputs = {}
+        for job_id in job_ids:
+            std_out = os.path.join(out_dir, str(job_id), 'std.out')
+            if os.path.isfile(std_out):
+                outputs[job_id] = std_out
+        return outputs
+
+    def kill(self, job_ids):
+        """
+        Kill jobs with one dirac-wms-job-kill call
+        """
+        if len(job_ids) == 0:
+            return
+        proc = subprocess.Popen(['dirac-wms-job-kill']+list(job_ids), \
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        proc.communicate()
+
+def parse_job_status(output):
+    """
+    Parse dirac-wms-job-status output
+
+    One line per job like
+    JobID=4511856 Status=Done; MinorStatus=Execution Complete; Site=LCG.X.uk;
+
+    @returns dict of job ID to (status, minor status, site)
+    """
+    states = {}
+    for line in output.splitlines():
+        match = re.match(r'\s*JobID=(\d+)\s+(.*)', line)
+        if match is None:
+            continue
+        fields = {}
+        for item in match.group(2).split(';'):
+            if '=' in item:
+                key, value = item.split('=', 1)
+                fields[key.strip()] = value.strip()
+        states[match.group(1)] = (fields.get('Status', 'Unknown'), \
+                                  fields.get('MinorStatus', ''), \
+                                  fields.get('Site', ''))
+    return states
+
+def parse_job_ids(output):
+    """
+    Parse job IDs from dirac-wms-job-submit output
+
+    Output is "JobID = 4511856" for a single job and "JobID = [1, 2, 3]" for a
+    parametric job.
+
+    @returns list of job IDs as strings
+    """
+    match = re.search(r'JobID\s*=\s*\[?([\d,\s]+)\]?', output)
+    if match is None:
+        return []
+    return re.findall(r'\d+', match.group(1))
+
+class LocalBackend(Backend):
+    """
+    Local stand-in backend for testing
+
+    Hands out increasing job IDs and remembers the JDL of every job; nothing is
+    run. Jobs report the status set in self.states (default Done) and the
+    std.out text set in self.outputs.
+    """
+
+    name = 'local'
+
+    def __init__(self, first_id=1):
+        """
+        @param first_id job ID of the first job submitted
+        """
+        self.next_id = first_id
+        self.jobs = {}
+        self.states = {}
+        self.outputs = {}
+
+    def submit(self, template, arguments):
+        """
+        Record the jobs and return their IDs
+        """
+        job_ids = []
+        for argument in arguments:
+            job_id = str(self.next_id)
+            self.next_id += 1
+            self.jobs[job_id] = make_jdl(template, argument)
+            job_ids.append(job_id)
+        return job_ids
+
+    def status(self, job_ids):
+        """
+        Report the preset status of known jobs
+        """
+        return dict([(job_id, self.states.get(job_id, ('Done', '', 'Local'))) \
+                     for job_id in job_ids if job_id in self.jobs])
+
+    def get_output(self, job_ids, out_dir):
+        """
+        Write the preset std.out of known jobs
+        """
+        outputs = {}
+        for job_id in job_ids:
+            if job_id not in self.jobs:
+                continue
+            job_dir = os.path.join(out_dir, str(job_id))
+            if not os.path.isdir(job_dir):
+                os.makedirs(job_dir)
+            outputs[job_id] = os.path.join(job_dir, 'std.out')
+            with open(outputs[job_id], 'w') as std_out:
+                std_out.write(self.outputs.get(job_id, ''))
+        return outputs
+
+    def kill(self, job_ids):
+        """
+        Mark known jobs as killed
+        """
+        for job_id in job_ids:
+            if job_id in self.jobs:
+                self.states[job_id] = ('Killed', '', 'Local')
+
+DEFAULT_SPOOL = 'local_spool'
+
+# executor job states, named as the DIRAC states the poller understands
+EXECUTOR_STATES = ['Waiting', 'Matched', 'Running', 'Done', 'Failed', 'Killed']
+
+class ExecutorBackend(Backend):
+    """
+    Executor backend queues jobs for local_executor.py
+
+    Each job is a directory <spool>/<job ID>/ holding job.json (executable,
+    arguments and absolute input sandbox paths, taken from the JDL), a state
+    file with one of EXECUTOR_STATES and, once run, std.out, std.err, pid and
+    exit_code. Job IDs are "local-<n>" so they never clash with DIRAC IDs in
+    job_info2.
+    """
+
+    name = 'executor'
+
+    def __init__(self, spool_dir=DEFAULT_SPOOL, work_dir='.'):
+        """
+        @param spool_dir directory holding the queued jobs
+        @param work_dir directory the input sandbox paths are relative to
+        """
+        self.spool_dir = spool_dir
+        self.work_dir = work_dir
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+
+    def _new_job_dir(self):
+        """
+        @returns (job ID, job directory); the directory is created atomically
+        """
+        number = len(os.listdir(self.spool_dir))
+        while True:
+            job_id = 'local-'+str(number)
+            job_dir = os.path.join(self.spool_dir, job_id)
+            try:
+                os.mkdir(job_dir)
+                return job_id, job_dir
+            except OSError:
+                number += 1
+
+    def submit(self, template, arguments):
+        """
+        Queue one job per argument
+        """
+        job_ids = []
+        for argument in arguments:
+            jdl = make_jdl(template, argument)
+            executable = get_jdl_value(jdl, 'Executable')
+            if executable is None:
+                raise SubmissionError("JDL has no Executable")
+            sandbox = get_jdl_value(jdl, 'InputSandbox') or []
+            sandbox = [os.path.abspath(os.path.join(self.work_dir, name)) \
+                       for name in sandbox]
+            for name in sandbox:
+                if not os.path.exists(name):
+                    raise SubmissionError("Input sandbox file "+name+\
+                                          " not found")
+            job_id, job_dir = self._new_job_dir()
+            with open(os.path.join(job_dir, 'job.json'), 'w') as job_file:
+                json.dump({'executable':executable, \
+                           'arguments':get_jdl_value(jdl, 'Arguments') or '', \
+                           'sandbox':sandbox}, job_file, indent=1)
+            set_executor_state(job_dir, 'Waiting')
+            job_ids.append(job_id)
+        return job_ids
+
+    def status(self, job_ids):
+        """
+        Read the state files of the jobs
+        """
+        states = {}
+        site = 'Local.'+socket.gethostname()
+        for job_id in job_ids:
+            state = get_executor_state(os.path.join(self.spool_dir, job_id))
+            if state is not None:
+                states[job_id] = (state, '', site)
+        return states
+
+    def get_output(self, job_ids, out_dir):
+        """
+        Copy std.out and std.err of the jobs to out_dir/<job ID>/
+        """
+        outputs = {}
+        for job_id in job_ids:
+            job_dir = os.path.join(self.spool_dir, job_id)
+            if not os.path.isfile(os.path.join(job_dir, 'std.out')):
+                continue
+            target = os.path.join(out_dir, job_id)
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            for name in ['std.out', 'std.err']:
+                if os.path.isfile(os.path.join(job_dir, name)):
+                    with open(os.path.join(job_dir, name)) as fin:
+                        with open(os.path.join(target, name), 'w') as fout:
+                            fout.write(fin.read())
+            outputs[job_id] = os.path.join(target, 'std.out')
+        return outputs
+
+    def kill(self, job_ids):
+        """
+        Kill running jobs (their whole process group) and drop queued ones
+        """
+        for job_id in job_ids:
+            job_dir = os.path.join(self.spool_dir, job_id)
+            state = get_executor_state(job_dir)
+            if state in ['Done', 'Failed', 'Killed', None]:
+                continue
+            set_executor_state(job_dir, 'Killed')
+            pid_file = os.path.join(job_dir, 'pid')
+            if os.path.isfile(pid_file):
+                with open(pid_file) as pid_in:
+                    try:
+                        os.killpg(int(pid_in.read()), signal.SIGTERM)
+                    except (OSError, ValueError):
+                        pass
+
+def get_executor_state(job_dir):
+    """
+    @returns the state of an executor job, or None if there is no such job
+    """
+    try:
+        with open(os.path.join(job_dir, 'state')) as state_file:
+            return state_file.read().strip()
+    except IOError:
+        return None
+
+def set_executor_state(job_dir, state):
+    """
+    Set the state of an executor job atomically
+    """
+    with open(os.path.join(job_dir, 'state.tmp'), 'w') as state_file:
+        state_file.write(state+'\n')
+    os.rename(os.path.join(job_dir, 'state.tmp'), \
+              os.path.join(job_dir, 'state'))
+
+BACKENDS = {'dirac':DiracBackend, 'local':LocalBackend, \
+            'executor':ExecutorBackend}
+
+def get_backend(name, **kwargs):
+    """
+    @returns a backend instance by name
+    """
+    if name not in BACKENDS:
+        raise SubmissionError("Unknown backend "+name+"; choose from "+\
+                              ', '.join(sorted(BACKENDS.keys())))
+    return BACKENDS[name](**kwargs)
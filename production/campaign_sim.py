@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+
+"""
+Discrete-event simulation of a production campaign
+"""
+
+DESCRIPTION = """
+Replay a reconstruction (or MC) campaign against a model of the grid, to
+compare packing, retry and site-selection policies before trying them on the
+live grid.
+
+The campaign is the run list given as arguments (runs, ranges like 10000-10100
+or run list files), each run weighted by its triggers in runinfo.sqlite
+(--runinfo; without it every run is one unit of work, as for MC chunks).
+
+The sites are fitted from the site_jobs table of the production database
+(filled by site_stats.py harvest from past job logs and \\time -v output) over
+the last --window-days. For each site:
+  - seconds per unit of work, stage-in and stage-out seconds are log-normal
+    distributions fitted to the logged jobs;
+  - the failure rates: return code 1 (transient, mostly CDB downloads) and
+    other codes (parked for an expert).
+Without statistics --sites identical sites are made from the defaults below.
+Every site has --slots job slots; a job waits an exponential queue time of
+mean --queue-wait seconds before it can start.
+
+A job does its CDB downloads (geometry and calibration for each run; a group
+of runs downloads the geometry once), each taking --download-seconds and
+failing transiently with the fitted probability, then stages in, runs MAUS
+and stages out. Submission calls are paced by the token bucket of
+submit_jobs.py, failed jobs are seen by the poller every --poll-interval
+seconds and resubmitted with the exponential backoff of job_poller.py.
+
+Each --policy is a comma separated list of key=value overriding
+    group_size=1      runs per job (grouped by settings, see affinity.py)
+    bulk_size=100     jobs per submission call
+    rate=0.5          submission calls per second
+    burst=5           submission calls back to back
+    max_retries=5     retry budget per job
+    backoff=600       first resubmission delay [s]
+    max_backoff=21600 longest resubmission delay [s]
+    sites=all         all, ban (site_stats.py ban list) or best:N
+
+For each policy the makespan, the CPU efficiency (MAUS seconds of successful
+jobs over all occupied slot seconds), the wasted slot-hours (slots held by
+jobs that failed) and the number of jobs parked are printed. All policies see
+the same random numbers (--seed).
+
+Usage:
+    campaign_sim.py --runinfo runinfo.sqlite --policy group_size=1 \\
+                    --policy group_size=5,sites=ban <runs or run lists>
+"""
+
+import argparse
+import heapq
+import json
+import math
+import os
+import random
+import sys
+
+import affinity
+from job_poller import backoff_delay
+from proddb import ProdDB, DEFAULT_DB, now_string
+import site_stats
+from submit_jobs import parse_items
+
+POLICY_DEFAULTS = {'group_size':1, 'bulk_size':100, 'rate':0.5, 'burst':5, \
+                   'max_retries':5, 'backoff':600., 'max_backoff':6*3600., \
+                   'sites':'all'}
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('items', nargs='+', \
+                        help='Runs, ranges like 10000-10100 or run list files')
+    parser.add_argument('--policy', dest='policies', action='append', \
+                        default=None, help='Policy to simulate; repeatable')
+    parser.add_argument('--db', dest='db', default=DEFAULT_DB, \
+                        help='Production database holding site_jobs')
+    parser.add_argument('--geometry-ids', dest='geometry_ids', \
+                        default=affinity.DEFAULT_GEOMETRY_IDS, \
+                        help='Geometry ID cache used for grouping')
+    parser.add_argument('--sites', dest='sites', type=int, default=10, \
+                        help='Sites made up when there are no statistics')
+    parser.add_argument('--slots', dest='slots', type=int, default=100, \
+                        help='Job slots per site')
+    parser.add_argument('--queue-wait', dest='queue_wait', type=float, \
+                        default=600., help='Mean queue wait [s]')
+    parser.add_argument('--seconds-per-unit', dest='seconds_per_unit', \
+                        type=float, default=0.1, \
+                        help='Default MAUS seconds per unit of work '+\
+                             '(trigger, or MC chunk without --runinfo)')
+    parser.add_argument('--stage-seconds', dest='stage_seconds', type=float, \
+                        default=60., help='Default stage-in/out time [s]')
+    parser.add_argument('--download-seconds', dest='download_seconds', \
+                        type=float, default=60., help='Time per CDB download')
+    parser.add_argument('--transient-rate', dest='transient_rate', \
+                        type=float, default=0.05, \
+                        help='Default fraction of jobs returning 1')
+    parser.add_argument('--fatal-rate', dest='fatal_rate', type=float, \
+                        default=0.01, help='Default fraction of jobs parked')
+    parser.add_argument('--poll-interval', dest='poll_interval', type=float, \
+                        default=600., help='Job poller interval [s]')
+    parser.add_argument('--seed', dest='seed', type=int, default=1, \
+                        help='Random seed')
+    site_stats.add_site_options(parser)
+    return parser
+
+def parse_policy(text):
+    """
+    @returns policy dict from "key=value,key=value"
+    """
+    policy = dict(POLICY_DEFAULTS)
+    if text is None or text.strip() == '':
+        return policy
+    for item in text.split(','):
+        key, value = item.split('=', 1)
+        key = key.strip()
+        if key not in POLICY_DEFAULTS:
+            raise ValueError("Unknown policy key "+key)
+        policy[key] = type(POLICY_DEFAULTS[key])(value)
+    return policy
+
+def fit_lognormal(values, default):
+    """
+    Fit a log-normal distribution
+
+    @returns (mu, sigma); a narrow distribution around default if there are
+             fewer than two positive values
+    """
+    logs = [math.log(value) for value in values if value > 0]
+    if len(logs) < 2:
+        return (math.log(default), 0.1)
+    mean = sum(logs)/len(logs)
+    variance = sum([(log-mean)**2 for log in logs])/(len(logs)-1)
+    return (mean, math.sqrt(variance))
+
+def download_failure_rate(transient_rate, downloads=2):
+    """
+    @returns the failure probability of one CDB download, from the fraction
+             of single-run jobs (downloads downloads each) that returned 1
+    """
+    return 1.-(1.-min(transient_rate, 0.99))**(1./downloads)
+
+class SiteModel: # pylint: disable = R0903
+    """
+    SiteModel holds the fitted behaviour of one site
+    """
+
+    def __init__(self, name, slots, speed, stage_in, stage_out, \
+                 download_failure, fatal_rate):
+        """
+        @param speed, stage_in, stage_out log-normal (mu, sigma) of seconds
+               per unit of work and stage-in/out seconds
+        @param download_failure probability of one CDB download failing
+        @param fatal_rate probability of a job failing for good
+        """
+        self.name = name
+        self.slots = slots
+        self.speed = speed
+        self.stage_in = stage_in
+        self.stage_out = stage_out
+        self.download_failure = download_failure
+        self.fatal_rate = fatal_rate
+
+def fit_sites(prod_db, args):
+    """
+    Fit one SiteModel per site from site_jobs
+
+    @returns dict of site to SiteModel, empty if nothing was harvested
+    """
+    stats = site_stats.SiteStats(prod_db)
+    rows = stats.proddb.execute("SELECT site, success, exit_code, work, \
+            wall_seconds, stagein_seconds, stageout_seconds FROM site_jobs \
+            WHERE ended >= ?", (now_string(-args.window_days*24*3600),))
+    by_site = {}
+    for row in rows.fetchall():
+        by_site.setdefault(row[0], []).append(row)
+    sites = {}
+    for site, jobs in by_site.items():
+        speeds = [wall/work for success, wall, work in \
+                  [(job[1], job[4], job[3]) for job in jobs] \
+                  if success and wall is not None and work]
+        transient = len([job for job in jobs if job[2] == 1])
+        fatal = len([job for job in jobs if not job[1] and job[2] != 1])
+        sites[site] = SiteModel(site, args.slots, \
+                 fit_lognormal(speeds, args.seconds_per_unit), \
+                 fit_lognormal([job[5] for job in jobs if job[5] is not None], \
+                               args.stage_seconds), \
+                 fit_lognormal([job[6] for job in jobs if job[6] is not None], \
+                               args.stage_seconds), \
+                 download_failure_rate(float(transient)/len(jobs)), \
+                 float(fatal)/len(jobs))
+    return sites
+
+def default_sites(args):
+    """
+    @returns dict of args.sites identical made up sites
+    """
+    sites = {}
+    for i in range(args.sites):
+        name = 'Site.'+str(i)
+        sites[name] = SiteModel(name, args.slots, \
+                            (math.log(args.seconds_per_unit), 0.3), \
+                            (math.log(args.stage_seconds), 0.5), \
+                            (math.log(args.stage_seconds), 0.5), \
+                            download_failure_rate(args.transient_rate), \
+                            args.fatal_rate)
+    return sites
+
+def allowed_sites(sites, policy, stats, args):
+    """
+    @returns the site names jobs may run at under the policy
+    """
+    names = sorted(sites.keys())
+    if policy['sites'] == 'all' or len(stats) == 0:
+        return names
+    banned = site_stats.ban_list(stats, args.min_jobs, args.min_success, \
+                                 args.min_speed)
+    if policy['sites'] == 'ban':
+        allowed = [name for name in names if name not in banned]
+    elif policy['sites'].startswith('best:'):
+        allowed = site_stats.ranking(stats, banned)
+        allowed = allowed[:int(policy['sites'].split(':')[1])]
+    else:
+        raise ValueError("Unknown site policy "+policy['sites'])
+    allowed = [name for name in allowed if name in sites]
+    if len(allowed) == 0:
+        return names
+    return allowed
+
+def make_jobs(runs, info, geometry_ids, group_size):
+    """
+    Pack runs into jobs as submit_jobs.py --group-size does; runs whose
+    geometry ID is not cached are grouped by their settings alone
+
+    @returns list of lists of runs
+    """
+    keys = {}
+    for run in runs:
+        if run in info:
+            keys[run] = affinity.affinity_key(info[run], \
+                                              geometry_ids.get(str(run), \
+                                                               'unknown'))
+    triggers = dict([(run, info[run]['triggers']) for run in info])
+    return affinity.group_runs(runs, keys, triggers, group_size)
+
+class CampaignSimulator:
+    """
+    CampaignSimulator runs one campaign under one policy
+
+    Events are (time, sequence, kind, data) in a heap:
+      - "queue": a job is ready to be submitted (first time or retry);
+      - "submit": the submitter makes one call if the token bucket allows;
+      - "end": a job attempt ended, well or badly.
+    Jobs are matched at submission to the allowed site whose next slot frees
+    first; each site keeps a heap of the times its slots become free.
+    """
+
+    def __init__(self, sites, allowed, policy, args, seed):
+        """
+        @param sites dict of site name to SiteModel
+        @param allowed site names jobs may run at
+        @param policy policy dict (see POLICY_DEFAULTS)
+        @param args parsed command line arguments
+        @param seed random seed
+        """
+        self.sites = sites
+        self.allowed = allowed
+        self.policy = policy
+        self.args = args
+        self.random = random.Random(seed)
+        self.events = []
+        self.sequence = 0
+        self.pending = []
+        self.submit_scheduled = False
+        self.tokens = float(policy['burst'])
+        self.last_refill = 0.
+        self.slots = dict([(name, [0.]*sites[name].slots) \
+                           for name in allowed])
+        self.totals = {'jobs':0, 'attempts':0, 'calls':0, 'parked':0, \
+                       'slot_seconds':0., 'maus_seconds':0., \
+                       'wasted_seconds':0., 'makespan':0.}
+
+    def push(self, time, kind, data=None):
+        """
+        Add an event
+        """
+        heapq.heappush(self.events, (time, self.sequence, kind, data))
+        self.sequence += 1
+
+    def run(self, jobs, work):
+        """
+        Simulate the campaign
+
+        @param jobs list of lists of runs
+        @param work dict of run to units of work
+        @returns dict of totals
+        """
+        self.totals['jobs'] = len(jobs)
+        for runs in jobs:
+            self.push(0., 'queue', {'runs':runs, 'retries':0, \
+                      'work':sum([work.get(run, 1) for run in runs])})
+        while len(self.events) > 0:
+            time, dummy, kind, data = heapq.heappop(self.events)
+            if kind == 'queue':
+                self.pending.append(data)
+                if not self.submit_scheduled:
+                    self.submit_scheduled = True
+                    self.push(time, 'submit')
+            elif kind == 'submit':
+                self.submit_call(time)
+            else:
+                self.attempt_ended(time, data)
+        return self.totals
+
+    def submit_call(self, time):
+        """
+        Make one submission call if there is a token, else wait for one
+        """
+        self.tokens = min(float(self.policy['burst']), self.tokens+\
+                          (time-self.last_refill)*self.policy['rate'])
+        self.last_refill = time
+        if self.tokens < 1.:
+            self.push(time+(1.-self.tokens)/self.policy['rate'], 'submit')
+            return
+        self.tokens -= 1.
+        self.totals['calls'] += 1
+        bulk = self.pending[:self.policy['bulk_size']]
+        self.pending = self.pending[self.policy['bulk_size']:]
+        for job in bulk:
+            self.dispatch(time, job)
+        if len(self.pending) > 0:
+            self.push(time, 'submit')
+        else:
+            self.submit_scheduled = False
+
+    def dispatch(self, time, job):
+        """
+        Match a submitted job to a site slot and work out how it ends
+        """
+        ready = time+self.random.expovariate(1./max(self.args.queue_wait, 1.))
+        name = min(self.allowed, key=lambda name: self.slots[name][0])
+        site = self.sites[name]
+        start = max(ready, heapq.heappop(self.slots[name]))
+        n_runs = len(job['runs'])
+        downloads = 2
+        if n_runs > 1:
+            downloads = 1+n_runs
+        stage_in = sum([self.random.lognormvariate(*site.stage_in) \
+                        for dummy in range(n_runs)])
+        download = downloads*self.args.download_seconds
+        maus = job['work']*self.random.lognormvariate(*site.speed)
+        stage_out = self.random.lognormvariate(*site.stage_out)
+        transient = self.random.random() < \
+                    1.-(1.-site.download_failure)**downloads
+        fatal = self.random.random() < site.fatal_rate
+        if transient:
+            # the download failing is the one that ends the job
+            duration = stage_in+self.random.uniform(0., download)
+            outcome = 1
+        elif fatal:
+            duration = stage_in+download+maus
+            outcome = 2
+        else:
+            duration = stage_in+download+maus+stage_out
+            outcome = 0
+        end = start+duration
+        heapq.heappush(self.slots[name], end)
+        self.totals['attempts'] += 1
+        self.totals['slot_seconds'] += duration
+        if outcome == 0:
+            self.totals['maus_seconds'] += maus
+        else:
+            self.totals['wasted_seconds'] += duration
+        self.push(end, 'end', (job, outcome))
+
+    def attempt_ended(self, time, data):
+        """
+        Finish, park or resubmit a job after the poller has seen it end
+        """
+        job, outcome = data
+        if outcome == 0:
+            self.totals['makespan'] = max(self.totals['makespan'], time)
+            return
+        job['retries'] += 1
+        if outcome != 1 or job['retries'] > self.policy['max_retries']:
+            self.totals['parked'] += 1
+            return
+        interval = self.args.poll_interval
+        seen = math.ceil(time/interval)*interval
+        self.push(seen+backoff_delay(job['retries'], self.policy['backoff'], \
+                                     self.policy['max_backoff']), 'queue', job)
+
+def read_runs(items):
+    """
+    @returns sorted run numbers from runs, ranges and run list files
+    """
+    runs = []
+    for item in items:
+        if os.path.isfile(item):
+            with open(item) as run_list:
+                runs += [int(word) for word in run_list.read().split()]
+        else:
+            runs += parse_items([item])
+    return sorted(set(runs))
+
+def main(argv):
+    """
+    Simulate each policy and print the results
+    """
+    args = arg_parser().parse_args(argv)
+    runs = read_runs(args.items)
+    info = {}
+    if args.runinfo is not None:
+        info = affinity.read_run_info(args.runinfo, runs)
+    work = dict([(run, info[run]['triggers'] or 1) for run in info])
+    ids = {}
+    if os.path.exists(args.geometry_ids):
+        with open(args.geometry_ids) as ids_file:
+            ids = json.load(ids_file)
+
+    stats = {}
+    sites = {}
+    if os.path.exists(args.db):
+        prod_db = ProdDB(args.db)
+        sites = fit_sites(prod_db, args)
+        stats = site_stats.SiteStats(prod_db).summary(args.window_days)
+    if len(sites) == 0:
+        print 'No site statistics, using', args.sites, 'made up sites'
+        sites = default_sites(args)
+
+    print 'runs:', len(runs), 'sites:', len(sites), 'units of work:', \
+          sum([work.get(run, 1) for run in runs])
+    print 'policy jobs attempts calls parked makespan[h] cpu_efficiency '+\
+          'wasted_slot_hours'
+    for text in args.policies or ['']:
+        policy = parse_policy(text)
+        jobs = make_jobs(runs, info, ids, policy['group_size'])
+        simulator = CampaignSimulator(sites, allowed_sites(sites, policy, \
+                                      stats, args), policy, args, args.seed)
+        totals = simulator.run(jobs, work)
+        efficiency = 0.
+        if totals['slot_seconds'] > 0:
+            efficiency = totals['maus_seconds']/totals['slot_seconds']
+        print text or 'default', totals['jobs'], totals['attempts'], \
+              totals['calls'], totals['parked'], \
+              round(totals['makespan']/3600., 2), round(efficiency, 3), \
+              round(totals['wasted_seconds']/3600., 2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
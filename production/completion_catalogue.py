@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""
+Local catalogue of reconstruction outputs that are already done
+"""
+
+DESCRIPTION = """
+Keep a local sqlite catalogue of finished reconstruction outputs, so runs that
+are already done are filtered out at submission time instead of finding out on
+a worker node with lcg-ls.
+
+Each output is recorded with its run, batch iteration, MAUS version, size and
+md5 (if known) and the storage path. The catalogue is filled
+  - from job outcomes: "record" the <run>_offline.tar (and .md5) files brought
+    back by a job or a local run;
+  - from bulk listings of the storage tree: "harvest" runs lcg-ls -l over
+    <base>/<MAUS version>/<batch iteration>/Step4/ (or reads a saved listing)
+    and records every <run>_offline.tar found.
+"filter" prints the runs of a run list that are not in the catalogue.
+
+Usage:
+    completion_catalogue.py record  -b BI -m VERSION <tar files>
+    completion_catalogue.py harvest -b BI -m VERSION [--listing FILE]
+    completion_catalogue.py filter  -b BI -m VERSION <runs or run list files>
+    completion_catalogue.py list    [-b BI] [-m VERSION]
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+
+DEFAULT_CATALOGUE = "../../MICEprodDB/completion_catalogue.db"
+
+STORAGE_BASE = "srm://heplnx204.pp.rl.ac.uk/pnfs/pp.rl.ac.uk/data/mice/RECO"
+
+_OUTPUT_RE = re.compile(r'(\d+)_offline\.tar$')
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['record', 'harvest', 'filter', \
+                                            'list'])
+    parser.add_argument('items', nargs='*', \
+                        help='Tar files (record) or runs/run lists (filter)')
+    parser.add_argument('-b', '--batch-iteration', dest='batch_iteration', \
+                        type=int, default=None, help='Batch iteration number')
+    parser.add_argument('-m', '--maus-version', dest='maus_version', \
+                        default=None, help='MAUS version, e.g. MAUS-v3.1.2')
+    parser.add_argument('--catalogue', dest='catalogue', \
+                        default=DEFAULT_CATALOGUE, help='Catalogue file')
+    parser.add_argument('--base', dest='base', default=STORAGE_BASE, \
+                        help='Storage base URL for harvest')
+    parser.add_argument('--listing', dest='listing', default=None, \
+                        help='Harvest from a saved "lcg-ls -l" listing')
+    return parser
+
+class CompletionCatalogue:
+    """
+    Completion catalogue records which (run, batch iteration, MAUS version)
+    outputs exist
+    """
+
+    def __init__(self, db_name=DEFAULT_CATALOGUE):
+        """
+        Open the catalogue, creating the table if needed
+        """
+        self.catdb = sqlite3.connect(db_name)
+        self.create_table()
+
+    def create_table(self):
+        """
+        Create the completed table
+        """
+        self.catdb.execute("CREATE TABLE IF NOT EXISTS completed(\
+                run INTEGER,\
+                batch_iteration INTEGER,\
+                maus_version STRING,\
+                size INTEGER,\
+                md5 STRING,\
+                path STRING,\
+                source STRING,\
+                recorded DATE,\
+                PRIMARY KEY(run, batch_iteration, maus_version))\
+                ")
+        self.catdb.commit()
+
+    def record(self, outputs, batch_iteration, maus_version, source):
+        """
+        Record outputs in one transaction
+
+        @param outputs list of (run, size, md5, path); md5 may be None
+        @param source where the information came from ('job' or 'listing')
+        """
+        rows = [(int(run), batch_iteration, maus_version, size, md5, path, \
+                 source) for (run, size, md5, path) in outputs]
+        with self.catdb:
+            self.catdb.executemany("INSERT OR REPLACE INTO completed(run, \
+                batch_iteration, maus_version, size, md5, path, source, \
+                recorded) VALUES (?,?,?,?,?,?,?,datetime('now'))", rows)
+        return len(rows)
+
+    def done_runs(self, batch_iteration, maus_version):
+        """
+        @returns set of runs with a non-empty output for this processing
+        """
+        rows = self.catdb.execute("SELECT run FROM completed WHERE \
+                batch_iteration = ? AND maus_version = ? AND size > 0", \
+                (batch_iteration, maus_version)).fetchall()
+        return set([row[0] for row in rows])
+
+    def filter_runs(self, runs, batch_iteration, maus_version):
+        """
+        @returns runs (in the given order) that are not done yet
+        """
+        done = self.done_runs(batch_iteration, maus_version)
+        return [run for run in runs if int(run) not in done]
+
+    def entries(self, batch_iteration=None, maus_version=None):
+        """
+        @returns list of catalogue rows, optionally selected
+        """
+        query = "SELECT run, batch_iteration, maus_version, size, md5, path, \
+                 source, recorded FROM completed WHERE 1"
+        values = []
+        if batch_iteration is not None:
+            query += " AND batch_iteration = ?"
+            values.append(batch_iteration)
+        if maus_version is not None:
+            query += " AND maus_version = ?"
+            values.append(maus_version)
+        return self.catdb.execute(query+" ORDER BY run", values).fetchall()
+
+def file_md5(file_name):
+    """
+    @returns the md5 hex digest of a file
+    """
+    md5hash = hashlib.md5()
+    with open(file_name, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(4096), b""):
+            md5hash.update(chunk)
+    return md5hash.hexdigest()
+
+def outputs_from_files(tar_files):
+    """
+    Describe local <run>_offline.tar files brought back from jobs
+
+    The md5 is read from the .md5 file written by execute_data_recon.py if
+    present, otherwise computed.
+
+    @returns list of (run, size, md5, path)
+    """
+    outputs = []
+    for tar_file in tar_files:
+        match = _OUTPUT_RE.search(os.path.basename(tar_file))
+        if match is None or not os.path.isfile(tar_file):
+            print 'Skipping', tar_file
+            continue
+        if os.path.isfile(tar_file+'.md5'):
+            with open(tar_file+'.md5') as md5_file:
+                md5 = md5_file.read().split()[0]
+        else:
+            md5 = file_md5(tar_file)
+        outputs.append((int(match.group(1)), os.path.getsize(tar_file), md5, \
+                        os.path.abspath(tar_file)))
+    return outputs
+
+def parse_listing(lines):
+    """
+    Parse "lcg-ls -l" output
+
+    File lines look like
+    -rw-r--r--   1     2     2  5488820   ONLINE  /pnfs/.../10526_offline.tar
+    and may be followed by a "* Checksum: <value> (<type>)" line.
+
+    @returns list of (run, size, md5, path); md5 is None unless listed as md5
+    """
+    outputs = []
+    last_was_output = False
+    for line in lines:
+        words = line.split()
+        if len(words) > 2 and words[0] == '*' and words[1] == 'Checksum:':
+            if last_was_output and line.find('md5') >= 0:
+                run, size, md5, path = outputs[-1]
+                outputs[-1] = (run, size, words[2], path)
+            continue
+        last_was_output = False
+        if len(words) < 5 or not words[0].startswith('-'):
+            continue
+        match = _OUTPUT_RE.search(words[-1])
+        if match is None:
+            continue
+        last_was_output = True
+        size = [int(word) for word in words[1:-1] if word.isdigit()][-1]
+        outputs.append((int(match.group(1)), size, None, words[-1]))
+    return outputs
+
+def list_storage(base, maus_version, batch_iteration):
+    """
+    Bulk list the Step4 output tree of one processing with lcg-ls
+
+    @returns listing lines of all century directories
+    """
+    top = '/'.join([base, maus_version, str(batch_iteration), 'Step4'])
+    proc = subprocess.Popen(['lcg-ls', top], stdout=subprocess.PIPE)
+    (stdout, stderr) = proc.communicate() # pylint: disable = W0612
+    lines = []
+    for subdir in stdout.split():
+        url = top+'/'+os.path.basename(subdir)
+        proc = subprocess.Popen(['lcg-ls', '-l', url], stdout=subprocess.PIPE)
+        lines += proc.communicate()[0].splitlines()
+    return lines
+
+def read_runs(items):
+    """
+    @returns run numbers from a mix of run numbers and run list files
+    """
+    runs = []
+    for item in items:
+        if os.path.isfile(item):
+            with open(item) as run_list:
+                runs += [int(word) for word in run_list.read().split()]
+        else:
+            runs.append(int(item))
+    return runs
+
+def main(argv):
+    """
+    Command line interface - see DESCRIPTION
+    """
+    parser = arg_parser()
+    # items may come after the options as well as before them
+    args, extra = parser.parse_known_args(argv)
+    for item in extra:
+        if item.startswith('-'):
+            parser.error('unrecognized arguments: '+item)
+    args.items += extra
+    if args.command != 'list' and \
+       (args.batch_iteration is None or args.maus_version is None):
+        print 'Batch iteration (-b) and MAUS version (-m) are needed'
+        return 1
+    catalogue = CompletionCatalogue(args.catalogue)
+    if args.command == 'record':
+        outputs = outputs_from_files(args.items)
+        catalogue.record(outputs, args.batch_iteration, args.maus_version, \
+                         'job')
+        print 'Recorded', len(outputs), 'outputs'
+    elif args.command == 'harvest':
+        if args.listing is not None:
+            with open(args.listing) as listing:
+                lines = listing.readlines()
+        else:
+            lines = list_storage(args.base, args.maus_version, \
+                                 args.batch_iteration)
+        outputs = parse_listing(lines)
+        catalogue.record(outputs, args.batch_iteration, args.maus_version, \
+                         'listing')
+        print 'Recorded', len(outputs), 'outputs'
+    elif args.command == 'filter':
+        for run in catalogue.filter_runs(read_runs(args.items), \
+                                         args.batch_iteration, \
+                                         args.maus_version):
+            print run
+    else:
+        for row in catalogue.entries(args.batch_iteration, args.maus_version):
+            print ' '.join([str(item) for item in row])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+"""
+Poll job status, record exit codes and resubmit transient failures
+"""
+
+DESCRIPTION = """
+Follow the jobs recorded in job_info2 until they are finished or need an
+expert, so the farm stays full without anyone watching it.
+
+Each poll
+  - queries the status of all active jobs in bulk (--status-bulk jobs per
+    backend call) and writes status and site to job_info2 in one transaction;
+  - for jobs that ended (DIRAC status Done or Failed) fetches std.out in
+    bulk and reads the exit code of the job script:
+        0 - Finished
+        1 - transient error (DownloadError, raw data not available); the job
+            is put in Retry and resubmitted after a backoff of
+            --backoff * 2^(retry_count-1) seconds (at most --max-backoff),
+            until retry_count reaches --max-retries
+        2, 3 - MAUS or script error; Parked for an expert (as is any other
+            code, and a job that used up its retries)
+        4 - the run failed pre-flight validation (no beamline entry,
+            geometry or SciFi calibration, see metadata_index.py); Parked
+    A job that failed without an exit code in its std.out (lost, killed by the
+    site, no output sandbox) counts as transient;
+  - resubmits Retry jobs whose backoff is over, through the same backend and
+    rate limit as submit_jobs.py. The new job gets a new job_info2 row with
+    retry_count+1; the old row becomes Resubmitted.
+
+With --speculate, jobs running well past their predicted runtime get a
+duplicate at another site (see stragglers.py). When one copy of a job
+finishes successfully the other copies are killed.
+
+Run from the directory holding the JDL template and input sandbox files, as
+for submit_jobs.py. With --interval the poller loops forever.
+"""
+
+import argparse
+import re
+import sys
+import time
+
+import backends
+from proddb import ProdDB, DEFAULT_DB, now_string
+from submit_jobs import TokenBucket
+import stragglers
+
+# exit codes of execute_MC.py / execute_data_recon.py
+TRANSIENT_CODES = [1]
+PARKED_CODES = [2, 3, 4]
+
+# DIRAC statuses after which the job will not run any more
+ENDED_STATUSES = ['Done', 'Failed']
+
+# lines in std.out giving the exit code of the job script, newest wins
+_EXIT_CODE_RES = [
+    re.compile(r'execute_MC\.py exit status = (\d+)'),
+    re.compile(r'Reconstruction failed with status = (\d+)'),
+    re.compile(r'Reconstruction returned with status (\d+)'),
+    re.compile(r'Job exit status = (\d+)'),
+]
+_TRANSIENT_RES = [
+    re.compile(r'Error getting raw input'),
+]
+_DONE_RES = [
+    re.compile(r'Error: Already existing output file on dcache'),
+]
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prod-id', dest='prod_id', default=None, \
+                        help='Only follow jobs of this prodID')
+    parser.add_argument('--db', dest='db', default=DEFAULT_DB, \
+                        help='Production database')
+    parser.add_argument('--template', dest='template', default='testMICE', \
+                        help='JDL template used for resubmission')
+    parser.add_argument('--backend', dest='backend', default='dirac', \
+                        choices=sorted(backends.BACKENDS.keys()), \
+                        help='Submission backend')
+    parser.add_argument('--output-dir', dest='output_dir', \
+                        default='job_outputs', \
+                        help='Where std.out of ended jobs is fetched to')
+    parser.add_argument('--status-bulk', dest='status_bulk', type=int, \
+                        default=500, help='Jobs per status query')
+    parser.add_argument('--bulk-size', dest='bulk_size', type=int, \
+                        default=100, help='Jobs per resubmission call')
+    parser.add_argument('--rate', dest='rate', type=float, default=0.5, \
+                        help='Sustained backend calls per second')
+    parser.add_argument('--burst', dest='burst', type=int, default=5, \
+                        help='Backend calls allowed back to back')
+    parser.add_argument('--max-retries', dest='max_retries', type=int, \
+                        default=5, help='Retry budget per job argument')
+    parser.add_argument('--backoff', dest='backoff', type=float, \
+                        default=600., help='First resubmission delay [s]')
+    parser.add_argument('--max-backoff', dest='max_backoff', type=float, \
+                        default=6*3600., help='Longest resubmission delay [s]')
+    parser.add_argument('--speculate', dest='speculate', \
+                        action='store_true', default=False, \
+                        help='Duplicate straggler jobs at another site')
+    parser.add_argument('--runinfo', dest='runinfo', default=None, \
+                        help='runinfo.sqlite, to predict runtimes of '+\
+                             'reconstruction jobs from their triggers')
+    parser.add_argument('--seconds-per-unit', dest='seconds_per_unit', \
+                        type=float, default=0.1, \
+                        help='Runtime per trigger (with --runinfo) or per '+\
+                             'job until enough jobs finished [s]')
+    parser.add_argument('--straggler-factor', dest='straggler_factor', \
+                        type=float, default=2., \
+                        help='Straggler if running > factor * prediction '+\
+                             '+ margin')
+    parser.add_argument('--straggler-margin', dest='straggler_margin', \
+                        type=float, default=1800., help='See above [s]')
+    parser.add_argument('--max-speculative', dest='max_speculative', \
+                        type=int, default=50, \
+                        help='Most duplicate jobs alive at once')
+    parser.add_argument('--interval', dest='interval', type=float, \
+                        default=None, help='Poll every INTERVAL seconds; '+\
+                                           'default is to poll once')
+    return parser
+
+def parse_exit_code(text):
+    """
+    Find the exit code of the job script in its std.out
+
+    @returns exit code, or None if std.out does not say
+    """
+    code = None
+    position = -1
+    for regex in _EXIT_CODE_RES:
+        for match in regex.finditer(text):
+            if match.start() > position:
+                position = match.start()
+                code = int(match.group(1))
+    if code is not None:
+        return code
+    for regex in _TRANSIENT_RES:
+        if regex.search(text):
+            return 1
+    for regex in _DONE_RES:
+        if regex.search(text):
+            return 0
+    return None
+
+def classify(dirac_status, exit_code):
+    """
+    Decide what to do with an ended job
+
+    @returns exit code to record (None if unknown) and the new status
+    """
+    if exit_code is None:
+        if dirac_status == 'Done':
+            return None, 'Finished'
+        return None, 'Retry'
+    if exit_code == 0:
+        return 0, 'Finished'
+    if exit_code in TRANSIENT_CODES:
+        return exit_code, 'Retry'
+    return exit_code, 'Parked'
+
+def backoff_delay(retry_count, backoff, max_backoff):
+    """
+    @returns seconds to wait before the next resubmission
+    """
+    return min(max_backoff, backoff*2**max(0, retry_count-1))
+
+class JobPoller:
+    """
+    JobPoller runs the poll - classify - resubmit cycle on job_info2
+    """
+
+    def __init__(self, args, backend=None, prod_db=None):
+        """
+        @param args parsed command line arguments
+        @param backend backend instance; made from args.backend if None
+        @param prod_db ProdDB instance; opened from args.db if None
+        """
+        self.args = args
+        self.backend = backend
+        if self.backend is None:
+            self.backend = backends.get_backend(args.backend)
+        self.prod_db = prod_db
+        if self.prod_db is None:
+            self.prod_db = ProdDB(args.db)
+        self.bucket = TokenBucket(args.rate, args.burst)
+        self.template = None
+        self.stragglers = None
+        if args.speculate:
+            self.stragglers = stragglers.StragglerMonitor(args, self.backend, \
+                                                   self.prod_db, self.bucket)
+
+    def poll(self):
+        """
+        One cycle over all active jobs
+
+        @returns dict of counts of status changes
+        """
+        counts = {}
+        jobs = self.prod_db.active_jobs(self.args.prod_id)
+        following = [job for job in jobs if job['status'] != 'Retry']
+        states = {}
+        for start in range(0, len(following), self.args.status_bulk):
+            bulk = [job['ID'] for job in \
+                    following[start:start+self.args.status_bulk]]
+            self.bucket.acquire()
+            states.update(self.backend.status(bulk))
+
+        updates = []
+        ended = []
+        for job in following:
+            if job['ID'] not in states:
+                continue
+            status, minor, site = states[job['ID']] # pylint: disable = W0612
+            if status in ENDED_STATUSES:
+                ended.append((job, status, site))
+            elif status != job['status']:
+                values = {'status':status, 'site':site}
+                if status == 'Running' and job['started'] is None:
+                    values['started'] = now_string()
+                updates.append((job['rowid'], values))
+                counts[status] = counts.get(status, 0)+1
+        self.prod_db.update_jobs(updates)
+
+        updates = self.read_exit_codes(ended, counts)
+        self.prod_db.update_jobs(updates)
+        self.cancel_copies([rowid for rowid, values in updates \
+                            if values['status'] == 'Finished'], counts)
+        self.resubmit(counts)
+        if self.stragglers is not None:
+            self.stragglers.check(self.get_template(), counts)
+        return counts
+
+    def get_template(self):
+        """
+        @returns the JDL template, read on first use
+        """
+        if self.template is None:
+            with open(self.args.template) as template_file:
+                self.template = template_file.read()
+        return self.template
+
+    def cancel_copies(self, finished_rowids, counts):
+        """
+        Kill the other copies of jobs that finished successfully
+
+        The first copy to finish wins; copies still queued or running are
+        killed, copies waiting for a retry are dropped.
+        """
+        if len(finished_rowids) == 0:
+            return
+        jobs = self.prod_db.active_jobs(self.args.prod_id)
+        winners = self.prod_db.proddb.execute("SELECT prodID, argument FROM \
+                job_info2 WHERE rowid IN ("+\
+                ','.join([str(rowid) for rowid in finished_rowids])+")")
+        winners = set([(str(prod_id), str(argument)) \
+                       for prod_id, argument in winners.fetchall()])
+        losers = [job for job in jobs \
+                  if (str(job['prodID']), job['argument']) in winners]
+        if len(losers) == 0:
+            return
+        self.bucket.acquire()
+        self.backend.kill([job['ID'] for job in losers \
+                           if job['status'] != 'Retry'])
+        self.prod_db.update_jobs([(job['rowid'], {'status':'Killed'}) \
+                                  for job in losers])
+        counts['Killed'] = counts.get('Killed', 0)+len(losers)
+
+    def read_exit_codes(self, ended, counts):
+        """
+        Fetch std.out of ended jobs and classify them
+
+        @returns list of job_info2 updates
+        """
+        outputs = {}
+        for start in range(0, len(ended), self.args.status_bulk):
+            bulk = [job['ID'] for job, status, site in \
+                    ended[start:start+self.args.status_bulk]]
+            self.bucket.acquire()
+            outputs.update(self.backend.get_output(bulk, \
+                                                   self.args.output_dir))
+        updates = []
+        for job, status, site in ended:
+            exit_code = None
+            if job['ID'] in outputs:
+                with open(outputs[job['ID']]) as std_out:
+                    exit_code = parse_exit_code(std_out.read())
+            exit_code, new_status = classify(status, exit_code)
+            next_retry = None
+            if new_status == 'Retry':
+                if job['retry_count'] >= self.args.max_retries:
+                    new_status = 'Parked'
+                else:
+                    next_retry = now_string(backoff_delay(job['retry_count'], \
+                                 self.args.backoff, self.args.max_backoff))
+            updates.append((job['rowid'], {'status':new_status, 'site':site, \
+                            'exit_code':exit_code, 'next_retry':next_retry}))
+            counts[new_status] = counts.get(new_status, 0)+1
+        return updates
+
+    def resubmit(self, counts):
+        """
+        Resubmit Retry jobs whose backoff is over
+
+        Each bulk gets new rows for the new jobs and marks the old rows
+        Resubmitted.
+        """
+        now = now_string()
+        jobs = self.prod_db.active_jobs(self.args.prod_id)
+        # a job with another live copy (a speculative duplicate) is not retried
+        live = set([(job['prodID'], job['argument']) for job in jobs \
+                    if job['status'] != 'Retry'])
+        due = [job for job in jobs \
+               if job['status'] == 'Retry' and job['next_retry'] is not None \
+                  and job['next_retry'] <= now and job['argument'] is not None]
+        superseded = [job for job in due \
+                      if (job['prodID'], job['argument']) in live]
+        self.prod_db.update_jobs([(job['rowid'], {'status':'Resubmitted'}) \
+                                  for job in superseded])
+        due = [job for job in due if job not in superseded]
+        if len(due) == 0:
+            return
+        template = self.get_template()
+        for start in range(0, len(due), self.args.bulk_size):
+            bulk = due[start:start+self.args.bulk_size]
+            self.bucket.acquire()
+            try:
+                job_ids = self.backend.submit(template, \
+                                          [job['argument'] for job in bulk])
+            except backends.SubmissionError as error:
+                print 'Resubmission failed, will try again next poll', error
+                return
+            new_jobs = []
+            for job, job_id in zip(bulk, job_ids):
+                new_job = dict(job)
+                new_job['ID'] = job_id
+                new_job['retry_count'] = job['retry_count']+1
+                new_job['status'] = 'Submitted'
+                new_job['speculative'] = 0
+                new_jobs.append(new_job)
+                print 'Resubmitted', job['argument'], 'as', job_id, \
+                      'retry', new_job['retry_count']
+            self.prod_db.insert_jobs(new_jobs)
+            self.prod_db.update_jobs([(job['rowid'], \
+                                       {'status':'Resubmitted'}) \
+                                      for job in bulk])
+            counts['Resubmitted'] = counts.get('Resubmitted', 0)+len(bulk)
+
+def main(argv):
+    """
+    Poll once, or every --interval seconds
+    """
+    args = arg_parser().parse_args(argv)
+    poller = JobPoller(args)
+    while True:
+        counts = poller.poll()
+        print now_string(), ' '.join([status+':'+str(number) for \
+                                      status, number in sorted(counts.items())])
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
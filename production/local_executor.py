@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+Run production jobs on this machine or a local batch system
+"""
+
+DESCRIPTION = """
+Run the jobs queued by the executor backend (submit_jobs.py --backend
+executor) on a plain multi-core machine or through a local batch system,
+instead of on the grid.
+
+Submit with a local JDL (testLocal in Data/ and MonteCarlo/): its Executable
+is run with its Arguments in a scratch directory holding a copy of its
+InputSandbox. The local job scripts write their outputs under the local
+"storage element" directory given by --local-se (exported as LOCAL_SE), with
+the same layout as on grid storage.
+
+"run" starts queued jobs until the queue is empty (or forever with --follow):
+  - with --processes N, at most N jobs run at once on this machine;
+  - with --batch-command, each job is handed to the batch system, e.g.
+        --batch-command "sbatch -c 1 --wrap '{command}'"
+    and at most --processes jobs are queued or running there at once.
+Every --interval seconds job_info2 is updated through job_poller.py (status,
+exit code, resubmission of transient failures) unless --no-poll is given.
+
+"execute" runs one queued job; it is what "run" starts for each job.
+
+Usage:
+    local_executor.py run [--processes N] [--batch-command CMD] [--follow]
+    local_executor.py execute <spool>/<job ID>
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import backends
+from backends import get_executor_state, set_executor_state
+import job_poller
+from proddb import DEFAULT_DB
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['run', 'execute'])
+    parser.add_argument('job_dir', nargs='?', default=None, \
+                        help='Job directory (execute)')
+    parser.add_argument('--spool', dest='spool', \
+                        default=backends.DEFAULT_SPOOL, help='Job spool')
+    parser.add_argument('--scratch', dest='scratch', default='local_scratch', \
+                        help='Directory for the per-job scratch directories')
+    parser.add_argument('--local-se', dest='local_se', default='local_se', \
+                        help='Directory used as storage element')
+    parser.add_argument('--keep-scratch', dest='keep_scratch', \
+                        action='store_true', default=False, \
+                        help='Keep scratch directories of successful jobs')
+    parser.add_argument('--processes', dest='processes', type=int, \
+                        default=4, help='Jobs running at once')
+    parser.add_argument('--batch-command', dest='batch_command', \
+                        default=None, help='Batch submission command; '+\
+                                           '{command} is the job command')
+    parser.add_argument('--interval', dest='interval', type=float, \
+                        default=10., help='Seconds between scheduling cycles')
+    parser.add_argument('--follow', dest='follow', action='store_true', \
+                        default=False, help='Wait for new jobs when idle')
+    parser.add_argument('--db', dest='db', default=DEFAULT_DB, \
+                        help='Production database')
+    parser.add_argument('--template', dest='template', default='testLocal', \
+                        help='JDL used by the poller for resubmission')
+    parser.add_argument('--no-poll', dest='poll', action='store_false', \
+                        default=True, help='Do not update job_info2')
+    return parser
+
+def execute(job_dir, scratch, local_se, keep_scratch):
+    """
+    Run one job in its own scratch directory
+
+    std.out and std.err go to the job directory; the exit status is appended
+    to std.out and written to the exit_code file.
+
+    @returns exit status of the job
+    """
+    job_dir = os.path.abspath(job_dir)
+    job_id = os.path.basename(job_dir)
+    with open(os.path.join(job_dir, 'job.json')) as job_file:
+        job = json.load(job_file)
+    if get_executor_state(job_dir) == 'Killed':
+        return 1
+    set_executor_state(job_dir, 'Running')
+    work_dir = os.path.abspath(os.path.join(scratch, job_id))
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    for name in job['sandbox']:
+        if os.path.isdir(name):
+            shutil.copytree(name, os.path.join(work_dir, \
+                                               os.path.basename(name)))
+        else:
+            shutil.copy(name, work_dir)
+    executable = os.path.join(work_dir, job['executable'])
+    os.chmod(executable, 0755)
+    env = dict(os.environ)
+    env['LOCAL_SE'] = os.path.abspath(local_se)
+    env['JOB_ID'] = job_id
+    with open(os.path.join(job_dir, 'std.out'), 'w') as std_out:
+        with open(os.path.join(job_dir, 'std.err'), 'w') as std_err:
+            proc = subprocess.Popen(executable+' '+job['arguments'], \
+                                    shell=True, cwd=work_dir, env=env, \
+                                    stdout=std_out, stderr=std_err, \
+                                    preexec_fn=os.setsid)
+            with open(os.path.join(job_dir, 'pid'), 'w') as pid_file:
+                pid_file.write(str(proc.pid))
+            proc.wait()
+    status = proc.returncode
+    if status < 0: # killed by a signal
+        status = 128-status
+    with open(os.path.join(job_dir, 'std.out'), 'a') as std_out:
+        std_out.write('Job exit status = '+str(status)+'\n')
+    with open(os.path.join(job_dir, 'exit_code'), 'w') as exit_file:
+        exit_file.write(str(status)+'\n')
+    if get_executor_state(job_dir) != 'Killed':
+        set_executor_state(job_dir, ['Failed', 'Done'][status == 0])
+    if status == 0 and not keep_scratch:
+        shutil.rmtree(work_dir)
+    return status
+
+class Executor:
+    """
+    Executor starts queued jobs, keeping at most args.processes in flight
+    """
+
+    def __init__(self, args):
+        """
+        @param args parsed command line arguments
+        """
+        self.args = args
+        self.backend = backends.ExecutorBackend(args.spool)
+        self.children = {}
+        self.poller = None
+        if args.poll:
+            poll_args = job_poller.arg_parser().parse_args(['--backend', \
+                        'executor', '--db', args.db, '--template', \
+                        args.template, '--rate', '100', '--burst', '100'])
+            self.poller = job_poller.JobPoller(poll_args, self.backend)
+
+    def job_dirs(self, states):
+        """
+        @returns job directories in the given states, oldest first
+        """
+        names = [name for name in os.listdir(self.args.spool) \
+                 if get_executor_state(os.path.join(self.args.spool, name)) \
+                    in states]
+        names.sort(key=lambda name: int(name.split('-')[-1]))
+        return [os.path.join(self.args.spool, name) for name in names]
+
+    def job_command(self, job_dir):
+        """
+        @returns the command executing one job
+        """
+        return ' '.join([sys.executable, os.path.abspath(__file__), \
+                         'execute', os.path.abspath(job_dir), \
+                         '--scratch', os.path.abspath(self.args.scratch), \
+                         '--local-se', os.path.abspath(self.args.local_se)]+\
+                        ['--keep-scratch']*self.args.keep_scratch)
+
+    def start_jobs(self):
+        """
+        Start waiting jobs while there is room
+
+        @returns number of jobs started
+        """
+        for job_dir, child in self.children.items():
+            if child.poll() is not None:
+                del self.children[job_dir]
+        in_flight = len(self.job_dirs(['Matched', 'Running']))
+        started = 0
+        for job_dir in self.job_dirs(['Waiting']):
+            if in_flight >= self.args.processes:
+                break
+            set_executor_state(job_dir, 'Matched')
+            command = self.job_command(job_dir)
+            if self.args.batch_command is not None:
+                command = self.args.batch_command.replace('{command}', \
+                                                          command)
+                if subprocess.call(command, shell=True) != 0:
+                    print 'Batch submission failed for', job_dir
+                    set_executor_state(job_dir, 'Waiting')
+                    break
+            else:
+                self.children[job_dir] = subprocess.Popen(command, shell=True)
+            in_flight += 1
+            started += 1
+        return started
+
+    def run(self):
+        """
+        Schedule jobs until the queue is empty, or forever with --follow
+        """
+        while True:
+            started = self.start_jobs()
+            if self.poller is not None:
+                counts = self.poller.poll()
+                if len(counts) > 0 or started > 0:
+                    print time.strftime("%Y-%m-%d %H:%M:%S"), \
+                          'started:'+str(started), \
+                          ' '.join([status+':'+str(number) for \
+                                    status, number in sorted(counts.items())])
+            idle = len(self.job_dirs(['Waiting', 'Matched', 'Running'])) == 0
+            if idle and not self.args.follow:
+                break
+            time.sleep(self.args.interval)
+
+def main(argv):
+    """
+    Command line interface - see DESCRIPTION
+    """
+    args = arg_parser().parse_args(argv)
+    if args.command == 'execute':
+        if args.job_dir is None:
+            print 'execute needs a job directory'
+            return 1
+        return execute(args.job_dir, args.scratch, args.local_se, \
+                       args.keep_scratch)
+    if not os.path.isdir(args.spool):
+        print 'No job spool', args.spool
+        return 1
+    Executor(args).run()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+"""
+Local index of the run metadata reconstruction jobs need
+"""
+
+DESCRIPTION = """
+Keep a local sqlite index of whether each run has what its reconstruction job
+will download: a beamline entry, a geometry valid at the start of the run and
+a SciFi calibration. Jobs for runs missing any of these fail after setup, so
+they are rejected before submission (submit_jobs.py --metadata-index) and
+again at job start, before any download (execute_data_recon.py
+--metadata-index, with the index shipped in the input sandbox).
+
+"update" looks up runs that are not in the index yet. Settings and start time
+come from runinfo.sqlite (--runinfo); beamline entries of runs missing there,
+geometry and SciFi calibration are asked from the CDB. Each item is stored as
+1 (available), 0 (missing) or NULL (the CDB could not be asked). Runs with a
+NULL are looked up again next time, runs with a 0 once they were checked more
+than --recheck-days ago (a geometry may be uploaded late). After the first CDB
+error no more runs are looked up.
+
+"geometry" records whether MC geometry IDs can be downloaded, for
+execute_MC.py --metadata-index. submit_jobs.py --metadata-index --mc-serial
+does the same for the geometry of the MC cards before submitting.
+
+"check" prints the problems of runs; its return code is 4 if any run would be
+rejected, as execute_data_recon.py returns for such a run.
+
+Usage:
+    metadata_index.py update [--runinfo runinfo.sqlite] <runs or run lists>
+    metadata_index.py check <runs or run lists>
+    metadata_index.py geometry <geometry IDs>
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import affinity
+from proddb import now_string, to_seconds
+
+DEFAULT_INDEX = "../../MICEprodDB/metadata_index.sqlite"
+
+# name of the index in the input sandbox, as execute_data_recon.py expects it
+SANDBOX_INDEX = "metadata_index.sqlite"
+
+# return code of execute_data_recon.py / execute_MC.py for a rejected run
+INVALID_CODE = 4
+
+# SciFi calibration as get_scifi_calib.py downloads it
+SCIFI_DEVICE = 'Trackers'
+SCIFI_CALIBRATION_TYPE = 'trigger'
+
+ITEMS = [('beamline', 'no beamline entry in the CDB'), \
+         ('geometry', 'no geometry valid at the run start'), \
+         ('scifi_calibration', 'no SciFi calibration')]
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['update', 'check', 'geometry'])
+    parser.add_argument('items', nargs='+', \
+                        help='Runs, ranges, run list files or geometry IDs')
+    parser.add_argument('--runinfo', dest='runinfo', \
+                        default=affinity.DEFAULT_RUNINFO, \
+                        help='runinfo.sqlite')
+    parser.add_argument('--cdb', dest='cdb_url', default=affinity.CDBURL, \
+                        help='Configuration database URL')
+    add_index_options(parser)
+    return parser
+
+def add_index_options(parser):
+    """
+    Options shared with submit_jobs.py
+    """
+    parser.add_argument('--metadata-index', dest='metadata_index', \
+                        default=None, help='Run metadata index (default '+\
+                        DEFAULT_INDEX+'; submit_jobs.py: no checks)')
+    parser.add_argument('--recheck-days', dest='recheck_days', type=float, \
+                        default=1., help='Look up missing metadata again '+\
+                                         'after this many days')
+
+def cards_geometry_id(cards):
+    """
+    @param cards MC datacards text
+    @returns the geometry_download_id set in the cards, or None
+    """
+    match = re.search(r'^\s*geometry_download_id\s*=\s*[\'"]?(\w+)', \
+                      cards or '', re.MULTILINE)
+    if match is None:
+        return None
+    return match.group(1)
+
+def run_problems(row):
+    """
+    @param row dict of ITEMS keys to 1, 0 or None
+    @returns list of the reasons a run cannot be reconstructed
+    """
+    return [problem for key, problem in ITEMS if row.get(key) == 0]
+
+class MetadataIndex:
+    """
+    MetadataIndex holds the runs and geometries tables of the index
+    """
+
+    def __init__(self, index_file=DEFAULT_INDEX):
+        """
+        @param index_file sqlite file, created if needed
+        """
+        self.index = sqlite3.connect(index_file)
+        self.create_tables()
+
+    def create_tables(self):
+        """
+        Create the runs and geometries tables
+        """
+        self.index.execute("CREATE TABLE IF NOT EXISTS runs(\
+                run INTEGER PRIMARY KEY,\
+                beamline INTEGER,\
+                geometry_id STRING,\
+                geometry INTEGER,\
+                scifi_calibration INTEGER,\
+                checked DATE)\
+                ")
+        self.index.execute("CREATE TABLE IF NOT EXISTS geometries(\
+                geometry_id STRING PRIMARY KEY,\
+                available INTEGER,\
+                checked DATE)\
+                ")
+        self.index.commit()
+
+    def lookup(self, runs):
+        """
+        @returns dict of run to dict of runs columns, for indexed runs
+        """
+        columns = ['beamline', 'geometry_id', 'geometry', \
+                   'scifi_calibration', 'checked']
+        rows = {}
+        runs = [int(run) for run in runs]
+        for start in range(0, len(runs), 500):
+            bulk = runs[start:start+500]
+            query = "SELECT run, "+', '.join(columns)+" FROM runs WHERE \
+                     run IN ("+','.join(['?']*len(bulk))+")"
+            for row in self.index.execute(query, bulk).fetchall():
+                rows[row[0]] = dict(zip(columns, row[1:]))
+        return rows
+
+    def stale(self, row, recheck_days):
+        """
+        @returns True if a run has to be looked up (again)
+        """
+        if row is None:
+            return True
+        values = [row[key] for key, problem in ITEMS]
+        if None in values:
+            return True
+        return 0 in values and \
+               time.time()-to_seconds(row['checked']) > recheck_days*24*3600
+
+    def update(self, runs, runinfo_db, cdb_url, recheck_days):
+        """
+        Look up runs that are missing from the index or stale
+
+        @returns number of runs looked up
+        """
+        runs = [int(run) for run in runs]
+        known = self.lookup(runs)
+        todo = [run for run in runs if self.stale(known.get(run), recheck_days)]
+        if len(todo) == 0:
+            return 0
+        info = {}
+        if runinfo_db is not None and os.path.exists(runinfo_db):
+            info = affinity.read_run_info(runinfo_db, todo)
+        lookup = CdbLookup(cdb_url)
+        rows = []
+        for run in todo:
+            row = lookup.run_metadata(run, info.get(run))
+            if lookup.failed:
+                print 'CDB lookups stopped at run', run
+                break
+            rows.append((run, row['beamline'], row['geometry_id'], \
+                         row['geometry'], row['scifi_calibration'], \
+                         now_string()))
+        with self.index:
+            self.index.executemany("INSERT OR REPLACE INTO runs VALUES \
+                                   (?,?,?,?,?,?)", rows)
+        return len(rows)
+
+    def validate(self, runs):
+        """
+        Split runs into those that can be reconstructed and those that cannot;
+        runs not in the index are not rejected
+
+        @returns (list of valid runs, dict of rejected run to problems)
+        """
+        rows = self.lookup(runs)
+        valid = []
+        rejected = {}
+        for run in runs:
+            problems = run_problems(rows.get(int(run), {}))
+            if len(problems) > 0:
+                rejected[run] = problems
+            else:
+                valid.append(run)
+        return valid, rejected
+
+    def update_geometries(self, geometry_ids, cdb_url):
+        """
+        Record whether MC geometry IDs can be downloaded
+        """
+        lookup = CdbLookup(cdb_url)
+        rows = []
+        for geometry_id in geometry_ids:
+            available = lookup.geometry_available(geometry_id)
+            if lookup.failed:
+                break
+            rows.append((str(geometry_id), available, now_string()))
+        with self.index:
+            self.index.executemany("INSERT OR REPLACE INTO geometries VALUES \
+                                   (?,?,?)", rows)
+        return len(rows)
+
+    def geometry_problems(self, geometry_id):
+        """
+        @returns list of reasons jobs using the geometry cannot run; empty if
+                 the geometry is fine or is not in the index
+        """
+        row = self.index.execute("SELECT available FROM geometries WHERE \
+                                 geometry_id = ?", \
+                                 (str(geometry_id),)).fetchone()
+        if row is None or row[0] != 0:
+            return []
+        return ['geometry '+str(geometry_id)+' cannot be downloaded']
+
+class CdbLookup:
+    """
+    CdbLookup asks the CDB for run metadata, remembering the first failure
+    """
+
+    def __init__(self, cdb_url):
+        """
+        @param cdb_url configuration database URL
+        """
+        self.cdb_url = cdb_url
+        self.failed = False
+        self._services = {}
+
+    def service(self, name):
+        """
+        @returns the cdb client of the given class, made on first use
+        """
+        if name not in self._services:
+            import cdb
+            self._services[name] = getattr(cdb, name)(self.cdb_url)
+        return self._services[name]
+
+    def ask(self, function):
+        """
+        Call function unless a CDB call failed before
+
+        @returns the result, or None if the CDB could not be asked
+        """
+        if self.failed:
+            return None
+        try:
+            return function()
+        except Exception: # pylint: disable = W0703
+            print 'CDB lookup failed:', sys.exc_info()[1]
+            self.failed = True
+            return None
+
+    def run_metadata(self, run, run_info):
+        """
+        @param run_info runinfo.sqlite columns of the run, or None
+        @returns dict of ITEMS keys to 1, 0 or None, and geometry_id
+        """
+        row = {'beamline':None, 'geometry':None, 'geometry_id':None, \
+               'scifi_calibration':None}
+        start = None
+        if run_info is not None:
+            row['beamline'] = 1
+            start = run_info['start']
+        else:
+            beamline = self.ask(lambda: \
+                  self.service('Beamline').get_beamline_for_run(run).get(run))
+            if self.failed:
+                return row
+            row['beamline'] = int(beamline is not None)
+            if beamline is None:
+                row['geometry'] = 0
+            else:
+                start = beamline.get('start_time')
+        try:
+            if start is not None:
+                affinity.parse_start_time(start)
+        except ValueError:
+            # left NULL, so the run is looked up again; not a CDB failure
+            print 'Cannot parse the start time of run', run, start
+            start = None
+        if start is not None:
+            row['geometry_id'] = self.ask(lambda: affinity.lookup_geometry_id( \
+                                          self.service('Geometry'), start))
+            if not self.failed:
+                row['geometry'] = int(row['geometry_id'] is not None)
+        calibration = self.ask(lambda: \
+                    self.service('Calibration').get_calibration_for_run( \
+                              SCIFI_DEVICE, run, SCIFI_CALIBRATION_TYPE))
+        if not self.failed:
+            row['scifi_calibration'] = int(bool(calibration))
+        return row
+
+    def geometry_available(self, geometry_id):
+        """
+        @returns 1 if the geometry can be downloaded, 0 if not, None if the CDB
+                 could not be asked
+        """
+        gdml = self.ask(lambda: \
+                        self.service('Geometry').get_gdml_for_id(geometry_id))
+        if self.failed:
+            return None
+        return int(bool(gdml))
+
+    def mc_geometry_id(self, mc_serial):
+        """
+        @returns the geometry_download_id of the MC cards of an MC serial
+                 number, or None if the cards do not set one or the CDB could
+                 not be asked
+        """
+        cards = self.ask(lambda: self.service('MCSerialNumber').get_datacards( \
+                                                         mc_serial)['data'])
+        if self.failed or cards == 'null':
+            return None
+        return cards_geometry_id(cards)
+
+def read_items(items):
+    """
+    @returns run numbers from runs, ranges and run list files
+    """
+    from submit_jobs import parse_items
+    runs = []
+    for item in items:
+        if os.path.isfile(item):
+            with open(item) as run_list:
+                runs += [int(word) for word in run_list.read().split()]
+        else:
+            runs += parse_items([item])
+    return runs
+
+def main(argv):
+    """
+    Command line interface - see DESCRIPTION
+    """
+    args = arg_parser().parse_args(argv)
+    index = MetadataIndex(args.metadata_index or DEFAULT_INDEX)
+    if args.command == 'geometry':
+        print 'Checked', index.update_geometries(args.items, args.cdb_url), \
+              'geometries'
+        return 0
+    runs = read_items(args.items)
+    if args.command == 'update':
+        print 'Looked up', index.update(runs, args.runinfo, args.cdb_url, \
+                                        args.recheck_days), 'runs'
+        return 0
+    valid, rejected = index.validate(runs)
+    for run in sorted(rejected.keys()):
+        print run, '; '.join(rejected[run])
+    print len(valid), 'valid,', len(rejected), 'rejected'
+    if len(rejected) > 0:
+        return INVALID_CODE
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,165 @@
+"""
+Access to the production database table job_info2
+
+job_info2 is the table the submission scripts have always written to:
+    datetime, prodID, dir_name, jdl_name, ID, lfc_name, retry_count, status
+The python tools add an "argument" column holding the argument the job was
+submitted with (chunk or run number), so a job can be resubmitted without its
+job directory. Columns are only ever added, never changed, so the shell
+scripts and existing queries keep working.
+
+Status values are those of DIRAC (Received, Waiting, Running, Done, Failed,
+...) plus the ones set by job_poller.py:
+    Finished    - the job returned 0
+    Retry       - transient failure, to be resubmitted after next_retry
+    Resubmitted - superseded by a newer row for the same argument
+    Parked      - failed for good, waiting for an expert
+    Killed      - another copy of the job finished first
+"""
+
+import sqlite3
+import time
+
+DEFAULT_DB = "../../MICEprodDB/MICEprodDB_dirac_sqlite.db"
+
+# columns added by the python tools, with their types
+EXTRA_COLUMNS = [('argument', 'STRING'), ('exit_code', 'INTEGER'), \
+                 ('site', 'STRING'), ('next_retry', 'DATE'), \
+                 ('updated', 'DATE'), ('started', 'DATE'), \
+                 ('speculative', 'INTEGER')]
+
+# statuses after which the poller has nothing more to do with a row
+FINAL_STATUSES = ['Finished', 'Resubmitted', 'Parked', 'Killed', 'Deleted']
+
+INDEXES = {'job_info2_id':'ID', 'job_info2_status':'status', \
+           'job_info2_argument':'prodID, argument'}
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def now_string(offset=0):
+    """
+    @returns local time plus offset seconds, as job_info2 stores it
+    """
+    return time.strftime(TIME_FORMAT, time.localtime(time.time()+offset))
+
+def to_seconds(time_string):
+    """
+    @returns seconds since the epoch of a job_info2 time string
+    """
+    return time.mktime(time.strptime(time_string, TIME_FORMAT))
+
+class ProdDB:
+    """
+    ProdDB wraps the job_info2 table of the production database
+    """
+
+    def __init__(self, db_name=DEFAULT_DB):
+        """
+        Open the database and make sure job_info2 has the columns we need
+        """
+        self.proddb = sqlite3.connect(db_name)
+        self.create_table()
+
+    def create_table(self):
+        """
+        Create job_info2 if it does not exist; add missing extra columns
+        """
+        self.proddb.execute("CREATE TABLE IF NOT EXISTS job_info2(\
+                datetime STRING,\
+                prodID STRING,\
+                dir_name STRING,\
+                jdl_name STRING,\
+                ID STRING,\
+                lfc_name STRING,\
+                retry_count INTEGER,\
+                status STRING)\
+                ")
+        columns = [row[1] for row in \
+                   self.proddb.execute("PRAGMA table_info(job_info2)")]
+        for name, column_type in EXTRA_COLUMNS:
+            if name not in columns:
+                self.proddb.execute("ALTER TABLE job_info2 ADD COLUMN "+\
+                                    name+" "+column_type)
+        for index, columns in INDEXES.items():
+            self.proddb.execute("CREATE INDEX IF NOT EXISTS "+index+\
+                                " ON job_info2("+columns+")")
+        self.proddb.commit()
+
+    def insert_jobs(self, jobs):
+        """
+        Insert submitted jobs in one transaction
+
+        @param jobs list of dicts with keys prodID, dir_name, jdl_name, ID,
+               lfc_name, argument; retry_count defaults to 1, status to
+               'Submitted' and speculative to 0
+        """
+        now = now_string()
+        rows = [(now, job['prodID'], job['dir_name'], job['jdl_name'], \
+                 job['ID'], job['lfc_name'], job.get('retry_count', 1), \
+                 job.get('status', 'Submitted'), job['argument'], \
+                 job.get('speculative', 0)) for job in jobs]
+        with self.proddb:
+            self.proddb.executemany("INSERT INTO job_info2(datetime, prodID, \
+                dir_name, jdl_name, ID, lfc_name, retry_count, status, \
+                argument, speculative) VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+        return len(rows)
+
+    def active_jobs(self, prod_id=None):
+        """
+        @returns list of dicts for rows the poller still has to follow
+        """
+        query = "SELECT rowid, prodID, dir_name, jdl_name, ID, lfc_name, \
+                 retry_count, status, argument, next_retry, site, started, \
+                 speculative FROM job_info2 \
+                 WHERE status NOT IN ("+','.join(['?']*len(FINAL_STATUSES))+")"
+        values = list(FINAL_STATUSES)
+        if prod_id is not None:
+            query += " AND prodID = ?"
+            values.append(prod_id)
+        keys = ['rowid', 'prodID', 'dir_name', 'jdl_name', 'ID', 'lfc_name', \
+                'retry_count', 'status', 'argument', 'next_retry', 'site', \
+                'started', 'speculative']
+        jobs = [dict(zip(keys, row)) for row in \
+                self.proddb.execute(query, values).fetchall()]
+        # STRING columns have numeric affinity, so IDs come back as integers
+        for job in jobs:
+            job['ID'] = str(job['ID'])
+            if job['argument'] is not None:
+                job['argument'] = str(job['argument'])
+        return jobs
+
+    def update_jobs(self, updates):
+        """
+        Update rows in one transaction
+
+        @param updates list of (rowid, {column:value})
+        """
+        by_columns = {}
+        for rowid, values in updates:
+            columns = tuple(sorted(values.keys()))
+            by_columns.setdefault(columns, []).append((rowid, values))
+        now = now_string()
+        with self.proddb:
+            for columns, column_updates in by_columns.items():
+                rows = [[values[column] for column in columns]+[now, rowid] \
+                        for (rowid, values) in column_updates]
+                self.proddb.executemany("UPDATE job_info2 SET "+\
+                    ', '.join([column+' = ?' for column in columns])+\
+                    ", updated = ? WHERE rowid = ?", rows)
+        return len(updates)
+
+    def finished_runtimes(self, prod_id=None):
+        """
+        @returns list of (argument, seconds) of finished jobs whose start was
+                 seen by the poller
+        """
+        query = "SELECT argument, started, updated FROM job_info2 WHERE \
+                 status = 'Finished' AND started IS NOT NULL AND \
+                 updated IS NOT NULL"
+        values = []
+        if prod_id is not None:
+            query += " AND prodID = ?"
+            values.append(prod_id)
+        return [(str(argument), to_seconds(updated)-to_seconds(started)) \
+                for (argument, started, updated) in \
+                self.proddb.execute(query, values).fetchall()]
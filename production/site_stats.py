@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+"""
+Per-site job statistics, and the ban list and site ranking made from them
+"""
+
+DESCRIPTION = """
+Keep per-site statistics of finished jobs and turn them into the BannedSites
+list and a preferred-site ranking for the next submission round.
+
+"harvest" adds the jobs that ended since the last harvest (job_info2 rows with
+a site and a final status, as written by job_poller.py) to the site_jobs table
+of the production database. From the std.out/std.err fetched by the poller
+into --output-dir/<job ID>/ it reads
+  - the wall clock time of the MAUS step (\\time -v);
+  - the "Stage-in/Stage-out bytes = N seconds = S" lines of the job scripts.
+The work of a job is its number of triggers in runinfo.sqlite (--runinfo,
+reconstruction) or one unit per job (MC).
+
+"summary" prints, per site over the last --window-days, the number of jobs,
+success rate, work per second of wall time and stage-in/out bandwidth.
+"bans" prints the sites that would be banned. A site is banned when it has at
+least --min-jobs jobs in the window and
+  - its success rate is below --min-success, or
+  - its throughput (work per second including stage-in and stage-out) is
+    below --min-speed times the median of all sites.
+Sites come back once their bad jobs age out of the window; sites without
+statistics are never banned, so they get jobs and are measured.
+
+submit_jobs.py --site-stats harvests and applies the bans (and with
+--preferred-sites N the N best sites) to the JDL of each submission round.
+"""
+
+import argparse
+import os
+import re
+import sys
+
+import backends
+from proddb import ProdDB, DEFAULT_DB, now_string
+from stragglers import argument_work, median
+
+# job_info2 statuses of jobs that ran to an end the poller understood
+ENDED_STATUSES = ['Finished', 'Parked', 'Retry', 'Resubmitted']
+
+_WALL_RE = re.compile(r'Elapsed \(wall clock\) time \(h:mm:ss or m:ss\): '+\
+                      r'([\d:.]+)')
+_STAGE_RE = re.compile(r'Stage-(in|out) bytes = (\d+) seconds = (\d+)')
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['harvest', 'summary', 'bans'])
+    parser.add_argument('--db', dest='db', default=DEFAULT_DB, \
+                        help='Production database')
+    add_site_options(parser)
+    return parser
+
+def add_site_options(parser):
+    """
+    Options shared with submit_jobs.py
+    """
+    parser.add_argument('--output-dir', dest='output_dir', \
+                        default='job_outputs', \
+                        help='Where job_poller.py fetched the job outputs')
+    parser.add_argument('--runinfo', dest='runinfo', default=None, \
+                        help='runinfo.sqlite; jobs are weighted by triggers')
+    parser.add_argument('--window-days', dest='window_days', type=float, \
+                        default=7., help='Statistics window [days]')
+    parser.add_argument('--min-jobs', dest='min_jobs', type=int, default=5, \
+                        help='Jobs needed in the window to judge a site')
+    parser.add_argument('--min-success', dest='min_success', type=float, \
+                        default=0.5, help='Ban below this success rate')
+    parser.add_argument('--min-speed', dest='min_speed', type=float, \
+                        default=0.25, \
+                        help='Ban below this fraction of the median '+\
+                             'throughput')
+
+def parse_wall_seconds(text):
+    """
+    @returns wall clock seconds from \\time -v output, or None
+    """
+    match = None
+    for match in _WALL_RE.finditer(text):
+        pass
+    if match is None:
+        return None
+    seconds = 0.
+    for field in match.group(1).split(':'):
+        seconds = seconds*60+float(field)
+    return seconds
+
+def parse_stages(text):
+    """
+    @returns dict of 'in'/'out' to (bytes, seconds), summed over the job
+    """
+    stages = {}
+    for match in _STAGE_RE.finditer(text):
+        n_bytes, seconds = stages.get(match.group(1), (0, 0))
+        stages[match.group(1)] = (n_bytes+int(match.group(2)), \
+                                  seconds+int(match.group(3)))
+    return stages
+
+def read_job_output(output_dir, job_id):
+    """
+    @returns std.out and std.err text of a job, empty if not fetched
+    """
+    text = ''
+    for name in ['std.out', 'std.err']:
+        file_name = os.path.join(output_dir, str(job_id), name)
+        if os.path.isfile(file_name):
+            with open(file_name) as output:
+                text += output.read()
+    return text
+
+class SiteStats:
+    """
+    SiteStats keeps one row per ended job in the site_jobs table
+    """
+
+    def __init__(self, prod_db):
+        """
+        @param prod_db ProdDB instance; site_jobs lives in the same database
+        """
+        self.prod_db = prod_db
+        self.proddb = prod_db.proddb
+        self.create_table()
+
+    def create_table(self):
+        """
+        Create the site_jobs table
+        """
+        self.proddb.execute("CREATE TABLE IF NOT EXISTS site_jobs(\
+                ID STRING PRIMARY KEY,\
+                site STRING,\
+                prodID STRING,\
+                argument STRING,\
+                success INTEGER,\
+                exit_code INTEGER,\
+                work REAL,\
+                wall_seconds REAL,\
+                stagein_bytes INTEGER,\
+                stagein_seconds INTEGER,\
+                stageout_bytes INTEGER,\
+                stageout_seconds INTEGER,\
+                ended DATE)\
+                ")
+        self.proddb.execute("CREATE INDEX IF NOT EXISTS site_jobs_ended ON \
+                site_jobs(ended)")
+        self.proddb.commit()
+
+    def harvest(self, output_dir, runinfo=None):
+        """
+        Add jobs that ended since the last harvest
+
+        @returns number of jobs added
+        """
+        query = "SELECT ID, site, prodID, argument, status, exit_code, \
+                 started, updated FROM job_info2 WHERE site IS NOT NULL AND \
+                 site != '' AND status IN ("+\
+                 ','.join(['?']*len(ENDED_STATUSES))+") AND \
+                 ID NOT IN (SELECT ID FROM site_jobs)"
+        jobs = self.proddb.execute(query, ENDED_STATUSES).fetchall()
+        work = {}
+        if runinfo is not None:
+            work = argument_work(runinfo, [str(job[3]) for job in jobs \
+                                           if job[3] is not None])
+        rows = []
+        for job_id, site, prod_id, argument, status, exit_code, started, \
+            updated in jobs: # pylint: disable = W0612
+            text = read_job_output(output_dir, job_id)
+            stages = parse_stages(text)
+            success = int(status == 'Finished')
+            rows.append((job_id, site, str(prod_id), str(argument), \
+                         success, exit_code, work.get(str(argument), 1), \
+                         parse_wall_seconds(text), \
+                         stages.get('in', (None, None))[0], \
+                         stages.get('in', (None, None))[1], \
+                         stages.get('out', (None, None))[0], \
+                         stages.get('out', (None, None))[1], updated))
+        with self.proddb:
+            self.proddb.executemany("INSERT OR REPLACE INTO site_jobs \
+                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+        return len(rows)
+
+    def summary(self, window_days):
+        """
+        Per-site statistics over the window
+
+        @returns dict of site to dict with keys jobs, success_rate,
+                 work_per_second (MAUS wall time only), throughput (including
+                 stage-in/out), stagein_bandwidth, stageout_bandwidth [B/s];
+                 values are None where nothing was measured
+        """
+        since = now_string(-window_days*24*3600)
+        rows = self.proddb.execute("SELECT site, success, work, wall_seconds, \
+                stagein_bytes, stagein_seconds, stageout_bytes, \
+                stageout_seconds FROM site_jobs WHERE ended >= ?", \
+                (since,)).fetchall()
+        sums = {}
+        for row in rows:
+            site = row[0]
+            if site not in sums:
+                sums[site] = [0]*10
+            total = sums[site]
+            total[0] += 1
+            total[1] += row[1]
+            if row[1] and row[3] is not None:
+                total[2] += row[2]
+                total[3] += row[3]
+                total[4] += (row[5] or 0)+(row[7] or 0)
+            for i, (n_bytes, seconds) in enumerate([(row[4], row[5]), \
+                                                    (row[6], row[7])]):
+                if n_bytes is not None and seconds is not None:
+                    total[5+2*i] += n_bytes
+                    total[6+2*i] += seconds
+        stats = {}
+        for site, total in sums.items():
+            stats[site] = {'jobs':total[0], \
+                           'success_rate':float(total[1])/total[0], \
+                           'work_per_second':ratio(total[2], total[3]), \
+                           'throughput':ratio(total[2], total[3]+total[4]), \
+                           'stagein_bandwidth':ratio(total[5], total[6]), \
+                           'stageout_bandwidth':ratio(total[7], total[8])}
+        return stats
+
+def ratio(numerator, denominator):
+    """
+    @returns numerator/denominator, or None if nothing was measured
+    """
+    if denominator <= 0:
+        return None
+    return float(numerator)/denominator
+
+def ban_list(stats, min_jobs, min_success, min_speed):
+    """
+    @returns sorted list of sites to ban
+    """
+    speeds = [site_stats['throughput'] for site_stats in stats.values() \
+              if site_stats['throughput'] is not None]
+    median_speed = None
+    if len(speeds) > 0:
+        median_speed = median(speeds)
+    banned = []
+    for site, site_stats in stats.items():
+        if site_stats['jobs'] < min_jobs:
+            continue
+        if site_stats['success_rate'] < min_success:
+            banned.append(site)
+        elif median_speed is not None and \
+             site_stats['throughput'] is not None and \
+             site_stats['throughput'] < min_speed*median_speed:
+            banned.append(site)
+    return sorted(banned)
+
+def ranking(stats, banned=None):
+    """
+    Rank sites by expected good work per second: success rate times
+    throughput. Sites without a throughput measurement come last.
+
+    @returns list of sites, best first
+    """
+    if banned is None:
+        banned = []
+    def score(site):
+        """Expected useful throughput of a site"""
+        if stats[site]['throughput'] is None:
+            return -1.
+        return stats[site]['success_rate']*stats[site]['throughput']
+    return sorted([site for site in stats if site not in banned], \
+                  key=score, reverse=True)
+
+def site_template(template, stats, args, preferred_sites=0):
+    """
+    Apply the automatic ban list, and optionally a preferred site list, to a
+    JDL template
+
+    The automatic bans are added to the hand-made BannedSites list of the
+    template, which is kept; preferred sites are chosen from the sites banned
+    by neither.
+
+    @returns the JDL template for this submission round
+    """
+    if len(stats) == 0:
+        return template
+    banned = ban_list(stats, args.min_jobs, args.min_success, args.min_speed)
+    template = backends.ban_sites(template, banned)
+    if preferred_sites > 0:
+        all_banned = backends.get_jdl_value(template, 'BannedSites') or []
+        preferred = ranking(stats, all_banned)[:preferred_sites]
+        if len(preferred) > 0:
+            template = backends.set_jdl_list(template, 'Site', preferred)
+    print 'Banned sites:', ', '.join(banned)
+    return template
+
+def main(argv):
+    """
+    Command line interface - see DESCRIPTION
+    """
+    args = arg_parser().parse_args(argv)
+    site_stats = SiteStats(ProdDB(args.db))
+    if args.command == 'harvest':
+        print 'Harvested', site_stats.harvest(args.output_dir, args.runinfo), \
+              'jobs'
+        return 0
+    stats = site_stats.summary(args.window_days)
+    if args.command == 'bans':
+        for site in ban_list(stats, args.min_jobs, args.min_success, \
+                             args.min_speed):
+            print site
+        return 0
+    print 'site jobs success work/s throughput stage-in[B/s] stage-out[B/s]'
+    for site in ranking(stats):
+        print site, ' '.join([str(stats[site][key]) for key in \
+            ['jobs', 'success_rate', 'work_per_second', 'throughput', \
+             'stagein_bandwidth', 'stageout_bandwidth']])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
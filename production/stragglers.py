@@ -0,0 +1,192 @@
+"""
+Spot straggler jobs and launch speculative duplicates of them
+
+A job is a straggler when it has been running for more than
+    factor * predicted runtime + margin
+The predicted runtime is the work of the job times the median seconds per
+unit of work of the jobs of the same production that already finished:
+  - for reconstruction the work of a job is the number of triggers in
+    runinfo.sqlite of its run (or runs, for a group "run,run,...");
+  - for MC every chunk is one unit of work.
+Until enough jobs finished, a default seconds per unit is used.
+
+A straggler gets one duplicate, submitted with the straggler's site added to
+BannedSites so that it runs elsewhere. The duplicate is a new job_info2 row
+with speculative = 1 for the same argument. job_poller.py cancels the other
+copies as soon as one of them finishes successfully; on the storage side the
+job scripts do not upload an output whose .processed semaphore is already
+there.
+"""
+
+import sqlite3
+import time
+
+import backends
+from proddb import to_seconds
+
+DEFAULT_RUNINFO = "../runinfo/runinfo.sqlite"
+
+def read_triggers(runinfo_db, runs):
+    """
+    @returns dict of run number (string) to number of triggers
+    """
+    runs = [int(run) for run in runs]
+    triggers = {}
+    connection = sqlite3.connect(runinfo_db)
+    for start in range(0, len(runs), 500):
+        bulk = runs[start:start+500]
+        query = "SELECT run, triggers FROM runinfo WHERE run IN ("+\
+                ','.join(['?']*len(bulk))+")"
+        for run, n_triggers in connection.execute(query, bulk).fetchall():
+            triggers[str(run)] = n_triggers
+    connection.close()
+    return triggers
+
+def argument_work(runinfo_db, arguments):
+    """
+    @returns dict of job argument to the triggers of its runs
+    """
+    runs = set()
+    for argument in arguments:
+        runs.update(str(argument).split(','))
+    triggers = read_triggers(runinfo_db, runs)
+    return dict([(argument, sum([triggers.get(run) or 0 for run in \
+                                 str(argument).split(',')])) \
+                 for argument in arguments])
+
+def median(values):
+    """
+    @returns the median of a non-empty list
+    """
+    values = sorted(values)
+    middle = len(values)/2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle-1]+values[middle])/2.
+
+class RuntimePredictor: # pylint: disable = R0903
+    """
+    RuntimePredictor predicts job runtimes from the work each job has to do
+    """
+
+    def __init__(self, work, default_seconds_per_unit, min_samples=5):
+        """
+        @param work dict of job argument to units of work; missing arguments
+               count as one unit
+        @param default_seconds_per_unit used until min_samples jobs finished
+        """
+        self.work = work
+        self.seconds_per_unit = default_seconds_per_unit
+        self.default_seconds_per_unit = default_seconds_per_unit
+        self.min_samples = min_samples
+
+    def fit(self, runtimes):
+        """
+        Update seconds per unit of work from finished jobs
+
+        @param runtimes list of (argument, seconds)
+        """
+        rates = [seconds/self.work.get(argument, 1) for argument, seconds \
+                 in runtimes if self.work.get(argument, 1) > 0]
+        if len(rates) >= self.min_samples:
+            self.seconds_per_unit = median(rates)
+        else:
+            self.seconds_per_unit = self.default_seconds_per_unit
+
+    def predict(self, argument):
+        """
+        @returns predicted runtime in seconds
+        """
+        return self.seconds_per_unit*max(1, self.work.get(argument, 1))
+
+def find_stragglers(jobs, predictor, factor, margin, now=None):
+    """
+    @returns running jobs past factor * prediction + margin that do not have a
+             live duplicate yet
+    """
+    if now is None:
+        now = time.time()
+    copies = {}
+    for job in jobs:
+        key = (job['prodID'], job['argument'])
+        copies[key] = copies.get(key, 0)+1
+    stragglers = []
+    for job in jobs:
+        if job['status'] != 'Running' or job['started'] is None or \
+           copies[(job['prodID'], job['argument'])] > 1:
+            continue
+        elapsed = now-to_seconds(job['started'])
+        if elapsed > factor*predictor.predict(job['argument'])+margin:
+            stragglers.append(job)
+    return stragglers
+
+class StragglerMonitor:
+    """
+    StragglerMonitor submits speculative duplicates of straggler jobs
+    """
+
+    def __init__(self, args, backend, prod_db, bucket):
+        """
+        @param args parsed job_poller.py arguments
+        @param backend backend used for the duplicates
+        @param prod_db ProdDB instance
+        @param bucket TokenBucket shared with the poller
+        """
+        self.args = args
+        self.backend = backend
+        self.prod_db = prod_db
+        self.bucket = bucket
+        self.work = {}
+        self.predictor = RuntimePredictor(self.work, args.seconds_per_unit)
+
+    def update_work(self, jobs):
+        """
+        Look up the triggers of runs not seen before (reconstruction only)
+        """
+        if self.args.runinfo is None:
+            return
+        new_arguments = set([job['argument'] for job in jobs \
+                        if job['argument'] is not None and \
+                           job['argument'] not in self.work])
+        if len(new_arguments) > 0:
+            self.work.update(argument_work(self.args.runinfo, new_arguments))
+
+    def check(self, template, counts):
+        """
+        Submit duplicates of the current stragglers
+
+        The number of live duplicates is kept at most args.max_speculative.
+        """
+        jobs = self.prod_db.active_jobs(self.args.prod_id)
+        self.update_work(jobs)
+        self.predictor.fit(self.prod_db.finished_runtimes(self.args.prod_id))
+        n_live = len([job for job in jobs if job['speculative'] == 1])
+        stragglers = find_stragglers(jobs, self.predictor, \
+                                     self.args.straggler_factor, \
+                                     self.args.straggler_margin)
+        stragglers = stragglers[:max(0, self.args.max_speculative-n_live)]
+        by_site = {}
+        for job in stragglers:
+            by_site.setdefault(job['site'], []).append(job)
+        for site, site_jobs in by_site.items():
+            site_template = template
+            if site:
+                site_template = backends.ban_sites(template, [site])
+            self.bucket.acquire()
+            try:
+                job_ids = self.backend.submit(site_template, \
+                                     [job['argument'] for job in site_jobs])
+            except backends.SubmissionError as error:
+                print 'Speculative submission failed', error
+                continue
+            new_jobs = []
+            for job, job_id in zip(site_jobs, job_ids):
+                new_job = dict(job)
+                new_job['ID'] = job_id
+                new_job['status'] = 'Submitted'
+                new_job['speculative'] = 1
+                new_jobs.append(new_job)
+                print 'Straggler', job['ID'], 'at', site, 'duplicated as', \
+                      job_id
+            self.prod_db.insert_jobs(new_jobs)
+            counts['Speculative'] = counts.get('Speculative', 0)+len(new_jobs)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+"""
+Bulk job submitter for MC and reconstruction production
+"""
+
+DESCRIPTION = """
+Submit one grid job per chunk (MC) or run (reconstruction) from a testMICE JDL
+template, replacing the loop in create_jdl_and_submit.sh.
+
+JDLs are made in memory from the template (AAA is replaced by the chunk or run
+number) and submitted in bulk: the DIRAC backend submits up to --bulk-size jobs
+per dirac-wms-job-submit call as a parametric job. Calls are paced by a token
+bucket (--rate calls per second, bursts of up to --burst calls) instead of a
+fixed sleep per job. The job_info2 rows of each bulk are written in one
+transaction.
+
+Run from the directory holding the template and the input sandbox files.
+
+Chunks or runs are given as arguments, as a range a-b, or (MC) counted from a
+G4BL chunk list with --chunk-list. With --completion-catalogue, runs already
+done for --batch-iteration/--maus-version are dropped first.
+
+With --group-size N (reconstruction), runs that need the same geometry and
+settings are submitted together, up to N runs per job (see affinity.py); the
+job argument is then the comma separated list of runs.
+
+With --metadata-index (reconstruction), runs missing a beamline entry,
+geometry or SciFi calibration are looked up in the run metadata index (see
+metadata_index.py) and not submitted. For MC, --mc-serial (or --geometry-id)
+gives the geometry the jobs will download; it is looked up in the CDB and
+nothing is submitted if it cannot be downloaded. In both cases the index is
+added to the template's InputSandbox as metadata_index.sqlite, so jobs check
+their run or geometry again before downloading anything.
+
+With --site-stats the per-site statistics are harvested first and the
+automatic bans are added to the template's BannedSites list (see
+site_stats.py); --preferred-sites N also restricts the jobs to the N best
+sites.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import affinity
+import backends
+import metadata_index
+from proddb import ProdDB, DEFAULT_DB
+import site_stats
+
+def arg_parser():
+    """
+    Parse command line arguments.
+
+    Use -h switch at the command line for information on command line args used.
+    """
+    parser = argparse.ArgumentParser(description=DESCRIPTION, \
+                           formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('items', nargs='*', \
+                        help='Chunk/run numbers or ranges like 11-250')
+    parser.add_argument('--chunk-list', dest='chunk_list', default=None, \
+                        help='G4BL chunk list (URL or file); submits chunks '+\
+                             '--first-chunk to the last line')
+    parser.add_argument('--first-chunk', dest='first_chunk', type=int, \
+                        default=0, help='First chunk used with --chunk-list')
+    parser.add_argument('--template', dest='template', default='testMICE', \
+                        help='JDL template file')
+    parser.add_argument('--prod-id', dest='prod_id', required=True, \
+                        help='prodID written to job_info2 (e.g. MC serial)')
+    parser.add_argument('--lfc-name', dest='lfc_name', default='', \
+                        help='lfc_name pattern; %%05d is replaced by the '+\
+                             'chunk/run number')
+    parser.add_argument('--db', dest='db', default=DEFAULT_DB, \
+                        help='Production database')
+    parser.add_argument('--backend', dest='backend', default='dirac', \
+                        choices=sorted(backends.BACKENDS.keys()), \
+                        help='Submission backend')
+    parser.add_argument('--bulk-size', dest='bulk_size', type=int, \
+                        default=100, help='Jobs per submission call')
+    parser.add_argument('--rate', dest='rate', type=float, default=0.5, \
+                        help='Sustained submission calls per second')
+    parser.add_argument('--burst', dest='burst', type=int, default=5, \
+                        help='Submission calls allowed back to back')
+    parser.add_argument('--completion-catalogue', dest='completion_catalogue', \
+                        default=None, help='Drop runs done in this catalogue')
+    parser.add_argument('-b', '--batch-iteration', dest='batch_iteration', \
+                        type=int, default=None, \
+                        help='Batch iteration for the completion catalogue')
+    parser.add_argument('-m', '--maus-version', dest='maus_version', \
+                        default=None, \
+                        help='MAUS version for the completion catalogue')
+    parser.add_argument('--lock', dest='lock', default='../submitting', \
+                        help='Flag file present while submitting')
+    parser.add_argument('--site-stats', dest='site_stats', \
+                        action='store_true', default=False, \
+                        help='Ban sites from the measured site statistics')
+    parser.add_argument('--preferred-sites', dest='preferred_sites', \
+                        type=int, default=0, \
+                        help='With --site-stats, only use the N best sites')
+    site_stats.add_site_options(parser)
+    affinity.add_affinity_options(parser)
+    metadata_index.add_index_options(parser)
+    parser.add_argument('--mc-serial', dest='mc_serial', type=int, \
+                        default=None, help='With --metadata-index, check the '+\
+                        'geometry of the cards of this MC serial number')
+    parser.add_argument('--geometry-id', dest='geometry_id', default=None, \
+                        help='With --metadata-index, check this MC geometry '+\
+                             '(if the cards do not set one)')
+    return parser
+
+class TokenBucket: # pylint: disable = R0903
+    """
+    Token bucket rate limiter
+
+    Tokens are added at a steady rate up to a maximum; each call takes one,
+    waiting if the bucket is empty. Short bursts go out at once while the
+    long-term rate stays bounded.
+    """
+
+    def __init__(self, rate, burst, clock=time.time, sleep=time.sleep):
+        """
+        @param rate tokens added per second
+        @param burst maximum number of tokens held
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens, sleeping until they are available
+
+        @returns time spent waiting in seconds
+        """
+        waited = 0.
+        while True:
+            now = self._clock()
+            self.tokens = min(self.burst, \
+                              self.tokens+(now-self._last)*self.rate)
+            self._last = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return waited
+            wait = (tokens-self.tokens)/self.rate
+            self._sleep(wait)
+            waited += wait
+
+def parse_items(items):
+    """
+    @returns list of ints from numbers and inclusive ranges like 11-250
+    """
+    numbers = []
+    for item in items:
+        if '-' in item.strip('-'):
+            first, last = item.split('-')
+            numbers += range(int(first), int(last)+1)
+        else:
+            numbers.append(int(item))
+    return numbers
+
+def count_chunks(chunk_list):
+    """
+    Count the chunks in a G4BL chunk list, downloading it if it is a URL
+
+    @returns number of lines in the list
+    """
+    local_name = os.path.basename(chunk_list)
+    if chunk_list.find('http') >= 0:
+        if os.path.exists(local_name):
+            os.remove(local_name)
+        subprocess.call(['wget', '-q', chunk_list])
+    if not os.path.isfile(local_name):
+        local_name = chunk_list
+    with open(local_name) as list_file:
+        return len(list_file.readlines())
+
+def make_job_rows(arguments, job_ids, prod_id, lfc_name):
+    """
+    @returns job_info2 rows, named as create_jdl_and_submit.sh named them;
+             a group of runs is named after its first run
+    """
+    jobs = []
+    for argument, job_id in zip(arguments, job_ids):
+        first = str(argument).split(',')[0]
+        filenum = first.rjust(5, '0')
+        lfc = lfc_name
+        if '%05d' in lfc_name:
+            lfc = lfc_name % int(first)
+        jobs.append({'prodID':prod_id, 'dir_name':'job_'+filenum, \
+                     'jdl_name':'testMICE_'+filenum+'.jdl', 'ID':job_id, \
+                     'lfc_name':lfc, 'argument':str(argument)})
+    return jobs
+
+def submit(backend, template, arguments, prod_db, prod_id, lfc_name, \
+           bulk_size, bucket, log=None):
+    """
+    Submit arguments in bulks, recording each bulk in job_info2
+
+    A failed bulk is reported and skipped; the others are still submitted.
+
+    @returns list of (argument, job ID) for the jobs submitted
+    """
+    submitted = []
+    for start in range(0, len(arguments), bulk_size):
+        bulk = arguments[start:start+bulk_size]
+        bucket.acquire()
+        try:
+            job_ids = backend.submit(template, bulk)
+        except backends.SubmissionError as error:
+            print 'Failed to submit', bulk[0], 'to', bulk[-1], error
+            continue
+        jobs = make_job_rows(bulk, job_ids, prod_id, lfc_name)
+        prod_db.insert_jobs(jobs)
+        for job in jobs:
+            line = 'JobID = '+job['ID']+' '+job['jdl_name']+' '+job['dir_name']
+            print line
+            if log is not None:
+                log.write(line+'\n')
+        submitted += zip(bulk, job_ids)
+    return submitted
+
+def check_mc_geometry(args):
+    """
+    Record in the metadata index whether the geometry MC jobs will download
+    can be downloaded: the geometry_download_id of the --mc-serial cards, else
+    --geometry-id
+
+    @returns list of reasons the jobs cannot run
+    """
+    index = metadata_index.MetadataIndex(args.metadata_index)
+    geometry_id = None
+    if args.mc_serial is not None:
+        lookup = metadata_index.CdbLookup(args.cdb_url)
+        geometry_id = lookup.mc_geometry_id(args.mc_serial)
+    if geometry_id is None:
+        geometry_id = args.geometry_id
+    if geometry_id is None:
+        return []
+    index.update_geometries([geometry_id], args.cdb_url)
+    return index.geometry_problems(geometry_id)
+
+def sandbox_index(template, index_file):
+    """
+    Copy the metadata index to SANDBOX_INDEX and add it to the InputSandbox
+    of the template
+
+    @returns the new template
+    """
+    if os.path.abspath(index_file) != \
+       os.path.abspath(metadata_index.SANDBOX_INDEX):
+        shutil.copy(index_file, metadata_index.SANDBOX_INDEX)
+    sandbox = backends.get_jdl_value(template, 'InputSandbox') or []
+    if metadata_index.SANDBOX_INDEX not in sandbox:
+        template = backends.set_jdl_list(template, 'InputSandbox', \
+                                   sandbox+[metadata_index.SANDBOX_INDEX])
+    return template
+
+def main(argv):
+    """
+    Work out the arguments to submit and submit them
+    """
+    args = arg_parser().parse_args(argv)
+    arguments = parse_items(args.items)
+    if args.chunk_list is not None:
+        arguments += range(args.first_chunk, count_chunks(args.chunk_list))
+    if args.completion_catalogue is not None and \
+       os.path.exists(args.completion_catalogue):
+        from completion_catalogue import CompletionCatalogue
+        if args.batch_iteration is None or args.maus_version is None:
+            print 'The completion catalogue needs -b and -m'
+            return 1
+        catalogue = CompletionCatalogue(args.completion_catalogue)
+        arguments = catalogue.filter_runs(arguments, args.batch_iteration, \
+                                          args.maus_version)
+    if args.metadata_index is not None and \
+       (args.mc_serial is not None or args.geometry_id is not None):
+        problems = check_mc_geometry(args)
+        if len(problems) > 0:
+            print 'Not submitting -', '; '.join(problems)
+            return metadata_index.INVALID_CODE
+    elif args.metadata_index is not None:
+        index = metadata_index.MetadataIndex(args.metadata_index)
+        index.update(arguments, args.runinfo, args.cdb_url, args.recheck_days)
+        arguments, rejected = index.validate(arguments)
+        for run in sorted(rejected.keys()):
+            print 'Not submitting run', run, '-', '; '.join(rejected[run])
+    if len(arguments) == 0:
+        print 'Nothing to submit'
+        return 0
+    if args.group_size > 1:
+        if args.runinfo is None:
+            print 'Grouping runs needs --runinfo'
+            return 1
+        n_runs = len(arguments)
+        arguments = affinity.group_arguments(arguments, args.runinfo, args)
+        print 'Grouped', n_runs, 'runs into', len(arguments), 'jobs'
+
+    with open(args.template) as template_file:
+        template = template_file.read()
+    if args.metadata_index is not None:
+        template = sandbox_index(template, args.metadata_index)
+
+    prod_db = ProdDB(args.db)
+    if args.site_stats:
+        stats = site_stats.SiteStats(prod_db)
+        stats.harvest(args.output_dir, args.runinfo)
+        template = site_stats.site_template(template, \
+                                            stats.summary(args.window_days), \
+                                            args, args.preferred_sites)
+
+    open(args.lock, 'w').close()
+    try:
+        backend = backends.get_backend(args.backend)
+        bucket = TokenBucket(args.rate, args.burst)
+        with open('submition_logs.txt', 'a') as log:
+            submitted = submit(backend, template, arguments, prod_db, \
+                               args.prod_id, args.lfc_name, args.bulk_size, \
+                               bucket, log)
+    finally:
+        os.remove(args.lock)
+    print 'Submitted', len(submitted), 'of', len(arguments), 'jobs'
+    if len(submitted) != len(arguments):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
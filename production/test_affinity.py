@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+Tests of affinity.py against rows of the shipped runinfo.sqlite
+
+Run from the production directory:
+    python -m unittest test_affinity
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+import affinity
+
+RUNINFO = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+                       '..', 'runinfo', 'runinfo.sqlite')
+
+class StubGeometry: # pylint: disable = R0903
+    """
+    cdb.Geometry returning one geometry for any start time
+    """
+    def __init__(self, *args):
+        """Ignore the CDB URL"""
+        self.starts = []
+
+    def get_ids(self, start):
+        """Record the start asked for"""
+        self.starts.append(start)
+        return {57:{'validFrom':'2017-01-01 00:00:00', \
+                    'created':'2017-01-01 00:00:00'}}
+
+class AffinityTest(unittest.TestCase): # pylint: disable = R0904
+    """
+    Geometry lookups and grouping of runs 10596-10603, whose runinfo start
+    times have fractions of a second
+    """
+    runs = range(10596, 10604)
+
+    def setUp(self):
+        """Install a stub cdb module and an empty geometry ID cache"""
+        self.saved_cdb = sys.modules.get('cdb')
+        stub = types.ModuleType('cdb')
+        stub.Geometry = StubGeometry
+        sys.modules['cdb'] = stub
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp_dir, 'geometry_ids.json')
+
+    def tearDown(self):
+        """Restore the cdb module"""
+        if self.saved_cdb is None:
+            del sys.modules['cdb']
+        else:
+            sys.modules['cdb'] = self.saved_cdb
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parse_start_time(self):
+        """Start times with and without fractions of a second parse"""
+        info = affinity.read_run_info(RUNINFO, [10603])
+        self.assertEqual(info[10603]['start'], '2017-12-20 06:35:04.458952')
+        self.assertEqual(affinity.parse_start_time(info[10603]['start']), \
+                         datetime.datetime(2017, 12, 20, 6, 35, 4))
+        self.assertEqual(affinity.parse_start_time('2017-12-20 06:35:04'), \
+                         datetime.datetime(2017, 12, 20, 6, 35, 4))
+        self.assertRaises(ValueError, affinity.parse_start_time, 'today')
+
+    def test_geometry_ids(self):
+        """Every run is looked up; a bad start time only skips its run"""
+        info = affinity.read_run_info(RUNINFO, self.runs)
+        info[10599]['start'] = 'not a time'
+        ids = affinity.geometry_ids(info, self.cache, affinity.CDBURL)
+        expected = dict([(run, 57) for run in self.runs])
+        expected[10599] = None
+        self.assertEqual(ids, expected)
+
+    def test_group_arguments(self):
+        """Runs with the same geometry and settings are grouped"""
+        args = argparse.Namespace(group_size=5, group_triggers=None, \
+                                  geometry_ids=self.cache, \
+                                  cdb_url=affinity.CDBURL)
+        self.assertEqual(affinity.group_arguments(self.runs, RUNINFO, args), \
+                         ['10596,10597,10598,10599,10600', \
+                          '10601,10602,10603'])
+
+if __name__ == "__main__":
+    unittest.main()